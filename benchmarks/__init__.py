@@ -0,0 +1,11 @@
+"""Benchmarks for xlaz.
+
+hlo_generator writes seeded, realistic HLO modules of any size, and run
+measures the lexer and parser on them and saves the results as JSON:
+
+  python -m benchmarks.run --max-size 16M --output results.json
+  python -m benchmarks.run --max-size 16M --compare results.json
+
+The scaling scripts (lexer_scaling.py, parser_scaling.py, import_time.py)
+can also be run on their own.
+"""
@@ -0,0 +1,212 @@
+"""Generates realistic HLO modules for benchmarks.
+
+The same config and seed always produce the same text, which
+xlaz.hlo_parser.ParseHloModule accepts. A module has scalar reducer
+computations, called computations that each apply a chain of elementwise
+instructions to one parameter, and an ENTRY computation that calls them.
+Instructions may carry sharding and metadata attributes, and modules may
+contain large dense constants and comments.
+"""
+import random
+from dataclasses import dataclass, replace
+
+ELEMENT_TYPES = ['f32', 'f32', 'f32', 'bf16', 'f16', 's32']
+REDUCER_TYPES = ['f32', 'bf16', 's32', 'f16']
+DIMENSIONS = [1, 2, 3, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+UNARY_OPS = ['negate', 'abs', 'exponential', 'tanh', 'sqrt', 'copy']
+BINARY_OPS = ['add', 'multiply', 'subtract', 'maximum', 'minimum', 'divide']
+OP_TYPES = ['Add', 'Mul', 'Sub', 'Max', 'Min', 'RealDiv', 'Neg', 'Abs', 'Exp', 'Tanh', 'Sqrt', 'Identity']
+
+@dataclass(frozen=True)
+class GeneratorConfig:
+  computations: int = 4  # Including the entry computation.
+  instructions: int = 100  # Per computation, other than reducers.
+  max_rank: int = 4
+  sharding: float = 0.5  # Fraction of instructions with a sharding.
+  metadata: float = 0.8  # Fraction of instructions with metadata.
+  constants: float = 0.02  # Fraction of instructions that are large constants.
+  constant_elements: int = 256  # Elements per large constant.
+  comments: float = 0.05  # Fraction of instructions preceded by a comment.
+  seed: int = 0
+
+class _Generator:
+  def __init__(self, config: GeneratorConfig):
+    self.config = config
+    self.rng = random.Random(config.seed)
+    self.lines = []
+    self.next_id = 0
+
+  def name(self, op):
+    self.next_id += 1
+    return f'{op}.{self.next_id}'
+
+  def random_shape(self, element_type=None):
+    element_type = element_type or self.rng.choice(ELEMENT_TYPES)
+    rank = self.rng.randint(0, self.config.max_rank)
+    return element_type, tuple(self.rng.choice(DIMENSIONS) for _ in range(rank))
+
+  @staticmethod
+  def format_shape(shape, layout=True):
+    element_type, dims = shape
+    text = f"{element_type}[{','.join(map(str, dims))}]"
+    if layout and dims:
+      text += '{' + ','.join(map(str, reversed(range(len(dims))))) + '}'
+    return text
+
+  def sharding(self, shape):
+    rank = len(shape[1])
+    r = self.rng.random()
+    if rank == 0 or r < 0.2:
+      return 'sharding={replicated}'
+    if r < 0.3:
+      return f'sharding={{maximal device={self.rng.randrange(8)}}}'
+    tile = [1] * rank
+    tile[self.rng.randrange(rank)] = self.rng.choice([2, 4, 8])
+    devices = 1
+    for d in tile:
+      devices *= d
+    if r < 0.65:
+      return f"sharding={{devices=[{','.join(map(str, tile))}]<=[{devices}]}}"
+    order = list(range(devices))
+    self.rng.shuffle(order)
+    return f"sharding={{devices=[{','.join(map(str, tile))}]{','.join(map(str, order))}}}"
+
+  def metadata(self, op):
+    op_type = self.rng.choice(OP_TYPES)
+    scope = '/'.join(self.rng.choice(['jit(train_step)', 'transformer', f'layer_{self.rng.randrange(48)}', 'mlp', 'attention'])
+                     for _ in range(self.rng.randint(1, 4)))
+    return (f'metadata={{op_type="{op_type}" op_name="{scope}/{op}" '
+            f'source_file="/home/user/model/layers.py" source_line={self.rng.randrange(1, 2000)}}}')
+
+  def attributes(self, shape, op):
+    attrs = []
+    if self.rng.random() < self.config.sharding:
+      attrs.append(self.sharding(shape))
+    if self.rng.random() < self.config.metadata:
+      attrs.append(self.metadata(op))
+    return ''.join(', ' + attr for attr in attrs)
+
+  def literal_value(self, element_type):
+    r = self.rng.random()
+    if element_type == 's32':
+      return str(self.rng.randint(-1000, 1000))
+    if r < 0.01:
+      return self.rng.choice(['inf', '-inf', 'nan'])
+    return f'{self.rng.gauss(0, 1):.6g}'
+
+  def constant(self, element_type):
+    count = max(1, self.config.constant_elements)
+    if count >= 16 and self.rng.random() < 0.5:
+      dims = (count // 16, 16)
+      rows = ('{' + ', '.join(self.literal_value(element_type) for _ in range(dims[1])) + '}' for _ in range(dims[0]))
+      return (element_type, dims), '{ ' + ', '.join(rows) + ' }'
+    dims = (count,)
+    return (element_type, dims), '{' + ', '.join(self.literal_value(element_type) for _ in range(count)) + '}'
+
+  def instruction(self, name, shape, op, operands, attrs='', root=False):
+    operands = ', '.join(f'%{operand}' for operand in operands)
+    prefix = 'ROOT ' if root else ''
+    self.lines.append(f'  {prefix}%{name} = {self.format_shape(shape)} {op}({operands}){attrs}')
+
+  def comment(self):
+    if self.rng.random() < self.config.comments:
+      if self.rng.random() < 0.5:
+        self.lines.append(f'  // {self.rng.choice(["fused", "rematerialized", "scheduled"])} region {self.next_id}')
+      else:
+        self.lines.append(f'  /* index={self.next_id} */')
+
+  def reducer(self, name, element_type):
+    self.lines.append(f'%{name} (x: {element_type}[], y: {element_type}[]) -> {element_type}[] {{')
+    self.lines.append(f'  %x = {element_type}[] parameter(0)')
+    self.lines.append(f'  %y = {element_type}[] parameter(1)')
+    self.lines.append(f'  ROOT %{self.name("add")} = {element_type}[] add(%x, %y)')
+    self.lines.append('}')
+    self.lines.append('')
+
+  def chain(self, values, shape, count, reducers):
+    """Appends count instructions computing values of shape from values, a
+    list of names of values of that shape, and returns the last one."""
+    element_type, dims = shape
+    for _ in range(count):
+      self.comment()
+      r = self.rng.random()
+      if r < self.config.constants:
+        constant_shape, literal = self.constant(element_type)
+        name = self.name('constant')
+        self.lines.append(f'  %{name} = {self.format_shape(constant_shape)} constant({literal})')
+        continue
+      if dims and element_type in reducers and r < 0.1:
+        init = self.name('constant')
+        self.lines.append(f'  %{init} = {element_type}[] constant(0)')
+        op = self.name('reduce')
+        scalar = (element_type, ())
+        self.instruction(op, scalar, 'reduce', [self.rng.choice(values[-8:]), init],
+                         f", dimensions={{{','.join(map(str, range(len(dims))))}}}, to_apply=%{reducers[element_type]}"
+                         + self.attributes(scalar, 'reduce'))
+        continue
+      if len(values) >= 2 and r < 0.7:
+        op = self.rng.choice(BINARY_OPS)
+        operands = self.rng.sample(values[-8:], 2)
+      else:
+        op = self.rng.choice(UNARY_OPS)
+        operands = [self.rng.choice(values[-8:])]
+      name = self.name(op)
+      self.instruction(name, shape, op, operands, self.attributes(shape, op))
+      values.append(name)
+    return values[-1]
+
+  def computation(self, name, shape, reducers):
+    self.lines.append(f'%{name} (p: {self.format_shape(shape, layout=False)}) -> {self.format_shape(shape, layout=False)} {{')
+    self.lines.append(f'  %p = {self.format_shape(shape)} parameter(0)')
+    last = self.chain(['p'], shape, max(0, self.config.instructions - 2), reducers)
+    self.instruction(self.name('copy'), shape, 'copy', [last], root=True)
+    self.lines.append('}')
+    self.lines.append('')
+
+  def module(self) -> str:
+    config = self.config
+    self.lines.append(f'HloModule bench_{config.seed}, is_scheduled=true')
+    self.lines.append('')
+    # Up to half of the other computations are reducers.
+    reducers = {}
+    for element_type in REDUCER_TYPES[:config.computations // 2]:
+      reducers[element_type] = f'region_{len(reducers)}.reduce_{element_type}'
+      self.reducer(reducers[element_type], element_type)
+    called = []
+    for i in range(config.computations - 1 - len(reducers)):
+      shape = self.random_shape()
+      called.append((f'computation.{i}', shape))
+      self.computation(called[-1][0], shape, reducers)
+    # The entry computation has a parameter for itself and for each called
+    # computation, and returns the results of all of them.
+    shape = self.random_shape('f32')
+    shapes = [shape] + [callee_shape for callee, callee_shape in called]
+    params = ', '.join(f'Arg_{i}: {self.format_shape(s, layout=False)}' for i, s in enumerate(shapes))
+    result = '(' + ', '.join(self.format_shape(s) for s in shapes) + ')'
+    self.lines.append(f"ENTRY %main ({params}) -> ({', '.join(self.format_shape(s, layout=False) for s in shapes)}) {{")
+    for i, s in enumerate(shapes):
+      self.lines.append(f'  %Arg_{i} = {self.format_shape(s)} parameter({i})')
+    results = []
+    for i, (callee, callee_shape) in enumerate(called, 1):
+      results.append(self.name('call'))
+      self.instruction(results[-1], callee_shape, 'call', [f'Arg_{i}'], f', to_apply=%{callee}')
+    last = self.chain(['Arg_0'], shape, max(0, config.instructions - 2 * len(shapes)), reducers)
+    operands = ', '.join(f'%{value}' for value in [last] + results)
+    self.lines.append(f'  ROOT %{self.name("tuple")} = {result} tuple({operands})')
+    self.lines.append('}')
+    self.lines.append('')
+    return '\n'.join(self.lines)
+
+def generate_module(config: GeneratorConfig = GeneratorConfig(), **kwargs) -> str:
+  """Returns the HLO text of a module generated from config, with any fields
+  overridden by kwargs."""
+  return _Generator(replace(config, **kwargs)).module()
+
+def module_of_size(size: int, config: GeneratorConfig = GeneratorConfig(), **kwargs) -> str:
+  """Returns a module of roughly size bytes, generated like generate_module
+  with the number of instructions per computation chosen to fit."""
+  config = replace(config, **kwargs)
+  sample = generate_module(config, instructions=100)
+  per_instruction = len(sample) / (100 * config.computations)
+  instructions = max(4, round(size / (per_instruction * config.computations)))
+  return generate_module(config, instructions=instructions)
@@ -0,0 +1,45 @@
+"""Measures how long it takes a fresh interpreter to import xlaz modules.
+
+Usage: python benchmarks/import_time.py [runs]
+
+Each module is imported in a new process, runs times, and the median time
+is reported next to the median for a bare interpreter. The last column
+shows whether the import loaded protobuf, which xlaz.hlo_lexer and its
+dependencies should never do.
+"""
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+  None,
+  'xlaz',
+  'xlaz.primitive_util',
+  'xlaz.hlo_lexer',
+  'xlaz.hlo_stream',
+  'xlaz.pb',
+  'xlaz.hlo_parser',
+]
+
+def time_import(module, runs):
+  code = 'import sys'
+  if module is not None:
+    code += f'; import {module}'
+  code += "; print(any(name.startswith('google.protobuf') for name in sys.modules))"
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    times.append(time.perf_counter() - start)
+  return statistics.median(times), output.strip() == 'True'
+
+def main(argv):
+  runs = int(argv[1]) if len(argv) > 1 else 10
+  print(f"{'module':<24} {'ms':>8} {'protobuf':>9}")
+  for module in MODULES:
+    seconds, protobuf = time_import(module, runs)
+    print(f"{module or '(interpreter)':<24} {seconds * 1e3:>8.1f} {'yes' if protobuf else 'no':>9}")
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,54 @@
+"""Measures how long IncrementalLexer takes to apply an edit.
+
+Usage: python -m benchmarks.incremental_edit [megabytes] [edits]
+
+A module of the given size (default 10 MB) is generated with
+benchmarks.hlo_generator, and edits (default 1000) of each pattern are made
+to it: one-byte inserts at random offsets, at alternate ends of the module
+and typed one after the other in the middle of it, and deletes of a byte
+inserted at a random offset just before. The time of an edit shouldn't
+depend on the size of the module or on how far it is from the one before,
+so the median and worst milliseconds should stay roughly the same for every
+pattern and size.
+"""
+import random
+import sys
+import time
+
+from xlaz.hlo_incremental import IncrementalLexer
+
+from benchmarks.hlo_generator import module_of_size
+
+def offsets(pattern, size, edits, rng):
+  if pattern == 'random':
+    return [rng.randrange(size) for _ in range(edits)]
+  if pattern == 'ends':
+    return [0 if i % 2 else size - 1 for i in range(edits)]
+  return [size // 2 + i for i in range(edits)]
+
+def main(argv):
+  megabytes = int(argv[1]) if len(argv) > 1 else 10
+  edits = int(argv[2]) if len(argv) > 2 else 1000
+  text = module_of_size(megabytes << 20, computations=200)
+  start = time.perf_counter()
+  lexer = IncrementalLexer(text)
+  print(f"{len(lexer)} tokens in {lexer.size / 2**20:.1f} MB, lexed in {time.perf_counter() - start:.1f} s")
+  print(f"{'edit':>8} {'pattern':>8} {'median ms':>10} {'max ms':>10}")
+  rng = random.Random(0)
+  for edit in ('insert', 'delete'):
+    for pattern in (('random', 'ends', 'typed') if edit == 'insert' else ('random',)):
+      times = []
+      for offset in offsets(pattern, lexer.size, edits, rng):
+        if edit == 'delete':
+          lexer.edit(offset, 0, ' ')
+        start = time.perf_counter()
+        if edit == 'insert':
+          lexer.edit(offset, 0, ' ')
+        else:
+          lexer.edit(offset, 1)
+        times.append(time.perf_counter() - start)
+      times.sort()
+      print(f"{edit:>8} {pattern:>8} {times[len(times) // 2] * 1e3:>10.3f} {times[-1] * 1e3:>10.3f}")
+
+if __name__ == '__main__':
+  main(sys.argv)
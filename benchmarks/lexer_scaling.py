@@ -0,0 +1,44 @@
+"""Measures how HloLexer throughput scales with module size.
+
+Usage: python benchmarks/lexer_scaling.py [max_instructions [engine]]
+
+Lex time should grow linearly with the size of the module, so the
+microseconds-per-KB column should stay roughly flat as the module doubles.
+"""
+import sys
+import time
+
+from xlaz.hlo_lexer import HloLexer, TokKind
+
+INSTRUCTION = """\
+  %add.{i} = f32[5,7,11,13]{{3,2,1,0}} add(%param0, %param1), sharding={{devices=[1,2,2,1]0,1,2,3}}, metadata={{op_name="add.{i}" source_line={i}}}
+  %conv.{i} = f32[1,2,3]{{2,1,0}} convolution(%lhs, %rhs), window={{size=2x2 pad=0_1x1_0}}, dim_labels=01b_io01->b01, constant=-1.5e-3
+"""
+
+def make_module(n):
+  body = "".join(INSTRUCTION.format(i=i) for i in range(n))
+  return "HloModule bench\nENTRY %main {\n" + body + "}\n"
+
+def lex_all(text, engine='hand'):
+  lexer = HloLexer(text, engine=engine)
+  count = 0
+  while lexer.Lex() not in (TokKind.kEof, TokKind.kError):
+    count += 1
+  return count
+
+def main(argv):
+  max_instructions = int(argv[1]) if len(argv) > 1 else 4096
+  engine = argv[2] if len(argv) > 2 else 'hand'
+  n = 64
+  print(f"{'instrs':>8} {'KB':>10} {'tokens':>10} {'seconds':>10} {'us/KB':>10} {'tokens/s':>10}")
+  while n <= max_instructions:
+    text = make_module(n)
+    start = time.perf_counter()
+    tokens = lex_all(text, engine)
+    elapsed = time.perf_counter() - start
+    kb = len(text) / 1024
+    print(f"{n:>8} {kb:>10.1f} {tokens:>10} {elapsed:>10.3f} {elapsed / kb * 1e6:>10.1f} {tokens / elapsed:>10.0f}")
+    n *= 2
+
+if __name__ == '__main__':
+  main(sys.argv)
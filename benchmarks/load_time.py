@@ -0,0 +1,53 @@
+"""Measures how long LoadHloModule takes to index a module.
+
+Usage: python -m benchmarks.load_time [max_megabytes] [computations]
+
+Modules of 1 MB, doubling up to max_megabytes (default 20), are generated
+with benchmarks.hlo_generator with the given number of computations
+(default 200), and loaded from str, bytes and an mmap of a file holding
+them. Loading only finds where each computation starts, so the seconds
+should stay far below the time to parse, and the MB/s column roughly flat
+as the module doubles. The last column is the time to parse the first
+computation on first access.
+"""
+import mmap
+import sys
+import tempfile
+import time
+
+from xlaz.hlo_module import LoadHloModule
+
+from benchmarks.hlo_generator import module_of_size
+
+def best_of(runs, function):
+  """Returns the shortest time of runs calls to function, and its result."""
+  best = None
+  for _ in range(runs):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+def main(argv):
+  max_megabytes = int(argv[1]) if len(argv) > 1 else 20
+  computations = int(argv[2]) if len(argv) > 2 else 200
+  print(f"{'MB':>6} {'buffer':>7} {'seconds':>9} {'MB/s':>9} {'first':>9}")
+  megabytes = 1
+  while megabytes <= max_megabytes:
+    text = module_of_size(megabytes << 20, computations=computations)
+    data = text.encode()
+    with tempfile.TemporaryFile() as f:
+      f.write(data)
+      f.flush()
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for kind, buf in (('str', text), ('bytes', data), ('mmap', mapped)):
+          seconds, module = best_of(3, lambda: LoadHloModule(buf))
+          assert len(module) == computations and module.parsed_module is None
+          first, _ = best_of(1, lambda: module[next(iter(module))])
+          print(f"{len(data) / 2**20:>6.1f} {kind:>7} {seconds:>9.4f} {len(data) / 2**20 / seconds:>9.1f} {first:>9.4f}")
+    megabytes *= 2
+
+if __name__ == '__main__':
+  main(sys.argv)
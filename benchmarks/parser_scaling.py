@@ -0,0 +1,39 @@
+"""Measures how HloParser throughput scales with module size.
+
+Usage: python benchmarks/parser_scaling.py [max_instructions]
+
+Parse time should grow linearly with the size of the module, so the
+microseconds-per-KB column should stay roughly flat as the module doubles.
+"""
+import sys
+import time
+
+from xlaz.hlo_parser import ParseHloModule
+
+INSTRUCTION = """\
+  %add.{i} = f32[5,7,11,13]{{3,2,1,0}} add(%add.{j}, %param0), sharding={{devices=[1,2,2,1]0,1,2,3}}, metadata={{op_name="add.{i}" source_line={i}}}
+"""
+
+def make_module(n):
+  body = "".join(INSTRUCTION.format(i=i, j=i - 1) for i in range(1, n))
+  return ("HloModule bench\nENTRY %main {\n"
+          "  %param0 = f32[5,7,11,13]{3,2,1,0} parameter(0)\n"
+          "  %add.0 = f32[5,7,11,13]{3,2,1,0} copy(%param0)\n" + body +
+          f"  ROOT %result = f32[5,7,11,13]{{3,2,1,0}} copy(%add.{n - 1})\n}}\n")
+
+def main(argv):
+  max_instructions = int(argv[1]) if len(argv) > 1 else 4096
+  n = 64
+  print(f"{'instrs':>8} {'KB':>10} {'seconds':>10} {'us/KB':>10}")
+  while n <= max_instructions:
+    text = make_module(n)
+    start = time.perf_counter()
+    module = ParseHloModule(text)
+    elapsed = time.perf_counter() - start
+    assert len(module.computations[0].instructions) == n + 2
+    kb = len(text) / 1024
+    print(f"{n:>8} {kb:>10.1f} {elapsed:>10.3f} {elapsed / kb * 1e6:>10.1f}")
+    n *= 2
+
+if __name__ == '__main__':
+  main(sys.argv)
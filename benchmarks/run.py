@@ -0,0 +1,138 @@
+"""Runs the lexer and parser benchmarks over a range of module sizes.
+
+Usage: python -m benchmarks.run [--min-size 10K] [--max-size 500M]
+           [--benchmarks lex,lex-regex,tokenize,parse] [--seed N]
+           [--no-memory] [--output results.json] [--compare old.json]
+
+For each size, doubling from --min-size to --max-size, a module is
+generated with benchmarks.hlo_generator and every benchmark is run on it.
+Each result reports tokens/s, MB/s and, unless --no-memory is given, the
+peak memory allocated while the benchmark ran, measured with tracemalloc
+in a second, untimed run. Sizes past a few MB take minutes per benchmark
+in pure Python, so lower --max-size for quick comparisons.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import xlaz
+from xlaz.hlo_lexer import HloLexer, TokKind, tokenize
+from xlaz.hlo_parser import ParseHloModule
+
+from benchmarks.hlo_generator import GeneratorConfig, module_of_size
+
+def lex_all(text, engine='hand'):
+  lexer = HloLexer(text, engine=engine)
+  count = 0
+  while lexer.Lex() not in (TokKind.kEof, TokKind.kError):
+    count += 1
+  return count
+
+def parse(text):
+  # Returns None so that the token count of another benchmark is reused.
+  ParseHloModule(text)
+
+BENCHMARKS = {
+  'lex': lex_all,
+  'lex-regex': lambda text: lex_all(text, engine='regex'),
+  'tokenize': lambda text: len(tokenize(text)),
+  'parse': parse,
+}
+
+def parse_size(size: str) -> int:
+  units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+  size = size.strip().upper().rstrip('B')
+  if size and size[-1] in units:
+    return int(float(size[:-1]) * units[size[-1]])
+  return int(size)
+
+def peak_memory(function, text) -> int:
+  gc.collect()
+  tracemalloc.start()
+  try:
+    function(text)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def run(sizes, benchmarks, config: GeneratorConfig, memory: bool = True):
+  """Yields a result dict for each size and benchmark."""
+  for size in sizes:
+    text = module_of_size(size, config)
+    size_bytes = len(text.encode())
+    tokens = None
+    for name in benchmarks:
+      function = BENCHMARKS[name]
+      gc.collect()
+      start = time.perf_counter()
+      count = function(text)
+      seconds = time.perf_counter() - start
+      if count is not None:
+        tokens = count
+      result = {
+        'benchmark': name,
+        'size': size,
+        'bytes': size_bytes,
+        'tokens': tokens,
+        'seconds': seconds,
+        'tokens_per_second': tokens / seconds if tokens else None,
+        'mb_per_second': size_bytes / seconds / 1e6,
+        'peak_bytes': peak_memory(function, text) if memory else None,
+      }
+      yield result
+
+def format_result(result, baseline=None) -> str:
+  line = (f"{result['benchmark']:<10} {result['bytes'] / 1e6:>10.2f} {result['tokens'] or 0:>11} "
+          f"{result['seconds']:>9.3f} {result['tokens_per_second'] or 0:>11.0f} {result['mb_per_second']:>7.3f} "
+          f"{(result['peak_bytes'] or 0) / 1e6:>9.1f}")
+  if baseline is not None:
+    line += f" {baseline['seconds'] / result['seconds']:>7.2f}x"
+  return line
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description="Benchmark the HLO lexer and parser.")
+  parser.add_argument('--min-size', default='10K')
+  parser.add_argument('--max-size', default='500M')
+  parser.add_argument('--benchmarks', default='lex,lex-regex,tokenize,parse',
+                      help=f"comma-separated, from {', '.join(BENCHMARKS)}")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+  parser.add_argument('--output', help="save the results as JSON")
+  parser.add_argument('--compare', help="show speedups against results saved with --output")
+  args = parser.parse_args(argv)
+  benchmarks = args.benchmarks.split(',')
+  for name in benchmarks:
+    if name not in BENCHMARKS:
+      parser.error(f"unknown benchmark {name!r}")
+  sizes = []
+  size = parse_size(args.min_size)
+  while size <= parse_size(args.max_size):
+    sizes.append(size)
+    size *= 2
+  config = GeneratorConfig(seed=args.seed)
+  baselines = {}
+  if args.compare:
+    with open(args.compare) as f:
+      baselines = {(result['benchmark'], result['size']): result for result in json.load(f)['results']}
+  print(f"{'benchmark':<10} {'MB':>10} {'tokens':>11} {'seconds':>9} {'tokens/s':>11} {'MB/s':>7} {'peak MB':>9}"
+        + (f" {'speedup':>8}" if baselines else ''))
+  results = []
+  for result in run(sizes, benchmarks, config, memory=not args.no_memory):
+    results.append(result)
+    print(format_result(result, baselines.get((result['benchmark'], result['size']))), flush=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({
+        'xlaz_version': xlaz.__version__,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'config': vars(config),
+        'results': results,
+      }, f, indent=2)
+
+if __name__ == '__main__':
+  main()
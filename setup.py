@@ -11,10 +11,7 @@ package_dir = \
 {'': 'src'}
 
 packages = \
-['xlaz',
- 'xlaz.pb',
- 'xlaz.pb.tensorflow.compiler.xla',
- 'xlaz.pb.tensorflow.compiler.xla.service']
+['xlaz', 'xlaz.pb']
 
 package_data = \
 {'': ['*']}
@@ -22,11 +19,19 @@ package_data = \
 install_requires = \
 ['tensorflow-checkpoint-reader>=0.1.2']
 
+extras_require = \
+{'numpy': ['numpy>=1.17']}
+
+entry_points = \
+{'console_scripts': ['xlaz-scan = xlaz.hlo_scan:main', 'xlaz-diff = xlaz.hlo_diff:main']}
+
 setup_kwargs = {
     'package_dir': package_dir,
     'packages': packages,
     'package_data': package_data,
     'install_requires': install_requires,
+    'extras_require': extras_require,
+    'entry_points': entry_points,
     'python_requires': '>=3.8,<4.0',
 }
 
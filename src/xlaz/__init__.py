@@ -1,4 +1,9 @@
-# read version from installed package
-from importlib.metadata import version
-__version__ = version("xlaz")
-
+def __getattr__(name):
+  # Reading the installed package metadata is slow, so the version is only
+  # looked up when it's asked for.
+  if name == '__version__':
+    from importlib.metadata import version
+    global __version__
+    __version__ = version("xlaz")
+    return __version__
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
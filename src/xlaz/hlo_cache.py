@@ -0,0 +1,180 @@
+"""An opt-in on-disk cache of lexed token tables and parsed modules.
+
+Entries are keyed by a hash of the xlaz version, the source text and whether
+it is a str or bytes, so a changed dump or a new xlaz version never sees
+stale results. Entries are
+written to a temporary file and renamed into place, so concurrent readers
+only ever see complete files. They are read back with mmap: token tables
+are used in place, without copying their columns. When the cache grows past
+max_bytes, the least recently used entries are removed. Only files named
+like entries are ever removed, so the directory may hold other files.
+"""
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+import time
+from typing import Optional, Union
+
+import xlaz
+from xlaz.hlo_lexer import TokenTable, tokenize
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+kTokenTableMagic = b'XLAZTOK1'
+
+# The names of the files of finished entries: the key and the kind.
+kEntryNamePattern = re.compile(r"[0-9a-f]{64}\.(?:tokens|hlo\.pb)")
+
+# Put writes entries to temporary files with this prefix before renaming
+# them into place. Clear only removes those older than kStaleTemporarySeconds,
+# which another process is no longer writing.
+kTemporaryPrefix = '.tmp-'
+kStaleTemporarySeconds = 3600
+
+def DefaultCacheDirectory() -> str:
+  return os.environ.get('XLAZ_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'xlaz')
+
+def SerializeTokenTable(table: TokenTable) -> bytes:
+  """Returns the columns of table as a magic string, the length of each
+  column, and the columns themselves, each padded to a multiple of 8 bytes."""
+  columns = [getattr(table, name) for name, typecode in TokenTable.columns]
+  parts = [kTokenTableMagic, struct.pack(f'<{len(columns)}q', *map(len, columns))]
+  for column in columns:
+    data = column.tobytes()
+    parts.append(data)
+    parts.append(b'\0' * (-len(data) % 8))
+  return b''.join(parts)
+
+def DeserializeTokenTable(text, buf) -> TokenTable:
+  """Returns a read-only TokenTable whose columns are views of buf, which was
+  produced by SerializeTokenTable."""
+  view = memoryview(buf)
+  if bytes(view[:len(kTokenTableMagic)]) != kTokenTableMagic:
+    raise ValueError("not a serialized token table")
+  count = len(TokenTable.columns)
+  offset = len(kTokenTableMagic)
+  lengths = struct.unpack_from(f'<{count}q', view, offset)
+  offset += 8 * count
+  columns = {}
+  for (name, typecode), length in zip(TokenTable.columns, lengths):
+    size = length * struct.calcsize(typecode)
+    columns[name] = view[offset:offset + size].cast(typecode)
+    offset += size + (-size % 8)
+  return TokenTable(text, **columns)
+
+class HloCache:
+  """A directory of cached token tables and parsed modules."""
+  def __init__(self, directory: Optional[str] = None, max_bytes: int = 1 << 30):
+    self.directory = directory or DefaultCacheDirectory()
+    self.max_bytes = max_bytes
+    os.makedirs(self.directory, exist_ok=True)
+
+  def Key(self, text: Union[str, bytes], kind: str) -> str:
+    """Returns the key of the entry of the given kind for text. Token tables
+    hold character offsets into str and byte offsets into bytes, so a str
+    and its UTF-8 encoding have different keys."""
+    h = hashlib.sha256()
+    buffer = 'str' if isinstance(text, str) else 'bytes'
+    h.update(f'{xlaz.__version__}\0{kind}\0{buffer}\0'.encode())
+    h.update(text.encode() if isinstance(text, str) else text)
+    return h.hexdigest()
+
+  def Path(self, key: str, kind: str) -> str:
+    return os.path.join(self.directory, f'{key}.{kind}')
+
+  def Get(self, key: str, kind: str) -> Optional[mmap.mmap]:
+    """Returns a read-only mmap of the entry, or None if it isn't cached."""
+    path = self.Path(key, kind)
+    try:
+      with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+      # Missing, evicted by another process, or empty.
+      return None
+    try:
+      # Mark the entry as recently used.
+      os.utime(path)
+    except OSError:
+      pass
+    return buf
+
+  def Put(self, key: str, kind: str, data: bytes):
+    fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=kTemporaryPrefix)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.replace(tmp, self.Path(key, kind))
+    except BaseException:
+      try:
+        os.unlink(tmp)
+      except OSError:
+        pass
+      raise
+    self.Evict()
+
+  def Evict(self):
+    """Removes the least recently used entries until the cache is no larger
+    than max_bytes."""
+    entries = []
+    total = 0
+    for entry in os.scandir(self.directory):
+      if not kEntryNamePattern.fullmatch(entry.name):
+        continue
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+      total += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  def Clear(self):
+    """Removes every entry, and temporary files left behind by writers that
+    stopped more than kStaleTemporarySeconds ago."""
+    stale = time.time() - kStaleTemporarySeconds
+    for entry in os.scandir(self.directory):
+      try:
+        if not (kEntryNamePattern.fullmatch(entry.name) or
+                entry.name.startswith(kTemporaryPrefix) and entry.stat().st_mtime < stale):
+          continue
+        os.unlink(entry.path)
+      except FileNotFoundError:
+        pass
+
+  def Tokenize(self, text) -> TokenTable:
+    """Like xlaz.hlo_lexer.tokenize, but loads the table from the cache when
+    text has been tokenized before. Cached tables are read-only."""
+    key = self.Key(text, 'tokens')
+    buf = self.Get(key, 'tokens')
+    if buf is not None:
+      try:
+        return DeserializeTokenTable(text, buf)
+      except (ValueError, struct.error, TypeError):
+        pass
+    table = tokenize(text)
+    self.Put(key, 'tokens', SerializeTokenTable(table))
+    return table
+
+  def ParseHloModule(self, text) -> hlo_pb2.HloModuleProto:
+    """Like xlaz.hlo_parser.ParseHloModule, but loads the module from the cache
+    when text has been parsed before."""
+    from xlaz.hlo_parser import ParseHloModule
+    key = self.Key(text, 'hlo.pb')
+    buf = self.Get(key, 'hlo.pb')
+    if buf is not None:
+      with buf:
+        return hlo_pb2.HloModuleProto.FromString(buf[:])
+    module = ParseHloModule(text)
+    self.Put(key, 'hlo.pb', module.SerializeToString())
+    return module
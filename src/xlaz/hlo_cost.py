@@ -0,0 +1,238 @@
+"""Byte sizes, live bytes and FLOPs of every instruction of a module, with
+NumPy.
+
+CostAnalysis gathers the shapes of a module into arrays once: the dimensions
+of every array shape, padded with 1s to the largest rank, their element
+types, and the operands of every instruction as positions. Everything else
+is computed on those arrays at once rather than one instruction at a time:
+
+  output_bytes  the bytes of each instruction's shape, tuples included;
+  flops         2 per multiply-add for dot and convolution, and 1 per output
+                element for arithmetic elementwise ops;
+  live_bytes    the bytes of the buffers live while each instruction runs,
+                if the instructions of each computation run in text order.
+
+A buffer is live from the instruction that defines it, or the start of its
+computation for a parameter, to its last use, or the end of its computation
+for the root. tuple, get-tuple-element and bitcast alias their operands
+instead of defining buffers, and keep them live. Called computations don't
+add to the live bytes of their callers, and layouts, padding and windows are
+ignored, so the numbers are estimates for budget checks rather than what a
+compiler would allocate.
+
+  cost = CostAnalysis(ParseHloModule(text))
+  peak = cost.peak_live_bytes()['main']
+
+NumPy is required.
+"""
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+
+from xlaz import primitive_util
+from xlaz.hlo_literal import Numpy
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+# Elementwise opcodes that count one FLOP per output element. Data movement
+# like copy and convert doesn't count.
+kElementwiseOpcodes = frozenset([
+  'abs', 'add', 'and', 'atan2', 'cbrt', 'ceil', 'clamp', 'clz', 'compare', 'complex', 'cosine', 'divide',
+  'exponential', 'exponential-minus-one', 'floor', 'imag', 'is-finite', 'log', 'log-plus-one', 'logistic',
+  'maximum', 'minimum', 'multiply', 'negate', 'not', 'or', 'popcnt', 'power', 'real', 'remainder',
+  'round-nearest-afz', 'round-nearest-even', 'rsqrt', 'select', 'shift-left', 'shift-right-arithmetic',
+  'shift-right-logical', 'sign', 'sine', 'sqrt', 'subtract', 'tan', 'tanh', 'xor',
+])
+
+# Opcodes whose result is one of their operands, or made of them.
+kAliasingOpcodes = frozenset(['tuple', 'get-tuple-element', 'bitcast'])
+
+@lru_cache
+def ByteWidths():
+  """Returns the byte width of each primitive type as an array indexed by
+  the type."""
+  np = Numpy()
+  widths = np.zeros(max(primitive_util.kByteWidths) + 1, dtype=np.int64)
+  for type, width in primitive_util.kByteWidths.items():
+    widths[type] = width
+  return widths
+
+def ShapeArrays(shapes: Sequence[xd.ShapeProto]):
+  """Returns (dimensions, element_types) for array shapes: an int64 array of
+  their dimensions, one row each padded with 1s to the largest rank, and an
+  array of their element types."""
+  np = RequireNumpy()
+  flat = []
+  ranks = []
+  element_types = []
+  for shape in shapes:
+    shape_dimensions = shape.dimensions
+    flat.extend(shape_dimensions)
+    ranks.append(len(shape_dimensions))
+    element_types.append(shape.element_type)
+  ranks = np.array(ranks, dtype=np.int64)
+  dimensions = np.ones((len(shapes), int(ranks.max(initial=0))), dtype=np.int64)
+  # The row and column of each of the flattened dimensions.
+  rows = np.repeat(np.arange(len(shapes)), ranks)
+  columns = np.arange(len(flat)) - np.repeat(np.cumsum(ranks) - ranks, ranks)
+  dimensions[rows, columns] = flat
+  return dimensions, np.array(element_types, dtype=np.int64)
+
+def ArrayBytes(dimensions, element_types):
+  """Returns the bytes of each array shape given as by ShapeArrays."""
+  return dimensions.prod(axis=1) * ByteWidths()[element_types]
+
+def RequireNumpy():
+  np = Numpy()
+  if np is None:
+    raise ImportError("CostAnalysis requires numpy")
+  return np
+
+class CostAnalysis:
+  def __init__(self, module: hlo_pb2.HloModuleProto):
+    """Gathers the shapes of module and computes the costs of its
+    instructions. Arrays are indexed by the position of an instruction in
+    module order; ids has the id of each."""
+    np = RequireNumpy()
+    self.module = module
+    ids = []
+    opcodes = []
+    computations = []  # Position of the computation of each instruction.
+    starts = []  # Position of the first instruction of each computation.
+    roots = []
+    # Array shapes, each with the position of the instruction it is part of.
+    shapes: List[xd.ShapeProto] = []
+    owners = []
+    # Position of the array shape of each instruction, or -1 for a tuple.
+    own_shapes = []
+    users = []
+    operands = []
+    # The instructions that sum over dimensions of one of their operands:
+    # the operand's position and its dimensions that are summed over, or,
+    # for a convolution, the one dimension of its kernel that isn't.
+    reducers = []
+    reduced = []
+    reduced_dimensions: List[Tuple[Sequence[int], bool]] = []
+    for c, computation in enumerate(module.computations):
+      start = len(ids)
+      starts.append(start)
+      positions = {instruction.id: start + k for k, instruction in enumerate(computation.instructions)}
+      roots.append(positions.get(computation.root_id, -1))
+      for instruction in computation.instructions:
+        position = len(ids)
+        opcode = instruction.opcode
+        shape = instruction.shape
+        ids.append(instruction.id)
+        opcodes.append(opcode)
+        computations.append(c)
+        if shape.element_type == primitive_util.TUPLE:
+          own_shapes.append(-1)
+          self.AddShape(shape, position, shapes, owners)
+        else:
+          own_shapes.append(len(shapes))
+          shapes.append(shape)
+          owners.append(position)
+        operand_ids = instruction.operand_ids
+        if operand_ids:
+          users.extend([position] * len(operand_ids))
+          operands.extend([positions[id] for id in operand_ids])
+        if opcode == 'dot':
+          reducers.append(position)
+          reduced.append(positions[instruction.operand_ids[0]])
+          reduced_dimensions.append((instruction.dot_dimension_numbers.lhs_contracting_dimensions, False))
+        elif opcode == 'convolution':
+          reducers.append(position)
+          reduced.append(positions[instruction.operand_ids[1]])
+          reduced_dimensions.append(([instruction.convolution_dimension_numbers.kernel_output_feature_dimension], True))
+    n = len(ids)
+    self.ids = np.array(ids, dtype=np.int64)
+    self.computation_starts = np.array(starts, dtype=np.int64)
+    self.opcode_names, self.opcodes = np.unique(np.array(opcodes, dtype=str), return_inverse=True)
+    self.computations = np.array(computations, dtype=np.int64)
+    dimensions, element_types = ShapeArrays(shapes)
+    owners = np.array(owners, dtype=np.int64)
+    own_shapes = np.array(own_shapes, dtype=np.int64)
+    users = np.array(users, dtype=np.int64)
+    operands = np.array(operands, dtype=np.int64)
+
+    # Output bytes: the bytes of the array shapes summed per instruction.
+    shape_bytes = ArrayBytes(dimensions, element_types)
+    self.output_bytes = np.zeros(n, dtype=np.int64)
+    np.add.at(self.output_bytes, owners, shape_bytes)
+
+    # FLOPs.
+    elements = np.zeros(n, dtype=np.int64)
+    arrays = own_shapes >= 0
+    elements[arrays] = dimensions[own_shapes[arrays]].prod(axis=1)
+    elementwise = np.isin(self.opcode_names, sorted(kElementwiseOpcodes))[self.opcodes]
+    self.flops = np.where(elementwise, elements, 0)
+    if reducers:
+      reducers = np.array(reducers, dtype=np.int64)
+      operand_dimensions = dimensions[own_shapes[np.array(reduced, dtype=np.int64)]]
+      mask = np.zeros(operand_dimensions.shape, dtype=bool)
+      for row, (reduced_row, complement) in enumerate(reduced_dimensions):
+        if complement:
+          mask[row] = True
+        mask[row, list(reduced_row)] = not complement
+      reduction_sizes = np.where(mask, operand_dimensions, 1).prod(axis=1)
+      self.flops[reducers] = 2 * elements[reducers] * reduction_sizes
+
+    # Live bytes: each buffer is live from its first to its last position,
+    # and the bytes live at each position are a running sum.
+    aliasing = np.isin(self.opcode_names, sorted(kAliasingOpcodes))[self.opcodes]
+    first = np.arange(n, dtype=np.int64)
+    parameters = self.opcode_names[self.opcodes] == 'parameter'
+    first[parameters] = self.computation_starts[self.computations[parameters]]
+    last = np.arange(n, dtype=np.int64)
+    np.maximum.at(last, operands, users)
+    root_positions = np.array([root for root in roots if root >= 0], dtype=np.int64)
+    ends = np.append(self.computation_starts[1:], n) - 1
+    last[root_positions] = ends[self.computations[root_positions]]
+    # An aliased buffer stays live as long as its aliases. This loops over
+    # the operands of aliasing instructions only, users last first so that
+    # chains of aliases are followed.
+    alias_edges = np.flatnonzero(aliasing[users])
+    for edge in alias_edges[np.argsort(-users[alias_edges], kind='stable')]:
+      if last[users[edge]] > last[operands[edge]]:
+        last[operands[edge]] = last[users[edge]]
+    allocated = np.where(aliasing, 0, self.output_bytes)
+    changes = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(changes, first, allocated)
+    np.add.at(changes, last + 1, -allocated)
+    self.live_bytes = np.cumsum(changes[:n])
+
+  def AddShape(self, shape: xd.ShapeProto, position: int, shapes: List[xd.ShapeProto], owners: List[int]):
+    """Adds the array shapes of a tuple shape, owned by position."""
+    for element in shape.tuple_shapes:
+      if element.element_type == primitive_util.TUPLE:
+        self.AddShape(element, position, shapes, owners)
+      else:
+        shapes.append(element)
+        owners.append(position)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def position(self, id: int) -> int:
+    """Returns the position of the instruction with the given id."""
+    return int(self.computation_starts[id >> 32]) + (id & 0xffffffff)
+
+  def peak_live_bytes(self) -> Dict[str, int]:
+    """Returns the largest live bytes of each computation by name."""
+    np = Numpy()
+    # Empty computations start where the next one does, or past the end.
+    starts = np.minimum(self.computation_starts, len(self) - 1)
+    peaks = np.maximum.reduceat(self.live_bytes, starts) if len(self) else []
+    return {computation.name: int(peak) if computation.instructions else 0
+            for computation, peak in zip(self.module.computations, peaks)}
+
+  def total_flops(self) -> int:
+    return int(self.flops.sum())
+
+  def report(self) -> dict:
+    """Returns the totals as a dict of plain values, ready for json.dump."""
+    return {
+      'instructions': len(self),
+      'output_bytes': int(self.output_bytes.sum()),
+      'flops': self.total_flops(),
+      'peak_live_bytes': self.peak_live_bytes(),
+    }
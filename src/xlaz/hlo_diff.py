@@ -0,0 +1,323 @@
+"""Structural diff of two HLO modules.
+
+DiffHloModules parses both modules into an xlaz.hlo_index.HloIndex and
+compares their structure rather than their text, so renamed instructions
+and renumbered ids don't show up as changes. Computations are paired first
+by fingerprint (see xlaz.hlo_fingerprint), which settles every unchanged
+computation without looking at its instructions, then by name, and then by
+how many instructions they share.
+
+Within a pair of computations, instructions are paired in passes:
+
+  1. by deep hash: the hash of an instruction together with everything it
+     depends on, so an unchanged subgraph is paired whatever its names;
+  2. by name;
+  3. in dependency order, by their own fingerprint and paired operands,
+     then by opcode and paired operands, then by paired operands alone,
+     which pairs an instruction whose attributes or opcode changed in place;
+  4. from the root down, the operands of paired instructions with the same
+     opcode at the same position, which pairs an instruction whose inputs
+     changed.
+
+Each pass is a dict lookup per instruction, so the diff takes time linear
+in the size of the modules; parsing them takes most of it. A paired
+instruction is changed if its fingerprint, callees or paired operands
+differ; unpaired ones were added or removed.
+
+Usage: xlaz-diff [--summary] OLD NEW
+"""
+import argparse
+import hashlib
+import sys
+from collections import defaultdict, deque
+from typing import Dict, List, NamedTuple, Optional
+
+from xlaz.hlo_fingerprint import ComputationFingerprints
+from xlaz.hlo_index import HloIndex, IndexEntry
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+class InstructionDiff(NamedTuple):
+  kind: str  # 'added', 'removed' or 'changed'.
+  old: Optional[IndexEntry]
+  new: Optional[IndexEntry]
+
+class ComputationDiff(NamedTuple):
+  """A computation that differs. old or new is None if it was added or
+  removed, in which case instructions is empty."""
+  old: Optional[str]
+  new: Optional[str]
+  instructions: List[InstructionDiff]
+
+class ModuleDiff(NamedTuple):
+  old: HloIndex
+  new: HloIndex
+  computations: List[ComputationDiff]
+  identical_computations: int
+
+  def instructions(self, kind: Optional[str] = None) -> List[InstructionDiff]:
+    """Returns the differing instructions of every computation, or only those
+    of the given kind."""
+    return [diff for computation in self.computations for diff in computation.instructions
+            if kind is None or diff.kind == kind]
+
+  def __bool__(self):
+    """Whether the modules differ."""
+    return bool(self.computations)
+
+class ComputationGraph:
+  """The instructions of a computation, with the hashes used to pair them."""
+  def __init__(self, computation: hlo_pb2.HloComputationProto, fingerprints: Dict[int, str],
+               instruction_fingerprints: Dict[int, bytes]):
+    """fingerprints are those of the computations of the module by id, and
+    instruction_fingerprints those of its instructions, as stored by
+    ComputationFingerprints."""
+    self.computation = computation
+    instructions = computation.instructions
+    self.positions_ = positions = {instruction.id: i for i, instruction in enumerate(instructions)}
+    self.operands = [[positions[id] for id in instruction.operand_ids] for instruction in instructions]
+    # Each instruction's own fingerprint, including those of its callees.
+    self.local = []
+    for instruction in instructions:
+      h = hashlib.sha256(instruction_fingerprints[instruction.id])
+      h.update(''.join(fingerprints[id] for id in instruction.called_computation_ids).encode())
+      self.local.append(h.digest())
+    self.order = TopologicalOrder(self.operands)
+    self.deep = [None] * len(instructions)
+    for i in self.order:
+      h = hashlib.sha256(self.local[i])
+      for operand in self.operands[i]:
+        h.update(self.deep[operand] or b'')
+      self.deep[i] = h.digest()
+
+  def Position(self, id: int) -> Optional[int]:
+    return self.positions_.get(id)
+
+def TopologicalOrder(operands: List[List[int]]) -> List[int]:
+  """Returns the positions of the instructions, operands first."""
+  order = []
+  state = [0] * len(operands)  # 0: unvisited, 1: visiting, 2: done.
+  for root in range(len(operands)):
+    if state[root]:
+      continue
+    stack = [(root, 0)]
+    state[root] = 1
+    while stack:
+      i, next_operand = stack.pop()
+      if next_operand < len(operands[i]):
+        stack.append((i, next_operand + 1))
+        operand = operands[i][next_operand]
+        if not state[operand]:
+          state[operand] = 1
+          stack.append((operand, 0))
+      else:
+        state[i] = 2
+        order.append(i)
+  return order
+
+def PairInstructions(old: ComputationGraph, new: ComputationGraph) -> List[Optional[int]]:
+  """Returns, for each instruction of new, the position of the instruction of
+  old it is paired with, or None."""
+  old_instructions = old.computation.instructions
+  new_instructions = new.computation.instructions
+  old_paired = [False] * len(old_instructions)
+  partner: List[Optional[int]] = [None] * len(new_instructions)
+  def Pair(i, j):
+    old_paired[i] = True
+    partner[j] = i
+  # 1. Deep hashes.
+  by_deep = defaultdict(deque)
+  for i, deep in enumerate(old.deep):
+    by_deep[deep].append(i)
+  for j, deep in enumerate(new.deep):
+    candidates = by_deep.get(deep)
+    if candidates:
+      Pair(candidates.popleft(), j)
+  # 2. Names.
+  by_name = {instruction.name: i for i, instruction in enumerate(old_instructions) if not old_paired[i]}
+  for j, instruction in enumerate(new_instructions):
+    if partner[j] is None:
+      i = by_name.get(instruction.name)
+      if i is not None and not old_paired[i]:
+        Pair(i, j)
+  # 3. Own fingerprint, then opcode, then nothing else, with paired
+  # operands, operands first.
+  by_local = defaultdict(deque)
+  by_opcode = defaultdict(deque)
+  by_operands = defaultdict(deque)
+  for i in old.order:
+    if not old_paired[i]:
+      operands = tuple(old.operands[i])
+      by_local[old.local[i], operands].append(i)
+      by_opcode[old_instructions[i].opcode, operands].append(i)
+      by_operands[operands].append(i)
+  for j in new.order:
+    if partner[j] is not None:
+      continue
+    operands = tuple(partner[operand] for operand in new.operands[j])
+    if None in operands:
+      continue
+    for candidates in (by_local.get((new.local[j], operands)),
+                       by_opcode.get((new_instructions[j].opcode, operands)),
+                       by_operands.get(operands)):
+      while candidates and old_paired[candidates[0]]:
+        candidates.popleft()
+      if candidates:
+        Pair(candidates.popleft(), j)
+        break
+  # 4. Operands of paired instructions, users first.
+  old_root = old.Position(old.computation.root_id)
+  new_root = new.Position(new.computation.root_id)
+  if (old_root is not None and new_root is not None and partner[new_root] is None and not old_paired[old_root] and
+      old_instructions[old_root].opcode == new_instructions[new_root].opcode):
+    Pair(old_root, new_root)
+  for j in reversed(new.order):
+    i = partner[j]
+    if i is None:
+      continue
+    for old_operand, new_operand in zip(old.operands[i], new.operands[j]):
+      if (partner[new_operand] is None and not old_paired[old_operand] and
+          old_instructions[old_operand].opcode == new_instructions[new_operand].opcode):
+        Pair(old_operand, new_operand)
+  return partner
+
+def DiffComputations(old_index: HloIndex, new_index: HloIndex, old: ComputationGraph,
+                     new: ComputationGraph) -> List[InstructionDiff]:
+  partner = PairInstructions(old, new)
+  old_instructions = old.computation.instructions
+  new_instructions = new.computation.instructions
+  # Removed instructions come first, in old order, then the added and
+  # changed ones in new order.
+  diffs = []
+  paired = set(i for i in partner if i is not None)
+  for i in range(len(old_instructions)):
+    if i not in paired:
+      diffs.append(InstructionDiff('removed', old_index.entry(old_instructions[i].id), None))
+  for j in range(len(new_instructions)):
+    new_entry = new_index.entry(new_instructions[j].id)
+    i = partner[j]
+    if i is None:
+      diffs.append(InstructionDiff('added', None, new_entry))
+      continue
+    if (old.local[i] != new.local[j] or
+        [partner[operand] for operand in new.operands[j]] != old.operands[i]):
+      diffs.append(InstructionDiff('changed', old_index.entry(old_instructions[i].id), new_entry))
+  return diffs
+
+def DiffHloIndexes(old: HloIndex, new: HloIndex) -> ModuleDiff:
+  """Compares two indexed modules."""
+  old_instruction_fingerprints = {}
+  new_instruction_fingerprints = {}
+  old_fingerprints = ComputationFingerprints(old.module, old_instruction_fingerprints)
+  new_fingerprints = ComputationFingerprints(new.module, new_instruction_fingerprints)
+  old_computations = {computation.name: computation for computation in old.module.computations}
+  new_computations = {computation.name: computation for computation in new.module.computations}
+  pairs = {}  # New name -> old name.
+  # Identical computations, by fingerprint.
+  by_fingerprint = defaultdict(deque)
+  for name, fingerprint in old_fingerprints.items():
+    by_fingerprint[fingerprint].append(name)
+  for name, fingerprint in new_fingerprints.items():
+    if by_fingerprint[fingerprint]:
+      pairs[name] = by_fingerprint[fingerprint].popleft()
+  identical = len(pairs)
+  unpaired_old = {name for names in by_fingerprint.values() for name in names}
+  # Then by name.
+  for name in new_computations:
+    if name not in pairs and name in unpaired_old:
+      pairs[name] = name
+      unpaired_old.discard(name)
+  # Then by the instructions they share.
+  graphs = {}
+  def Graph(side, name):
+    key = (side, name)
+    if key not in graphs:
+      computations, fingerprints, instruction_fingerprints = (
+        (old_computations, old_fingerprints, old_instruction_fingerprints) if side == 'old'
+        else (new_computations, new_fingerprints, new_instruction_fingerprints))
+      by_id = {computation.id: fingerprints[computation.name] for computation in computations.values()}
+      graphs[key] = ComputationGraph(computations[name], by_id, instruction_fingerprints)
+    return graphs[key]
+  if unpaired_old:
+    owners = defaultdict(set)
+    for name in unpaired_old:
+      for deep in Graph('old', name).deep:
+        owners[deep].add(name)
+    for name in new_computations:
+      if name in pairs or not unpaired_old:
+        continue
+      shared = defaultdict(int)
+      for deep in Graph('new', name).deep:
+        for owner in owners.get(deep, ()):
+          if owner in unpaired_old:
+            shared[owner] += 1
+      if shared:
+        best = max(sorted(shared), key=shared.get)
+        pairs[name] = best
+        unpaired_old.discard(best)
+  diffs = []
+  paired_old = set(pairs.values())
+  for name in new_computations:
+    old_name = pairs.get(name)
+    if old_name is None:
+      diffs.append(ComputationDiff(None, name, []))
+    elif old_fingerprints[old_name] != new_fingerprints[name]:
+      instructions = DiffComputations(old, new, Graph('old', old_name), Graph('new', name))
+      diffs.append(ComputationDiff(old_name, name, instructions))
+  for name in old_computations:
+    if name not in paired_old:
+      diffs.append(ComputationDiff(name, None, []))
+  return ModuleDiff(old, new, diffs, identical)
+
+def DiffHloModules(old_text, new_text) -> ModuleDiff:
+  """Parses and compares the HLO text of two modules."""
+  return DiffHloIndexes(HloIndex(old_text), HloIndex(new_text))
+
+def FormatDiff(diff: ModuleDiff, summary: bool = False) -> str:
+  """Returns the diff as text: one section per differing computation, with
+  '-' for removed and '+' for added lines, prefixed with their line numbers.
+  A changed instruction shows its old and new lines. With summary, only the
+  counts are shown."""
+  lines = []
+  if not summary:
+    for computation in diff.computations:
+      if computation.old is None:
+        lines.append(f"+ computation %{computation.new}")
+        continue
+      if computation.new is None:
+        lines.append(f"- computation %{computation.old}")
+        continue
+      header = computation.new if computation.old == computation.new else f"{computation.old} -> {computation.new}"
+      lines.append(f"@@ computation %{header}")
+      for instruction in computation.instructions:
+        if instruction.old is not None:
+          lines.append(FormatLine('-', diff.old, instruction.old))
+        if instruction.new is not None:
+          lines.append(FormatLine('+', diff.new, instruction.new))
+  counts = {kind: len(diff.instructions(kind)) for kind in ('added', 'removed', 'changed')}
+  lines.append(f"{counts['added']} added, {counts['removed']} removed, {counts['changed']} changed instructions; "
+               f"{sum(c.old is None for c in diff.computations)} added, "
+               f"{sum(c.new is None for c in diff.computations)} removed, "
+               f"{sum(c.old is not None and c.new is not None for c in diff.computations)} changed, "
+               f"{diff.identical_computations} identical computations")
+  return '\n'.join(lines)
+
+def FormatLine(sign: str, index: HloIndex, entry: IndexEntry) -> str:
+  line, _ = index.line_and_column(entry)
+  return f"{sign}{line}: {index.line(entry).strip()}"
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(prog='xlaz-diff', description="Compare the structure of two HLO modules.")
+  parser.add_argument('old', metavar='OLD')
+  parser.add_argument('new', metavar='NEW')
+  parser.add_argument('--summary', action='store_true', help="only print the number of differences")
+  args = parser.parse_args(argv)
+  texts = []
+  for path in (args.old, args.new):
+    with open(path, 'rb') as f:
+      texts.append(f.read())
+  diff = DiffHloModules(*texts)
+  print(FormatDiff(diff, summary=args.summary))
+  return 1 if diff else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
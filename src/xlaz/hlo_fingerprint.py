@@ -0,0 +1,159 @@
+"""Canonical structural fingerprints of computations and modules.
+
+Two computations get the same fingerprint when they differ only in the
+names and ids of their instructions, their metadata (including the metadata
+of shardings) and comments or formatting. Opcodes, shapes, layouts, literals
+and every parsed attribute count, as does the graph: operands and control
+predecessors are hashed as positions in the computation instead of ids.
+Called computations are hashed as their own fingerprints rather than their
+names, so a computation's fingerprint is computed from those of its callees,
+each computed once however many instructions call it.
+
+Fingerprints are SHA-256 hex digests, stable across processes and xlaz
+versions that parse the same attributes, which makes them usable as
+deduplication and compilation cache keys. Attributes that HloParser skips
+rather than parses don't contribute.
+"""
+import hashlib
+import struct
+from array import array
+from typing import Dict, List, Optional, Set
+
+from google.protobuf.descriptor import FieldDescriptor
+
+from xlaz.hlo_parser import ParseHloModule
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+# Fields of HloInstructionProto that InstructionFingerprint leaves out: the
+# names, ids and metadata, and the references to other instructions and
+# computations, which ComputationFingerprints hashes canonically.
+kIgnoredFields = frozenset([
+  'name',
+  'id',
+  'metadata',
+  'operand_ids',
+  'control_predecessor_ids',
+  'called_computation_ids',
+])
+
+def InstructionFingerprint(instruction: hlo_pb2.HloInstructionProto) -> bytes:
+  """Returns the SHA-256 digest of the fields of instruction other than
+  kIgnoredFields."""
+  h = hashlib.sha256()
+  for field, value in instruction.ListFields():
+    if field.name in kIgnoredFields:
+      continue
+    if field.name == 'sharding':
+      value = ShardingWithoutMetadata(value)
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+      if field.label == FieldDescriptor.LABEL_REPEATED:
+        data = b''.join(Prefixed(item.SerializeToString(deterministic=True)) for item in value)
+      else:
+        data = value.SerializeToString(deterministic=True)
+    elif field.label == FieldDescriptor.LABEL_REPEATED:
+      data = repr(list(value)).encode()
+    else:
+      data = repr(value).encode()
+    h.update(struct.pack('<I', field.number))
+    h.update(Prefixed(data))
+  return h.digest()
+
+def Prefixed(data: bytes) -> bytes:
+  return struct.pack('<Q', len(data)) + data
+
+def ShardingWithoutMetadata(sharding: xd.OpSharding) -> xd.OpSharding:
+  """Returns sharding, or a copy of it without its metadata if it has any."""
+  if not HasShardingMetadata(sharding):
+    return sharding
+  copy = xd.OpSharding()
+  copy.CopyFrom(sharding)
+  ClearShardingMetadata(copy)
+  return copy
+
+def HasShardingMetadata(sharding: xd.OpSharding) -> bool:
+  return bool(sharding.metadata) or any(HasShardingMetadata(element) for element in sharding.tuple_shardings)
+
+def ClearShardingMetadata(sharding: xd.OpSharding):
+  del sharding.metadata[:]
+  for element in sharding.tuple_shardings:
+    ClearShardingMetadata(element)
+
+def ComputationFingerprint(computation: hlo_pb2.HloComputationProto,
+                           callee_fingerprints: Dict[int, str],
+                           instruction_fingerprints: Optional[Dict[int, bytes]] = None) -> str:
+  """Returns the fingerprint of computation, given the fingerprints of the
+  computations it calls by id. The InstructionFingerprint of each instruction
+  is also stored by id in instruction_fingerprints, if given."""
+  positions = {instruction.id: i for i, instruction in enumerate(computation.instructions)}
+  h = hashlib.sha256()
+  h.update(struct.pack('<Q', len(computation.instructions)))
+  for instruction in computation.instructions:
+    fingerprint = InstructionFingerprint(instruction)
+    if instruction_fingerprints is not None:
+      instruction_fingerprints[instruction.id] = fingerprint
+    h.update(fingerprint)
+    for ids in (instruction.operand_ids, instruction.control_predecessor_ids):
+      h.update(Prefixed(array('q', [positions[id] for id in ids]).tobytes()))
+    h.update(Prefixed(''.join(callee_fingerprints[id] for id in instruction.called_computation_ids).encode()))
+  h.update(struct.pack('<q', positions.get(computation.root_id, -1)))
+  return h.hexdigest()
+
+def ComputationFingerprints(module: hlo_pb2.HloModuleProto,
+                            instruction_fingerprints: Optional[Dict[int, bytes]] = None) -> Dict[str, str]:
+  """Returns the fingerprint of each computation of module by name, in
+  module order. Callees are fingerprinted before their callers. The
+  fingerprints of the instructions are stored in instruction_fingerprints,
+  if given, as by ComputationFingerprint. Raises ValueError if a computation
+  calls itself, directly or not."""
+  by_id = {computation.id: computation for computation in module.computations}
+  fingerprints: Dict[int, str] = {}
+  for computation in module.computations:
+    # Visit the callees of computation depth first, without recursion. path
+    # has the ids of the computations whose callees are being visited, each
+    # called by the one before it.
+    stack = [(computation, False)]
+    path: List[int] = []
+    on_path: Set[int] = set()
+    while stack:
+      current, callees_done = stack.pop()
+      if callees_done:
+        path.pop()
+        on_path.remove(current.id)
+        fingerprints[current.id] = ComputationFingerprint(current, fingerprints, instruction_fingerprints)
+        continue
+      if current.id in fingerprints:
+        continue
+      stack.append((current, True))
+      path.append(current.id)
+      on_path.add(current.id)
+      for instruction in current.instructions:
+        for id in instruction.called_computation_ids:
+          if id in on_path:
+            cycle = path[path.index(id):] + [id]
+            raise ValueError("computation call graph has a cycle: " + ' -> '.join(by_id[id].name for id in cycle))
+          if id not in fingerprints:
+            stack.append((by_id[id], False))
+  return {computation.name: fingerprints[computation.id] for computation in module.computations}
+
+def ModuleFingerprint(module: hlo_pb2.HloModuleProto,
+                      computation_fingerprints: Optional[Dict[str, str]] = None) -> str:
+  """Returns the fingerprint of module: that of its entry computation, which
+  covers every computation it calls, and of its entry computation layout.
+  computation_fingerprints, as returned by ComputationFingerprints, saves
+  computing them again."""
+  if computation_fingerprints is None:
+    computation_fingerprints = ComputationFingerprints(module)
+  h = hashlib.sha256()
+  h.update(computation_fingerprints[module.entry_computation_name].encode())
+  layout = module.host_program_shape
+  if layout.parameter_names:
+    layout = xd.ProgramShapeProto()
+    layout.CopyFrom(module.host_program_shape)
+    del layout.parameter_names[:]
+  h.update(layout.SerializeToString(deterministic=True))
+  return h.hexdigest()
+
+def FingerprintHloModule(text) -> str:
+  """Parses the HLO text of a module and returns its fingerprint."""
+  return ModuleFingerprint(ParseHloModule(text))
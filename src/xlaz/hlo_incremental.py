@@ -0,0 +1,460 @@
+"""Keeps the tokens of an HLO buffer up to date as it is edited.
+
+IncrementalLexer holds UTF-8 text and its tokens, as tokenize would produce
+them, and applies edits given as (offset, deleted length, inserted text).
+Only the tokens around an edit are lexed again: lexing restarts after the
+last token before the edit whose lexing can't have looked at the edited text,
+and stops as soon as a new token starts where an old token after the edit
+started, since from a token start onwards the lexer only depends on the text
+that follows. Strings and /* */ comments that an edit opens or closes are
+lexed until the token streams agree again, however far that is.
+
+The text is kept in blocks of about kBlockSize bytes, and each token in the
+block its start is in. A block stores the offsets of its tokens relative to
+a single delta of its own, and the sizes of the blocks and their numbers of
+tokens are summed in Fenwick trees, so an edit shifts every later token by
+changing one block size, and finding the block of an offset or a token takes
+time logarithmic in the number of blocks. Only the tokens after the edit in
+its own block are shifted one by one. The cost of an edit is proportional to
+the text lexed again plus the size of a block, wherever the edit is and
+however large the buffer is. Offsets are in bytes of the UTF-8 text.
+"""
+import re
+from array import array
+from bisect import bisect_left
+from typing import Iterator, List, NamedTuple, Union
+
+from xlaz.hlo_lexer import HloLexer, TokenTable, TokKind, kSingleCharTokens, kTokKindCodes, kTokKinds, tokenize
+from xlaz.hlo_stream import kSeparators
+
+# Bytes of text in a new block. A block is split when an edit makes it more
+# than twice as large.
+kBlockSize = 1 << 12
+
+# Bytes lexed at a time when re-lexing. The window doubles when a token
+# doesn't fit.
+kWindowSize = 1 << 10
+
+kSeparatorBytes = tuple(c.encode() for c in kSeparators)
+
+# Tokens whose kind was decided without looking at the text after them.
+kSingleCharCodes = frozenset(kTokKindCodes[kind] for kind in kSingleCharTokens.values())
+
+kErrorCode = kTokKindCodes[TokKind.kError]
+kErrorCodePattern = re.compile(re.escape(bytes([kErrorCode])))
+
+# The text that a kError token starting an unterminated string or comment
+# starts with.
+kUnterminatedStarts = (b'"', b'/*', b'//')
+
+class PrefixSums:
+  """A list of counts, kept in a Fenwick tree so that a count can be changed,
+  and the sum of the first j counts found, in time logarithmic in their
+  number."""
+  def __init__(self, counts):
+    self.tree_ = tree = list(counts)
+    self.total = sum(tree)
+    for i in range(1, len(tree) + 1):
+      parent = i + (i & -i)
+      if parent <= len(tree):
+        tree[parent - 1] += tree[i - 1]
+    # The largest power of two that is at most the number of counts.
+    self.step_ = 1 << len(tree).bit_length() >> 1
+
+  def Counts(self) -> List[int]:
+    """Returns the counts."""
+    counts = list(self.tree_)
+    for i in range(len(counts), 0, -1):
+      parent = i + (i & -i)
+      if parent <= len(counts):
+        counts[parent - 1] -= counts[i - 1]
+    return counts
+
+  def Add(self, j: int, delta: int):
+    """Adds delta to count j."""
+    tree = self.tree_
+    self.total += delta
+    i = j + 1
+    while i <= len(tree):
+      tree[i - 1] += delta
+      i += i & -i
+
+  def Sum(self, j: int) -> int:
+    """Returns the sum of the first j counts."""
+    tree = self.tree_
+    total = 0
+    while j > 0:
+      total += tree[j - 1]
+      j &= j - 1
+    return total
+
+  def Find(self, value: int) -> (int, int):
+    """Returns the largest j such that the first j counts sum to at most
+    value, and value minus their sum. Count j, if there is one, is then
+    larger than what is left of value."""
+    tree = self.tree_
+    n = len(tree)
+    j = 0
+    step = self.step_
+    while step:
+      if j + step <= n and tree[j + step - 1] <= value:
+        j += step
+        value -= tree[j - 1]
+      step >>= 1
+    return j, value
+
+class TokenEdit(NamedTuple):
+  """The tokens replaced by an edit: removed tokens starting at index were
+  replaced by inserted new ones."""
+  index: int
+  removed: int
+  inserted: int
+
+class IncrementalLexer:
+  def __init__(self, text: Union[str, bytes]):
+    if isinstance(text, str):
+      text = text.encode()
+    text = bytes(text)
+    table = tokenize(text)
+    # The text of each block, the tokens that start in it and the offset the
+    # block started at when it was made, which its token offsets are relative
+    # to.
+    self.texts_ = []
+    self.kinds_, self.starts_, self.ends_ = [], [], []
+    self.origins_ = []
+    lo = 0
+    for origin in range(0, max(len(text), 1), kBlockSize):
+      hi = bisect_left(table.starts, origin + kBlockSize)
+      self.texts_.append(bytearray(text[origin:origin + kBlockSize]))
+      self.kinds_.append(table.kinds[lo:hi])
+      self.starts_.append(table.starts[lo:hi])
+      self.ends_.append(table.ends[lo:hi])
+      self.origins_.append(origin)
+      lo = hi
+    # The sizes of the blocks, their numbers of tokens and of unterminated
+    # strings and comments.
+    self.sizes_ = PrefixSums(len(text) for text in self.texts_)
+    self.counts_ = PrefixSums(len(kinds) for kinds in self.kinds_)
+    self.unterminated_ = PrefixSums(self.Unterminated(j) for j in range(len(self.texts_)))
+
+  def __len__(self):
+    """Returns the number of tokens."""
+    return self.counts_.total
+
+  @property
+  def size(self) -> int:
+    """The length of the text in bytes."""
+    return self.sizes_.total
+
+  @property
+  def text(self) -> bytes:
+    return b''.join(self.texts_)
+
+  def kind(self, i) -> TokKind:
+    j, k = self.Token(i)
+    return kTokKinds[self.kinds_[j][k]]
+
+  def span(self, i) -> (int, int):
+    """Returns the start and end offsets of token i."""
+    j, k = self.Token(i)
+    shift = self.Shift(j)
+    return self.starts_[j][k] + shift, self.ends_[j][k] + shift
+
+  def token_text(self, i) -> str:
+    return self.Slice(*self.span(i)).decode()
+
+  def value(self, i):
+    """Returns the value of token i, as TokenTable.value would. The token is
+    lexed again on its own, which only gives its value if that yields a token
+    of the same kind spanning the same text: a token whose kind depended on
+    the text after it, such as the kError of 'nan(', has no value."""
+    text = self.Slice(*self.span(i))
+    lexer = HloLexer(text)
+    kind = lexer.Lex()
+    if kind != self.kind(i) or lexer.current_ptr_.offset_ != len(text):
+      return None
+    state = lexer.token_state_
+    if kind == TokKind.kInt:
+      return state.int64_val
+    if kind == TokKind.kDecimal:
+      return state.decimal_val
+    if kind == TokKind.kPrimitiveType:
+      return state.primitive_type_val
+    if kind in TokenTable.str_kinds:
+      return str(state.str_val)
+    return None
+
+  def Token(self, i) -> (int, int):
+    """Returns the block of token i and the index of the token in it."""
+    count = len(self)
+    if i < 0:
+      i += count
+    if not 0 <= i < count:
+      raise IndexError(f"token {i} is out of range for {count} tokens")
+    return self.counts_.Find(i)
+
+  def Shift(self, j: int) -> int:
+    """Returns what to add to the token offsets of block j."""
+    return self.sizes_.Sum(j) - self.origins_[j]
+
+  def Locate(self, offset: int) -> (int, int):
+    """Returns the block that offset is in and the offset in the block. The
+    end of the text is at the end of the last block."""
+    j, offset = self.sizes_.Find(offset)
+    if j == len(self.texts_):
+      j -= 1
+      offset += len(self.texts_[j])
+    return j, offset
+
+  def Slice(self, start: int, end: int) -> bytes:
+    """Returns the text from start to end."""
+    end = min(end, self.size)
+    j, offset = self.Locate(start)
+    pieces = []
+    while start < end:
+      piece = self.texts_[j][offset:offset + end - start]
+      pieces.append(piece)
+      start += len(piece)
+      j += 1
+      offset = 0
+    return b''.join(pieces)
+
+  def StartsFrom(self, index: int) -> Iterator[int]:
+    """Yields the start offsets of the tokens from token index on."""
+    if index >= len(self):
+      return
+    j, k = self.counts_.Find(index)
+    for j in range(j, len(self.starts_)):
+      shift = self.Shift(j)
+      for start in self.starts_[j][k:]:
+        yield start + shift
+      k = 0
+
+  def TokensEndingBefore(self, offset: int) -> int:
+    """Returns the number of tokens that end before offset."""
+    j, rel = self.Locate(offset)
+    first = self.counts_.Sum(j)
+    count = first + bisect_left(self.ends_[j], rel + self.origins_[j])
+    # Of the tokens in earlier blocks, only the last can end after offset.
+    if count == first and count > 0 and self.span(count - 1)[1] >= offset:
+      count -= 1
+    return count
+
+  def TokensStartingBefore(self, offset: int) -> int:
+    """Returns the number of tokens that start before offset."""
+    j, rel = self.Locate(offset)
+    return self.counts_.Sum(j) + bisect_left(self.starts_[j], rel + self.origins_[j])
+
+  def IsStable(self, i) -> bool:
+    """Returns whether token i stays the same whatever the text after it is.
+    The lexer can only have looked past the end of a token other than a
+    single character if no whitespace or comment follows it. The empty kError
+    token that stops lexing at a '\\0' is never stable."""
+    start, end = self.span(i)
+    if start == end:
+      return False
+    j, k = self.Token(i)
+    if self.kinds_[j][k] in kSingleCharCodes or i + 1 == len(self):
+      return True
+    return end < self.span(i + 1)[0]
+
+  def UnterminatedTokens(self, j: int, lo: int = 0, hi: int = None) -> Iterator[int]:
+    """Yields the indices in block j, from lo to hi, of the kError tokens that
+    start a string or a comment. Such a token is an unterminated string or
+    comment, which the lexer looked for the end of up to the end of the text
+    (or the line). The text that tells them apart is part of the token, or
+    just after it, so it can't change without lexing the token again."""
+    kinds = self.kinds_[j][lo:hi]
+    if kErrorCode not in kinds:
+      return
+    shift = self.Shift(j)
+    for match in kErrorCodePattern.finditer(kinds.tobytes()):
+      k = lo + match.start()
+      start = self.starts_[j][k] + shift
+      if self.Slice(start, start + 2).startswith(kUnterminatedStarts):
+        yield k
+
+  def Unterminated(self, j: int, lo: int = 0, hi: int = None) -> int:
+    """Returns the number of unterminated strings and comments in block j
+    from lo to hi."""
+    return sum(1 for _ in self.UnterminatedTokens(j, lo, hi))
+
+  def FirstUnterminated(self, index: int) -> int:
+    """Returns the index of the first unterminated string or comment before
+    token index, or index if there is none."""
+    if not self.unterminated_.total:
+      return index
+    j, _ = self.unterminated_.Find(0)
+    first = self.counts_.Sum(j)
+    return min(first + next(self.UnterminatedTokens(j)), index)
+
+  def StableIndex(self, index: int) -> int:
+    """Returns the number of tokens before token index that can't change when
+    the text after token index changes."""
+    while True:
+      while index > 0 and not self.IsStable(index - 1):
+        index -= 1
+      first = self.FirstUnterminated(index)
+      if first == index:
+        return index
+      index = first
+
+  def RemoveTokens(self, index: int, count: int):
+    """Removes count tokens from token index on."""
+    while count > 0:
+      j, k = self.counts_.Find(index)
+      n = min(count, len(self.kinds_[j]) - k)
+      unterminated = self.Unterminated(j, k, k + n)
+      del self.kinds_[j][k:k + n], self.starts_[j][k:k + n], self.ends_[j][k:k + n]
+      self.counts_.Add(j, -n)
+      if unterminated:
+        self.unterminated_.Add(j, -unterminated)
+      count -= n
+
+  def InsertTokens(self, index: int, kinds: array, starts: array, ends: array):
+    """Inserts tokens with the given kinds and offsets before token index.
+    They must start after the tokens before token index, and before the
+    others."""
+    i = 0
+    while i < len(kinds):
+      j, rel = self.Locate(starts[i])
+      n = bisect_left(starts, starts[i] - rel + len(self.texts_[j]), i)
+      shift = self.Shift(j)
+      k = bisect_left(self.starts_[j], starts[i] - shift)
+      self.kinds_[j][k:k] = kinds[i:n]
+      self.starts_[j][k:k] = array('q', [start - shift for start in starts[i:n]])
+      self.ends_[j][k:k] = array('q', [end - shift for end in ends[i:n]])
+      self.counts_.Add(j, n - i)
+      unterminated = self.Unterminated(j, k, k + n - i)
+      if unterminated:
+        self.unterminated_.Add(j, unterminated)
+      i = n
+
+  def ReplaceText(self, offset: int, deleted: int, inserted: bytes):
+    """Replaces deleted bytes at offset with inserted. No token may start in
+    the deleted bytes, or end at or after offset and start before it."""
+    j, rel = self.Locate(offset)
+    last, rel_end = self.Locate(offset + deleted)
+    # The tokens after the edit, which move to block j if the edit spans
+    # several blocks.
+    k = bisect_left(self.starts_[last], rel_end + self.origins_[last])
+    unterminated = self.Unterminated(last, k) if last != j else 0
+    moved = self.Shift(last) - self.Shift(j) + len(inserted) - deleted
+    kinds, starts, ends = self.kinds_[last][k:], self.starts_[last][k:], self.ends_[last][k:]
+    if moved:
+      starts = array('q', [start + moved for start in starts])
+      ends = array('q', [end + moved for end in ends])
+    del self.kinds_[last][k:], self.starts_[last][k:], self.ends_[last][k:]
+    self.kinds_[j] += kinds
+    self.starts_[j] += starts
+    self.ends_[j] += ends
+    if last != j:
+      self.counts_.Add(last, -len(kinds))
+      self.counts_.Add(j, len(kinds))
+      if unterminated:
+        self.unterminated_.Add(last, -unterminated)
+        self.unterminated_.Add(j, unterminated)
+    # The blocks in between are left empty.
+    text = self.texts_[j]
+    tail = self.texts_[last][rel_end:]
+    self.sizes_.Add(j, rel + len(inserted) + len(tail) - len(text))
+    del text[rel:]
+    text += inserted
+    text += tail
+    for m in range(j + 1, last + 1):
+      self.sizes_.Add(m, -len(self.texts_[m]))
+      del self.texts_[m][:]
+    if len(text) > 2 * kBlockSize:
+      self.SplitBlock(j)
+
+  def SplitBlock(self, j: int):
+    """Splits block j into blocks of kBlockSize bytes."""
+    text, kinds, starts, ends = self.texts_[j], self.kinds_[j], self.starts_[j], self.ends_[j]
+    origin = self.origins_[j]
+    pieces = range(0, len(text), kBlockSize)
+    bounds = [bisect_left(starts, origin + lo) for lo in pieces] + [len(starts)]
+    unterminated = self.unterminated_.Counts()
+    self.texts_[j:j + 1] = [text[lo:lo + kBlockSize] for lo in pieces]
+    self.kinds_[j:j + 1] = [kinds[lo:hi] for lo, hi in zip(bounds, bounds[1:])]
+    self.starts_[j:j + 1] = [starts[lo:hi] for lo, hi in zip(bounds, bounds[1:])]
+    self.ends_[j:j + 1] = [ends[lo:hi] for lo, hi in zip(bounds, bounds[1:])]
+    # The offsets stay as they are, relative to the origin of each piece.
+    self.origins_[j:j + 1] = [origin + lo for lo in pieces]
+    self.sizes_ = PrefixSums(len(text) for text in self.texts_)
+    self.counts_ = PrefixSums(len(kinds) for kinds in self.kinds_)
+    unterminated[j:j + 1] = [self.Unterminated(m) for m in range(j, j + len(pieces))]
+    self.unterminated_ = PrefixSums(unterminated)
+
+  def edit(self, offset: int, deleted: int, inserted: Union[str, bytes] = b'') -> TokenEdit:
+    """Replaces deleted bytes at offset with inserted, and lexes the affected
+    tokens again."""
+    if isinstance(inserted, str):
+      inserted = inserted.encode()
+    if not 0 <= offset <= offset + deleted <= self.size:
+      raise IndexError(f"edit of {deleted} bytes at {offset} is out of range for {self.size} bytes")
+    index = self.StableIndex(self.TokensEndingBefore(offset))
+    restart = self.span(index - 1)[1] if index > 0 else 0
+    # Drop the old tokens that start before the end of the edit.
+    removed = self.TokensStartingBefore(offset + deleted) - index
+    self.RemoveTokens(index, removed)
+    self.ReplaceText(offset, deleted, inserted)
+    more_removed, kinds, starts, ends = self.Relex(index, restart, offset + len(inserted))
+    self.RemoveTokens(index, more_removed)
+    self.InsertTokens(index, kinds, starts, ends)
+    return TokenEdit(index, removed + more_removed, len(kinds))
+
+  def Relex(self, index: int, start: int, edit_end: int) -> (int, array, array, array):
+    """Lexes from start, which is after the end of token index - 1, until a
+    new token starts at or after edit_end where an old token from token index
+    on starts. Returns the number of old tokens from token index on that the
+    new tokens replace, and the kinds and offsets of the new tokens."""
+    kinds, starts, ends = array('b'), array('q'), array('q')
+    old = self.StartsFrom(index)
+    old_start = next(old, None)
+    size = self.size
+    removed = 0
+    window_size = kWindowSize
+    while True:
+      end = min(start + window_size, size)
+      final = end == size
+      window = self.Slice(start, end)
+      if not final:
+        # Only lex up to a separator, so that no token is cut short.
+        cut = max(window.rfind(c) for c in kSeparatorBytes) + 1
+        if cut <= 0:
+          window_size *= 2
+          continue
+        window = window[:cut]
+      lexer = HloLexer(window)
+      resume = None
+      while True:
+        kind = lexer.Lex()
+        token_start = start + lexer.token_state_.token_start.offset_
+        token_end = start + lexer.current_ptr_.offset_
+        if kind == TokKind.kEof:
+          break
+        if kind == TokKind.kError and not final and (
+            window.startswith(b'"', token_start - start) or window.startswith(b'/*', token_start - start)):
+          # A string or comment that continues past the window.
+          break
+        while old_start is not None and old_start <= token_start:
+          if old_start == token_start and token_start >= edit_end:
+            # The rest of the tokens are the same as before.
+            return removed, kinds, starts, ends
+          old_start = next(old, None)
+          removed += 1
+        kinds.append(kTokKindCodes[kind])
+        starts.append(token_start)
+        ends.append(token_end)
+        resume = token_end
+        if kind == TokKind.kError and token_end == token_start:
+          # The lexer can't make progress past this character.
+          final = True
+          break
+      if final:
+        return len(self) - index, kinds, starts, ends
+      if resume is None:
+        window_size *= 2
+      else:
+        start = resume
+        window_size = kWindowSize
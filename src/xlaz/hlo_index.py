@@ -0,0 +1,196 @@
+"""An inverted index over the instructions of a parsed module.
+
+HloIndex parses a module once and records, for every instruction, its id,
+name, computation, opcode and the offset in the text where it starts. It
+maps opcodes, instruction names, metadata op_names and primitive types to
+the instructions that have them, and each instruction to the operands that
+use it, with the offset of each use. Queries are dict lookups, so they take
+microseconds however large the module is, and their results point back into
+the text through line_and_column and line, which use the lexer's index of
+line starts.
+
+  index = HloIndex(text)
+  for entry in index.opcode('all-reduce'):
+    print(index.line_and_column(entry), entry.name)
+  users = index.uses('param0', computation='main')
+"""
+import re
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Pattern, Union
+
+from xlaz import primitive_util
+from xlaz.hlo_lexer import HloLexer
+from xlaz.hlo_parser import HloParser
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+class IndexEntry(NamedTuple):
+  id: int
+  name: str
+  computation: str
+  opcode: str
+  offset: int  # Where the instruction starts in the text.
+
+class Use(NamedTuple):
+  user: IndexEntry
+  offset: int  # Where the operand is named in the text of the user.
+
+def ShapeBytes(shape: xd.ShapeProto) -> int:
+  """Returns the bytes of the arrays of shape, ignoring layout padding."""
+  if shape.element_type == primitive_util.TUPLE:
+    return sum(ShapeBytes(element) for element in shape.tuple_shapes)
+  count = 1
+  for dimension in shape.dimensions:
+    count *= dimension
+  return count * primitive_util.kByteWidths.get(shape.element_type, 0)
+
+class HloIndex:
+  def __init__(self, text):
+    """Parses text, the HLO text of a module as a str or any buffer HloLexer
+    accepts, and indexes it. The parsed module is kept as module."""
+    self.entries_: List[IndexEntry] = []
+    # Instruction id -> position in entries_.
+    self.positions_: Dict[int, int] = {}
+    self.by_opcode_ = defaultdict(list)
+    self.by_name_ = defaultdict(list)
+    self.by_op_name_ = defaultdict(list)
+    self.by_type_ = defaultdict(list)
+    self.uses_ = defaultdict(list)
+    self.bytes_: List[int] = []
+    # Positions sorted by bytes, and their bytes, built on first use.
+    self.by_bytes_ = None
+    self.sorted_bytes_ = None
+    # The distinct op_names, the text of all of them, one per line, and the
+    # offset of each line, built on first use.
+    self.op_names_ = None
+    self.op_names_text_ = None
+    self.op_name_starts_ = None
+    self.module: hlo_pb2.HloModuleProto = HloParser(text, index=self).Run()
+    # Only used for its index of line starts.
+    self.lexer_ = HloLexer(text)
+
+  def AddInstruction(self, computation: hlo_pb2.HloComputationProto,
+                     instruction: hlo_pb2.HloInstructionProto, offset: int):
+    """Called by HloParser for each instruction, in module order."""
+    position = len(self.entries_)
+    self.entries_.append(IndexEntry(instruction.id, instruction.name, computation.name, instruction.opcode, offset))
+    self.positions_[instruction.id] = position
+    self.by_opcode_[instruction.opcode].append(position)
+    self.by_name_[instruction.name].append(position)
+    if instruction.metadata.op_name:
+      self.by_op_name_[instruction.metadata.op_name].append(position)
+    self.by_type_[instruction.shape.element_type].append(position)
+    self.bytes_.append(ShapeBytes(instruction.shape))
+
+  def AddUse(self, operand_id: int, user_id: int, offset: int):
+    """Called by HloParser for each operand, once the computation of both
+    instructions has been parsed."""
+    self.uses_[operand_id].append((user_id, offset))
+
+  def __len__(self):
+    return len(self.entries_)
+
+  def Entries(self, positions) -> List[IndexEntry]:
+    entries = self.entries_
+    return [entries[position] for position in positions]
+
+  def entry(self, id: int) -> IndexEntry:
+    """Returns the entry of the instruction with the given id."""
+    return self.entries_[self.positions_[id]]
+
+  def instruction(self, entry: IndexEntry) -> hlo_pb2.HloInstructionProto:
+    """Returns the parsed instruction of entry."""
+    computation = self.module.computations[entry.id >> 32]
+    return computation.instructions[entry.id & 0xffffffff]
+
+  def opcode(self, opcode: str) -> List[IndexEntry]:
+    return self.Entries(self.by_opcode_.get(opcode, ()))
+
+  def name(self, name: str, computation: Optional[str] = None) -> List[IndexEntry]:
+    """Returns the instructions called name, in any computation unless one is
+    given. The name is given without its '%'."""
+    entries = self.Entries(self.by_name_.get(name, ()))
+    if computation is not None:
+      entries = [entry for entry in entries if entry.computation == computation]
+    return entries
+
+  def op_name(self, op_name: Union[str, Pattern]) -> List[IndexEntry]:
+    """Returns the instructions whose metadata op_name is op_name, or, if
+    op_name is a compiled pattern, contains a match of it. '^' and '$' match
+    at the start and end of each op_name."""
+    if isinstance(op_name, str):
+      return self.Entries(self.by_op_name_.get(op_name, ()))
+    if self.op_names_ is None:
+      self.op_names_ = list(self.by_op_name_)
+      self.op_name_starts_ = [0]
+      for key in self.op_names_:
+        self.op_name_starts_.append(self.op_name_starts_[-1] + len(key) + 1)
+      self.op_names_text_ = '\n'.join(self.op_names_)
+    # Search all op_names at once, and check each op_name a match starts in
+    # on its own, since a match may run into the next line.
+    keys = self.op_names_
+    starts = self.op_name_starts_
+    pattern = re.compile(op_name.pattern, op_name.flags | re.MULTILINE)
+    positions = []
+    pos = 0
+    while True:
+      match = pattern.search(self.op_names_text_, pos)
+      if match is None:
+        break
+      i = bisect_right(starts, match.start()) - 1
+      if pattern.search(keys[i]):
+        positions.extend(self.by_op_name_[keys[i]])
+      pos = starts[i + 1]
+    return self.Entries(sorted(positions))
+
+  def primitive_type(self, element_type: Union[int, str]) -> List[IndexEntry]:
+    """Returns the instructions whose shape has element_type, a
+    PrimitiveType or its name in HLO text, like 'f32' or 'tuple'."""
+    if isinstance(element_type, str):
+      element_type = primitive_util.TUPLE if element_type == 'tuple' else primitive_util.StringToPrimitiveType(element_type)
+    return self.Entries(self.by_type_.get(element_type, ()))
+
+  def larger_than(self, size: int) -> List[IndexEntry]:
+    """Returns the instructions whose shape holds more than size bytes,
+    largest first."""
+    if self.by_bytes_ is None:
+      self.by_bytes_ = sorted(range(len(self.bytes_)), key=self.bytes_.__getitem__)
+      self.sorted_bytes_ = [self.bytes_[position] for position in self.by_bytes_]
+    start = bisect_right(self.sorted_bytes_, size)
+    return self.Entries(reversed(self.by_bytes_[start:]))
+
+  def bytes(self, entry: IndexEntry) -> int:
+    return self.bytes_[self.positions_[entry.id]]
+
+  def uses(self, operand: Union[IndexEntry, int, str], computation: Optional[str] = None) -> List[Use]:
+    """Returns the uses of operand, an entry, an instruction id or a name,
+    as operands of other instructions, in module order. A name used in
+    several computations is looked up in all of them unless computation is
+    given."""
+    if isinstance(operand, IndexEntry):
+      ids = [operand.id]
+    elif isinstance(operand, int):
+      ids = [operand]
+    else:
+      ids = [entry.id for entry in self.name(operand, computation)]
+    uses = []
+    for id in ids:
+      uses.extend(Use(self.entry(user_id), offset) for user_id, offset in self.uses_.get(id, ()))
+    return uses
+
+  def line_and_column(self, target: Union[IndexEntry, Use, int]) -> (int, int):
+    """Returns the line and column where an entry or use, or an offset, is
+    in the text."""
+    return self.lexer_.GetLineAndColumn(self.lexer_.buf_ + self.Offset(target))
+
+  def line(self, target: Union[IndexEntry, Use, int]) -> str:
+    """Returns the line of the text where an entry or use, or an offset, is."""
+    return str(self.lexer_.GetLine(self.lexer_.buf_ + self.Offset(target)))
+
+  def Offset(self, target: Union[IndexEntry, Use, int]) -> int:
+    return target if isinstance(target, int) else target.offset
+
+def BuildHloIndex(text) -> HloIndex:
+  """Parses and indexes the HLO text of a module."""
+  return HloIndex(text)
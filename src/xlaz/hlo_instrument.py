@@ -0,0 +1,180 @@
+"""Opt-in instrumentation of HloLexer, for finding out why an input lexes
+slowly.
+
+Pass a LexerStats as the stats argument of HloLexer, HloParser,
+ParseHloModule or tokenize, and it records:
+
+  - the number of tokens of each TokKind, the bytes they span and the time
+    spent lexing them, plus the bytes of whitespace and comments between
+    them;
+  - the calls to, and the time spent in, LexToken, each Lex* method and
+    LookAhead/PeekAhead;
+  - the match attempts and misses of each pattern of HloLexer.
+
+Instrumentation is attached to a single lexer by shadowing its methods and
+patterns with counting wrappers on the instance, so lexers without stats run
+exactly the code they would otherwise. Times are inclusive: LexMinus
+includes the LexNumberOrPattern call it makes. Every path through LexToken
+is covered by the time of each kind, including the fallback of the regex
+engine to LexTokenByHand; the numbers, names and strings that the regex
+engine finishes without calling a Lex* method are only in those times and
+LexToken's. The data is available as a
+dict from report(), as a table from format(), or token by token through a
+callback.
+"""
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Optional
+
+from xlaz.hlo_lexer import HloLexer, TokKind
+
+# The methods of HloLexer that are timed, besides LexToken. Lex* handlers
+# called through the dispatch table are timed there too.
+kTimedMethods = (
+  'LexTokenByHand',
+  'LexNumberOrPattern',
+  'LexIdentifier',
+  'LexIdentifierMatch',
+  'LexPercent',
+  'LexString',
+  'LexComment',
+  'LexMinus',
+  'LexLeq',
+  'LexDots',
+  'LexNanPayload',
+  'LookAhead',
+  'PeekAhead',
+)
+
+class _CountedPattern:
+  """Stands in for a compiled pattern, counting calls to match()."""
+  __slots__ = ('pattern_', 'name_', 'stats_')
+  def __init__(self, pattern, name: str, stats: 'LexerStats'):
+    self.pattern_ = pattern
+    self.name_ = name
+    self.stats_ = stats
+  def match(self, *args):
+    match = self.pattern_.match(*args)
+    self.stats_.pattern_attempts[self.name_] += 1
+    if match is None:
+      self.stats_.pattern_misses[self.name_] += 1
+    return match
+  def __getattr__(self, name):
+    return getattr(self.pattern_, name)
+
+class LexerStats:
+  """Counters shared by every lexer it is attached to.
+
+  callback, if given, is called as callback(kind, start, end) with the offsets
+  of each token as it is lexed, including tokens lexed by PeekAhead before
+  Lex() reaches them."""
+  def __init__(self, callback: Optional[Callable[[TokKind, int, int], None]] = None):
+    self.callback = callback
+    self.token_counts = Counter()  # TokKind -> tokens.
+    self.token_bytes = Counter()  # TokKind -> characters, or bytes for byte buffers.
+    self.token_seconds = defaultdict(float)  # TokKind -> seconds in LexToken.
+    self.trivia_bytes = 0
+    self.method_calls = Counter()
+    self.method_seconds = defaultdict(float)
+    self.pattern_attempts = Counter()
+    self.pattern_misses = Counter()
+    # id(lexer) -> the instance attributes replaced by attach().
+    self.attached_ = {}
+
+  def attach(self, lexer: HloLexer):
+    """Instruments lexer. HloLexer(stats=...) calls this before lexing."""
+    if id(lexer) in self.attached_:
+      return
+    saved = {}
+    def shadow(name, value):
+      saved[name] = lexer.__dict__.get(name, _kMissing)
+      setattr(lexer, name, value)
+    for name, value in vars(HloLexer).items():
+      if isinstance(value, re.Pattern):
+        shadow(name, _CountedPattern(getattr(lexer, name), name, self))
+    shadow('LexToken', self.CountedLexToken(lexer, lexer.LexToken))
+    timed = {name: self.Timed(name, getattr(HloLexer, name)) for name in kTimedMethods}
+    for name, function in timed.items():
+      shadow(name, function.__get__(lexer))
+    # The dispatch table holds plain functions, called with the lexer.
+    shadow('dispatch_table', {c: timed.get(handler.__name__, handler)
+                              for c, handler in HloLexer.dispatch_table.items()})
+    self.attached_[id(lexer)] = (lexer, saved)
+
+  def detach(self, lexer: HloLexer):
+    """Removes the instrumentation from lexer. Counters are kept."""
+    lexer, saved = self.attached_.pop(id(lexer))
+    for name, value in saved.items():
+      if value is _kMissing:
+        delattr(lexer, name)
+      else:
+        setattr(lexer, name, value)
+
+  def Timed(self, name: str, function):
+    calls = self.method_calls
+    seconds = self.method_seconds
+    perf_counter = time.perf_counter
+    def timed(*args):
+      start = perf_counter()
+      try:
+        return function(*args)
+      finally:
+        seconds[name] += perf_counter() - start
+        calls[name] += 1
+    timed.__name__ = name
+    return timed
+
+  def CountedLexToken(self, lexer: HloLexer, lex_token):
+    """Wraps lex_token, the LexToken method of lexer, to time it and count
+    the tokens it returns."""
+    lex_token = self.Timed('LexToken', lex_token)
+    perf_counter = time.perf_counter
+    def LexToken() -> TokKind:
+      before = lexer.current_ptr_.offset_
+      started = perf_counter()
+      kind = lex_token()
+      self.token_seconds[kind] += perf_counter() - started
+      start = lexer.token_state_.token_start.offset_
+      end = lexer.current_ptr_.offset_
+      self.token_counts[kind] += 1
+      self.token_bytes[kind] += end - start
+      self.trivia_bytes += start - before
+      if self.callback is not None:
+        self.callback(kind, start, end)
+      return kind
+    return LexToken
+
+  def report(self) -> dict:
+    """Returns the counters as a dict of plain values, ready for json.dump."""
+    return {
+      'tokens': {kind.name: count for kind, count in self.token_counts.most_common()},
+      'token_bytes': {kind.name: count for kind, count in self.token_bytes.most_common()},
+      'token_seconds': {kind.name: self.token_seconds[kind] for kind, _ in self.token_counts.most_common()},
+      'trivia_bytes': self.trivia_bytes,
+      'methods': {name: {'calls': self.method_calls[name], 'seconds': self.method_seconds[name]}
+                  for name in sorted(self.method_calls, key=self.method_seconds.get, reverse=True)},
+      'patterns': {name: {'attempts': attempts, 'misses': self.pattern_misses[name]}
+                   for name, attempts in self.pattern_attempts.most_common()},
+    }
+
+  def format(self) -> str:
+    """Returns the report as human-readable tables."""
+    report = self.report()
+    lines = [f"{'kind':<30} {'tokens':>10} {'bytes':>12} {'seconds':>12}"]
+    for kind, count in report['tokens'].items():
+      lines.append(f"{kind:<30} {count:>10} {report['token_bytes'].get(kind, 0):>12} "
+                   f"{report['token_seconds'].get(kind, 0):>12.6f}")
+    lines.append(f"{'(trivia)':<30} {'':>10} {report['trivia_bytes']:>12}")
+    lines.append('')
+    lines.append(f"{'method':<30} {'calls':>10} {'seconds':>12} {'us/call':>9}")
+    for name, method in report['methods'].items():
+      lines.append(f"{name:<30} {method['calls']:>10} {method['seconds']:>12.6f} "
+                   f"{method['seconds'] / method['calls'] * 1e6:>9.2f}")
+    lines.append('')
+    lines.append(f"{'pattern':<30} {'attempts':>10} {'misses':>12}")
+    for name, pattern in report['patterns'].items():
+      lines.append(f"{name:<30} {pattern['attempts']:>10} {pattern['misses']:>12}")
+    return '\n'.join(lines)
+
+_kMissing = object()
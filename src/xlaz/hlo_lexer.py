@@ -1,18 +1,29 @@
+import mmap
 import re
+import struct
 import sys
+from array import array
+from collections import deque
+from bisect import bisect_left, bisect_right
 from copy import copy, deepcopy
 from dataclasses import dataclass
 from enum import auto, Enum
 from functools import lru_cache
+from types import MappingProxyType
 from typing import Union
 
 from xlaz import primitive_util
-from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
 
 @lru_cache
 def LazyRE2(pattern):
   return re.compile(pattern)
 
+@lru_cache
+def BytesRE2(pattern: re.Pattern) -> re.Pattern:
+  """Returns the bytes version of a str pattern. Every lexer pattern is ASCII,
+  so \\w and \\d only match ASCII characters in bytes."""
+  return re.compile(pattern.pattern.encode('ascii'), pattern.flags & ~re.UNICODE)
+
 kEOF = -1
 kError = -2
 
@@ -60,59 +71,72 @@ class TokKind(Enum):
   kInt             = auto() # 42
   kDecimal         = auto() # 4.2
 
+# Stable integer codes for each TokKind, used by columnar token tables.
+kTokKinds = tuple(TokKind)
+kTokKindCodes = {kind: code for code, kind in enumerate(kTokKinds)}
+
 class BufferPointer:
-  def __init__(self, buf=None, offset=0, length=None):
+  """A position in a shared buffer, analogous to a `const char*` into the HLO
+  text. Pointers into the same buffer compare by offset; the buffer itself is
+  only ever compared by identity, so every operation other than reading the
+  pointed-to text is O(1)."""
+  __slots__ = ('buf_', 'offset_', 'end_')
+  def __init__(self, buf=None, offset=0, end=None):
     if offset < 0:
       raise ValueError('offset < 0')
-    self.buf_ = getattr(buf, 'buf_', buf) if buf is not None else []
+    self.buf_ = getattr(buf, 'buf_', buf)
     self.offset_ = offset
-    self.length_ = length
+    self.end_ = len(self.buf_) if end is None else end
   def __int__(self):
     return self.offset_
-  def __new__(cls, buf=None, offset=0, length=None):
+  def __new__(cls, buf=None, offset=0, end=None):
     if buf is None:
       return None
     self = object.__new__(cls)
     return self
   def offset(self, other):
-    if isinstance(other, self.__class__):
+    if other.__class__ is int:
+      return other
+    if isinstance(other, BufferPointer):
       assert self.same_buffer(other)
     return getattr(other, 'offset_', other)
   def add(self, other):
     assert isinstance(other, int)
-    return BufferPointer(self.buf_, self.offset_ + other, self.length_)
+    return BufferPointer(self.buf_, self.offset_ + other, self.end_)
   def sub(self, other):
-    if isinstance(other, self.__class__):
+    if isinstance(other, BufferPointer):
       assert self.same_buffer(other)
       return self.offset_ - other.offset_
-    return BufferPointer(self.buf_, self.offset_ - other, self.length_)
+    return BufferPointer(self.buf_, self.offset_ - other, self.end_)
   def to(self, ptr):
     assert self.same_buffer(ptr)
-    return BufferPointer(self.buf_, self.offset_, self.offset_ + (ptr - self))
+    return BufferPointer(self.buf_, self.offset_, ptr.offset_)
   @property
-  def value(self): return self.buf_[self.offset_:self.length_]
-  def copy(self): return self.add(0)
-  def begin(self): return self - self.offset_
-  def end(self): return self + len(self)
-  def deref(self): assert len(self) > 0; return self.buf_[self.offset_]
+  def value(self): return self.buf_[self.offset_:self.end_]
+  def copy(self):
+    # Skips __new__ and __init__, whose checks a copy doesn't need; the lexer
+    # copies a pointer for every token.
+    ptr = object.__new__(BufferPointer)
+    ptr.buf_ = self.buf_
+    ptr.offset_ = self.offset_
+    ptr.end_ = self.end_
+    return ptr
+  def begin(self): return BufferPointer(self.buf_, 0, self.end_)
+  def end(self): return BufferPointer(self.buf_, max(self.offset_, self.end_), self.end_)
+  def deref(self): assert self.offset_ < self.end_; return self.buf_[self.offset_]
   def same_buffer(self, other):
-    if not isinstance(other, self.__class__):
-      return False
-    if not isinstance(other.buf_, self.buf_.__class__):
-      return False
-    if hasattr(self.buf_, '__array__'):
-      return other.buf_ is self.buf_
-    else:
-      return other.buf_ == self.buf_
+    return isinstance(other, BufferPointer) and other.buf_ is self.buf_
   def __add__(self, other): return self.add(other)
   def __radd__(self, other): return self.add(other)
   def __iadd__(self, other): self.offset_ += self.offset(other); return self
   def __sub__(self, other): return self.sub(other)
   def __rsub__(self, other): return self.sub(other)
   def __isub__(self, other): self.offset_ -= self.offset(other); return self
-  def __len__(self): return len(self.value)
-  def __repr__(self): return repr(self.value)
-  def __str__(self): return str(self.value)
+  def __len__(self): return max(0, self.end_ - self.offset_)
+  def __repr__(self): return repr(str(self))
+  def __str__(self):
+    value = self.value
+    return value if value.__class__ is str else str(value, 'utf-8')
   def __ne__(self, other): return not (self == other)
   def __eq__(self, other): return self.same_buffer(other) and self.offset_ == other.offset_
   def __lt__(self, other): return id(self.buf_) < id(other.buf_) if not self.same_buffer(other) else self.offset_ < other.offset_
@@ -128,7 +152,7 @@ class HloLexer:
     str_val: str = ''
     int64_val: int = 0
     decimal_val: float = 0.0
-    primitive_type_val: xd.PrimitiveType = xd.PRIMITIVE_TYPE_INVALID
+    primitive_type_val: int = primitive_util.PRIMITIVE_TYPE_INVALID
     def copy(self):
       return self.__class__(
         self.token_start.copy(),
@@ -138,21 +162,51 @@ class HloLexer:
         self.decimal_val,
         self.primitive_type_val
       )
-  @dataclass
-  class LineNoCacheTy:
-    last_query: BufferPointer = None
-    line_no_of_query: int = 0
-  def __init__(self, buf):
-    self.data_ = copy(buf)
+  def __init__(self, buf, start=0, engine='hand', stats=None):
+    """Lexes buf, starting at offset start. Locations are always relative to
+    the beginning of buf.
+
+    buf may be a str, or bytes, bytearray, memoryview or mmap holding UTF-8
+    text, which is lexed without decoding or copying it. Non-ASCII bytes are
+    only allowed in string literals. String values other than string literals
+    are then BufferPointer views, decoded when str() is called on them.
+
+    engine selects how tokens are recognized: 'hand' is the hand-written
+    lexer ported from XLA, and 'regex' recognizes most tokens with a single
+    match of token_pattern. Both produce the same tokens and values.
+
+    stats, an xlaz.hlo_instrument.LexerStats, records what this lexer does."""
+    if engine not in kLexerEngines:
+      raise ValueError(f"unknown lexer engine {engine!r}; expected one of {kLexerEngines}")
+    self.engine_ = engine
+    if engine == 'regex':
+      self.LexToken = self.LexTokenRegex
+    if isinstance(buf, kByteBuffers):
+      # Lex the bytes in place: shadow each pattern with its bytes version.
+      if isinstance(buf, memoryview):
+        buf = buf.cast('B')
+      self.data_ = buf
+      self.__dict__.update(BytesPatterns())
+    else:
+      self.data_ = copy(buf)
     self.buf_ = BufferPointer(self.data_)
-    self.current_ptr_ = self.buf_.begin()
+    self.current_ptr_ = self.buf_ + start
     self.token_state_ = self.TokenState()
     self.token_state_.token_start = self.current_ptr_.copy()
-    self.line_no_cache_ = self.LineNoCacheTy()
+    # (token state, pointer past the token) of tokens lexed by PeekAhead that
+    # Lex() hasn't reached yet.
+    self.lookahead_ = deque()
+    # Offsets of each '\n' in the buffer, for GetLineAndColumn and GetLine.
+    self.newline_offsets_ = None
+    if stats is not None:
+      stats.attach(self)
   def PeekCurrentChar(self) -> Union[str, TokKind]:
-    if self.current_ptr_ == self.buf_.end():
+    ptr = self.current_ptr_
+    if ptr.offset_ >= ptr.end_:
       return kEOF
-    current_char = self.current_ptr_.deref()
+    current_char = ptr.buf_[ptr.offset_]
+    if current_char.__class__ is int:
+      current_char = kByteChars[current_char]
     if current_char == '\0':
       #'\0' should not appear in the middle of the string.
       return kError
@@ -165,196 +219,191 @@ class HloLexer:
   def CanDereference(self, ptr):
     return ptr is not None and ptr < self.buf_.end() and ptr >= self.buf_.begin()
   def Lex(self) -> TokKind:
-    self.token_state_.current_kind = self.LexToken()
+    if self.lookahead_:
+      self.token_state_, self.current_ptr_ = self.lookahead_.popleft()
+    else:
+      self.token_state_.current_kind = self.LexToken()
     return self.GetKind()
+  def SkipTo(self, offset: int):
+    """Continues lexing at offset, dropping any tokens looked ahead. The next
+    call to Lex() lexes the token at offset."""
+    self.lookahead_.clear()
+    self.current_ptr_ = self.buf_ + offset
   def GetKind(self) -> TokKind:
     return self.token_state_.current_kind
   LocTy = BufferPointer
   def GetLoc(self) -> LocTy:
     """Returns the location of the current token."""
     return self.token_state_.token_start.copy()
+  def GetNewlineOffsets(self) -> array:
+    """Returns the sorted offsets of every '\n' in the buffer. The index is
+    built on first use."""
+    if self.newline_offsets_ is None:
+      self.newline_offsets_ = array('q', (match.start() for match in self.newline_pattern.finditer(self.data_)))
+    return self.newline_offsets_
+  newline_pattern = LazyRE2(r"\n")
   def GetLineAndColumn(self, location: LocTy) -> (int, int):
     """Returns the line and column of a location in the buffer."""
-    line_no = 1
-    start = self.buf_.begin()
-    ptr = start.copy()
-    #   if (line_no_cache_.last_query && CanDereference(line_no_cache_.last_query) &&
-    #       line_no_cache_.last_query <= location) {
-    #     ptr = line_no_cache_.last_query;
-    #     line_no = line_no_cache_.line_no_of_query;
-    #   }
-    if self.line_no_cache_.last_query is not None \
-            and self.CanDereference(self.line_no_cache_.last_query) \
-            and self.line_no_cache_.last_query <= location:
-      ptr = self.line_no_cache_.last_query.copy()
-      line_no = self.line_no_cache_.line_no_of_query
-    end = self.buf_.end()
-    while ptr != location:
-      assert ptr < end
-      if ptr.deref() == '\n':
-        line_no += 1
-      ptr += 1
-    # Update the line number cache.
-    self.line_no_cache_.last_query = ptr.copy()
-    self.line_no_cache_.line_no_of_query = line_no
-    line_offset = StringPieceFromPointers(start, ptr).value.rfind('\n')
-    if line_offset < 0:
-      line_offset = 0
-    return (line_no, ptr - start - line_offset)
+    assert self.buf_.same_buffer(location) and location.offset_ <= self.buf_.end_
+    offset = location.offset_
+    newlines = self.GetNewlineOffsets()
+    # The number of newlines before the location.
+    line_index = bisect_left(newlines, offset)
+    line_offset = newlines[line_index - 1] if line_index > 0 else 0
+    return (line_index + 1, offset - line_offset)
   def GetLine(self, loc: LocTy) -> BufferPointer:
     """Returns the whole line given the location."""
     if not self.CanDereference(loc):
       return BufferPointer("LINE OUT OF RANGE")
-    line_start = StringPieceFromPointers(self.buf_.begin(), loc + 1).value.rfind('\n')
-    start = self.buf_.begin() if line_start < 0 else (self.buf_.begin() + line_start + 1)
-    line_end = StringPieceFromPointers(loc, self.buf_.end()).value.find('\n')
-    end = self.buf_.end() if line_end < 0 else (loc + line_end)
+    newlines = self.GetNewlineOffsets()
+    # The line starts after the last newline at or before loc, and ends at the
+    # first newline at or after loc.
+    line_start = bisect_right(newlines, loc.offset_)
+    start = self.buf_.begin() if line_start == 0 else (self.buf_.begin() + newlines[line_start - 1] + 1)
+    line_end = bisect_left(newlines, loc.offset_)
+    end = self.buf_.end() if line_end == len(newlines) else (self.buf_.begin() + newlines[line_end])
     return StringPieceFromPointers(start, end)
   def LookAhead(self) -> TokKind:
     """Looks ahead one token and returns it. Lexer state is unchanged."""
-    if self.GetKind() in [TokKind.kEof, TokKind.kError]:
+    return self.PeekAhead(1)
+  def PeekAhead(self, k: int) -> TokKind:
+    """Returns the kind of the k-th token after the current one, without
+    changing the current token. Tokens lexed while looking ahead are kept
+    until Lex() reaches them, so each token is lexed exactly once."""
+    if k <= 0:
       return self.GetKind()
-    old_current_ptr = self.current_ptr_.copy()
-    old_current_state = self.token_state_.copy()
-    try:
-      self.Lex()
-      kind = self.GetKind()
-      return kind
-    finally:
-      self.token_state_ = old_current_state
-      self.current_ptr_ = old_current_ptr
+    while len(self.lookahead_) < k:
+      if self.lookahead_:
+        last_state, last_ptr = self.lookahead_[-1]
+      else:
+        last_state, last_ptr = self.token_state_, self.current_ptr_
+      if last_state.current_kind in [TokKind.kEof, TokKind.kError]:
+        return last_state.current_kind
+      old_current_state = self.token_state_
+      old_current_ptr = self.current_ptr_
+      try:
+        self.token_state_ = self.TokenState()
+        self.current_ptr_ = last_ptr.copy()
+        self.token_state_.current_kind = self.LexToken()
+        self.lookahead_.append((self.token_state_, self.current_ptr_))
+      finally:
+        self.token_state_ = old_current_state
+        self.current_ptr_ = old_current_ptr
+    return self.lookahead_[k - 1][0].current_kind
+  # Runs of whitespace and complete comments, which produce no tokens. A
+  # comment that is unterminated or contains '\0' is left for LexComment, which
+  # reports the error.
+  trivia_pattern = LazyRE2(r"(?:[ \t\n\r]+|//[^\n\r\0]*(?=[\n\r]|\Z)|/\*[^\0]*?\*/)*")
   def LexToken(self) -> TokKind:
     while True:
-      self.token_state_.token_start = self.current_ptr_.copy()
-      current_char = self.GetNextChar()
-      if current_char == kEOF:
+      ptr = self.current_ptr_
+      ptr.offset_ = self.trivia_pattern.match(ptr.buf_, ptr.offset_, ptr.end_).end()
+      self.token_state_.token_start = ptr.copy()
+      if ptr.offset_ >= ptr.end_:
         # Hit the end of the input buffer.
         return TokKind.kEof
-      elif current_char == kError:
+      current_char = ptr.buf_[ptr.offset_]
+      if current_char.__class__ is int:
+        current_char = kByteChars[current_char]
+      kind = kSingleCharTokens.get(current_char)
+      if kind is not None:
+        ptr.offset_ += 1
+        return kind
+      if current_char == '\0':
         # Hit an invalid character in the input buffer.
         return TokKind.kError
-      elif current_char in [' ', '\t', '\n', '\r']:
-        # Ignore whitespace.
-        continue
-      elif current_char.isnumeric() or current_char == '-':
-        if current_char == '-' and self.PeekCurrentChar() == '>':
-          self.current_ptr_ += 1
-          return TokKind.kArrow
-        return self.LexNumberOrPattern();
-      elif current_char == '=':
-        return TokKind.kEqual
-      elif current_char == '<':
-        if current_char == '<' and self.PeekCurrentChar() == '=':
-          self.current_ptr_ += 1
-          return TokKind.kLeq
-        return TokKind.kError
-      elif current_char == ',':
-        return TokKind.kComma
-      elif current_char == '%':
-        return self.LexPercent()
-      #       case ':':
-      #         return TokKind::kColon;
-      elif current_char == ':':
-        return TokKind.kColon
-      #       case '*':
-      #         return TokKind::kAsterisk;
-      elif current_char == '*':
-        return TokKind.kAsterisk
-      #       case '[':
-      #         return TokKind::kLsquare;
-      elif current_char == '[':
-        return TokKind.kLsquare
-      #       case ']':
-      #         return TokKind::kRsquare;
-      elif current_char == ']':
-        return TokKind.kRsquare
-      #       case '{':
-      #         return TokKind::kLbrace;
-      elif current_char == '{':
-        return TokKind.kLbrace
-      #       case '}':
-      #         return TokKind::kRbrace;
-      elif current_char == '}':
-        return TokKind.kRbrace
-      #       case '(':
-      #         return TokKind::kLparen;
-      elif current_char == '(':
-        return TokKind.kLparen
-      #       case ')':
-      #         return TokKind::kRparen;
-      elif current_char == ')':
-        return TokKind.kRparen
-      elif current_char == '/':
-        if self.PeekCurrentChar() == '*':
-          # This is the start of a /*...*/ delimited comment. Save the current
-          # location in case the comment is unterminated so the error message
-          # will point to the beginning of the comment.
-          # const char* comment_start = current_ptr_;
-          comment_start = self.current_ptr_.copy()
-          # current_ptr_++;
-          self.current_ptr_ += 1
-          # Advance until '*/' is found.
-          while True:
-            # int current = GetNextChar();
-            current = self.GetNextChar()
-            # if (current == '*' && PeekCurrentChar() == '/') {
-            #   // End of comment.
-            #   current_ptr_++;
-            #   break;
-            # }
-            if current == '*' and self.PeekCurrentChar() == '/':
-              # End of comment.
-              self.current_ptr_ += 1
-              break
-            # if (current == kEOF) {
-            #   // Unterminated comment.
-            #   current_ptr_ = comment_start;
-            #   return TokKind::kError;
-            # }
-            if current == kEOF:
-              # Unterminated comment.
-              self.current_ptr_ = comment_start
-              return TokKind.kError
-            # if (current == kError) {
-            #   return TokKind::kError;
-            # }
-            if current == kError:
-              return TokKind.kError
-          # Return no token for the comment. Keep lexing.
-          continue
-        elif self.PeekCurrentChar() == '/':
-          # This is the start of a '//' delimited comment. Throw away
-          # everything until end of line or file. The end-of-line character(s)
-          # are left unlexed in the buffer which is harmless because these are
-          # skipped later by the lexer. This approach enables support for
-          # different end-of-line encodings.
-          while True:
-            current = self.PeekCurrentChar()
-            if current == kEOF or current == '\n' or current == '\r':
-              break
-            if current == kError:
-              return TokKind.kError
-            self.current_ptr_ += 1
-          continue
-        # A lone '/' is an error.
-        return TokKind.kError
-      elif current_char == '.':
-        if self.PeekCurrentChar() == '.':
-          self.current_ptr_ += 1
-          if self.PeekCurrentChar() == '.':
-            self.current_ptr_ += 1
-            return TokKind.kDots
-        return TokKind.kError
-      elif current_char == '"':
-        return self.LexString()
+      ptr.offset_ += 1
+      handler = self.dispatch_table.get(current_char)
+      if handler is not None:
+        kind = handler(self)
+      elif current_char.isnumeric():
+        kind = self.LexNumberOrPattern()
+      elif current_char.isalpha():
+        kind = self.LexIdentifier()
       else:
-        # [a - zA - Z_]
-        if current_char.isalpha() or current_char == '_':
-          return self.LexIdentifier()
         return TokKind.kError
-  def LexIdentifier(self):
-    while IsIdentifierChar(self.PeekCurrentChar()):
+      if kind is not None:
+        return kind
+  # The hand-written LexToken, which LexTokenRegex falls back to.
+  LexTokenByHand = LexToken
+  def LexMinus(self):
+    if self.PeekCurrentChar() == '>':
+      self.current_ptr_ += 1
+      return TokKind.kArrow
+    return self.LexNumberOrPattern()
+  def LexLeq(self):
+    if self.PeekCurrentChar() == '=':
+      self.current_ptr_ += 1
+      return TokKind.kLeq
+    return TokKind.kError
+  def LexDots(self):
+    if self.PeekCurrentChar() == '.':
+      self.current_ptr_ += 1
+      if self.PeekCurrentChar() == '.':
+        self.current_ptr_ += 1
+        return TokKind.kDots
+    return TokKind.kError
+  def LexComment(self):
+    """Lexes a comment after a '/'. Returns None if a comment was skipped, or
+    kError."""
+    if self.PeekCurrentChar() == '*':
+      # This is the start of a /*...*/ delimited comment. Save the current
+      # location in case the comment is unterminated so the error message
+      # will point to the beginning of the comment.
+      # const char* comment_start = current_ptr_;
+      comment_start = self.current_ptr_.copy()
+      # current_ptr_++;
       self.current_ptr_ += 1
+      # Advance until '*/' is found.
+      while True:
+        # int current = GetNextChar();
+        current = self.GetNextChar()
+        # if (current == '*' && PeekCurrentChar() == '/') {
+        #   // End of comment.
+        #   current_ptr_++;
+        #   break;
+        # }
+        if current == '*' and self.PeekCurrentChar() == '/':
+          # End of comment.
+          self.current_ptr_ += 1
+          break
+        # if (current == kEOF) {
+        #   // Unterminated comment.
+        #   current_ptr_ = comment_start;
+        #   return TokKind::kError;
+        # }
+        if current == kEOF:
+          # Unterminated comment.
+          self.current_ptr_ = comment_start
+          return TokKind.kError
+        # if (current == kError) {
+        #   return TokKind::kError;
+        # }
+        if current == kError:
+          return TokKind.kError
+      # Return no token for the comment. Keep lexing.
+      return None
+    elif self.PeekCurrentChar() == '/':
+      # This is the start of a '//' delimited comment. Throw away
+      # everything until end of line or file. The end-of-line character(s)
+      # are left unlexed in the buffer which is harmless because these are
+      # skipped later by the lexer. This approach enables support for
+      # different end-of-line encodings.
+      while True:
+        current = self.PeekCurrentChar()
+        if current == kEOF or current == '\n' or current == '\r':
+          break
+        if current == kError:
+          return TokKind.kError
+        self.current_ptr_ += 1
+      return None
+    # A lone '/' is an error.
+    return TokKind.kError
+  # The characters IsIdentifierChar accepts: \w is str.isalnum() or '_'.
+  identifier_pattern = LazyRE2(r"[\w.\-]*")
+  def LexIdentifier(self):
+    ptr = self.current_ptr_
+    ptr.offset_ = self.identifier_pattern.match(ptr.buf_, ptr.offset_, ptr.end_).end()
     # If followed by ':', it's a name.
     if self.PeekCurrentChar() == ':':
       self.token_state_.str_val = self.token_state_.token_start.to(self.current_ptr_)
@@ -365,7 +414,9 @@ class HloLexer:
       self.token_state_.str_val = self.token_state_.token_start.to(self.current_ptr_)
       self.current_ptr_ += 1 # skip '='
       return TokKind.kAttributeName
-    identifier = StringPieceFromPointers(self.token_state_.token_start, self.current_ptr_)
+    identifier = ptr.buf_[self.token_state_.token_start.offset_:ptr.offset_]
+    if identifier.__class__ is not str:
+      identifier = str(identifier, 'ascii')
     # Primitive type strings are reserved words. The exception is 'tuple' whose
     # type is represented using nested parentheses without the string 'tuple'.
     #   if (primitive_util::IsPrimitiveTypeName(identifier)) {
@@ -376,11 +427,10 @@ class HloLexer:
     #       return TokKind::kPrimitiveType;
     #     }
     #   }
-    if primitive_util.IsPrimitiveTypeName(identifier):
-      primitive_type = primitive_util.StringToPrimitiveType(identifier)
-      if primitive_type != xd.TUPLE:
-        self.token_state_.primitive_type_val = primitive_type
-        return TokKind.kPrimitiveType
+    primitive_type = PrimitiveTypeKeywords().get(identifier)
+    if primitive_type is not None:
+      self.token_state_.primitive_type_val = primitive_type
+      return TokKind.kPrimitiveType
     # if (identifier == "nan") {
     #   absl::optional<int64_t> payload;
     #   if (PeekCurrentChar() == '(') {
@@ -395,7 +445,7 @@ class HloLexer:
     #       /*sign=*/false, payload.value_or(QuietNanWithoutPayload<double>()));
     #   return TokKind::kDecimal;
     # }
-    if str(identifier) == "nan":
+    if identifier == "nan":
       payload = None
       if self.PeekCurrentChar() == '(':
         consumable = StringPieceFromPointers(self.current_ptr_, self.buf_.end())
@@ -403,24 +453,12 @@ class HloLexer:
         if payload is None:
           return TokKind.kError
       if payload is None:
-        val = self.QuietNanWithoutPayload(float)
-      else:
-        val = self.NanWithSignAndPayload(float, sign=True, nan_payload=payload)
+        payload = self.QuietNanWithoutPayload(float)
+      self.token_state_.decimal_val = self.NanWithSignAndPayload(float, sign=False, nan_payload=payload)
       return TokKind.kDecimal
-    for kw in [
-      "true",
-      "false",
-      "inf",
-      "HloModule",
-      "ENTRY",
-      "ROOT",
-      "maximal",
-      "replicated",
-      "manual",
-      "last_tile_dim_replicate",
-      ]:
-      if str(identifier) == kw:
-        return getattr(TokKind, "kw_" + kw)
+    kind = kKeywords.get(identifier)
+    if kind is not None:
+      return kind
     # {
     #   absl::string_view consumable =
     #       StringPieceFromPointers(token_state_.token_start, buf_.end());
@@ -432,8 +470,15 @@ class HloLexer:
     #     return TokKind::kDimLabels;
     #   }
     # }
-    self.token_state_.str_val = str(identifier)
+    consumable = StringPieceToEnd(self.token_state_.token_start)
+    s = self.Consume(consumable, self.identifier_dim_labels_pattern)
+    if s is not None:
+      self.current_ptr_ = consumable.copy()
+      self.token_state_.str_val = self.StrVal(self.token_state_.token_start.offset_, consumable.offset_)
+      return TokKind.kDimLabels
+    self.token_state_.str_val = identifier
     return TokKind.kIdent
+  identifier_dim_labels_pattern = LazyRE2(r"([0-9bf?]{2,}_[0-9io?]{2,}->[0-9bf?]{2,})")
   # Lex integer and floating-point values, -inf, and patterns for dim labels,
   # dxd (e.g. 1x2x3), and pad.
   #
@@ -453,7 +498,7 @@ class HloLexer:
   neg_inf = LazyRE2(r"-inf")
   neg_nan = LazyRE2(r"-nan")
   def LexNumberOrPattern(self):
-    consumable = StringPieceFromPointers(self.token_state_.token_start, self.buf_.end())
+    consumable = StringPieceToEnd(self.token_state_.token_start)
     s = self.Consume(consumable, self.float_pattern)
     if s is not None:
       self.current_ptr_ = consumable.copy()
@@ -462,17 +507,17 @@ class HloLexer:
     s = self.Consume(consumable, self.dim_labels_pattern)
     if s is not None:
       self.current_ptr_ = consumable.copy()
-      self.token_state_.str_val = str(s)
+      self.token_state_.str_val = self.StrVal(self.token_state_.token_start.offset_, consumable.offset_)
       return TokKind.kDimLabels
     s = self.Consume(consumable, self.dxd_pattern)
     if s is not None:
       self.current_ptr_ = consumable.copy()
-      self.token_state_.str_val = str(s)
+      self.token_state_.str_val = self.StrVal(self.token_state_.token_start.offset_, consumable.offset_)
       return TokKind.kDxD
     s = self.Consume(consumable, self.pad_pattern)
     if s is not None:
       self.current_ptr_ = consumable.copy()
-      self.token_state_.str_val = str(s)
+      self.token_state_.str_val = self.StrVal(self.token_state_.token_start.offset_, consumable.offset_)
       return TokKind.kPad
     s = self.Consume(consumable, self.int_pattern)
     if s is not None:
@@ -496,30 +541,51 @@ class HloLexer:
       payload = None
       if self.PeekCurrentChar() == '(':
         payload = self.LexNanPayload(consumable)
-        if payload is not None:
+        if payload is None:
           return TokKind.kError
       #  token_state_.decimal_val = NanWithSignAndPayload<double>(
       #      /*sign=*/true, payload.value_or(QuietNanWithoutPayload<double>()));
       if payload is None:
-        val = self.QuietNanWithoutPayload(float)
-      else:
-        val = self.NanWithSignAndPayload(float, sign=True, nan_payload=payload)
-      self.token_state_.decimal_val = val
+        payload = self.QuietNanWithoutPayload(float)
+      self.token_state_.decimal_val = self.NanWithSignAndPayload(float, sign=True, nan_payload=payload)
       return TokKind.kDecimal
     return TokKind.kError
+  payload_pattern = LazyRE2(r"\(0x[0-9a-fA-F]+\)")
+  def LexNanPayload(self, consumable: BufferPointer):
+    """Lexes a NaN payload of the form (0x...) at consumable, advancing
+    current_ptr_ past it. Returns None if the payload is malformed or out of
+    range."""
+    s = self.Consume(consumable, self.payload_pattern)
+    if s is None:
+      return None
+    self.current_ptr_ = consumable.copy()
+    payload_value = int(s[len("(0x"):-len(")")], 16)
+    if payload_value <= 0 or payload_value > NanPayloadBitMask(float):
+      print(f'NaN payload out of range: {payload_value}', file=sys.stderr)
+      return None
+    return payload_value
+  @staticmethod
+  def QuietNanWithoutPayload(T=float) -> int:
+    return 1 << (kMantissaBits[T] - 1)
+  @staticmethod
+  def NanWithSignAndPayload(T=float, sign=False, nan_payload=0):
+    assert T is float
+    assert nan_payload != 0 and nan_payload & NanPayloadBitMask(T) == nan_payload
+    bits = (int(sign) << 63) | (0x7ff << kMantissaBits[T]) | nan_payload
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
   name_pattern = LazyRE2(r"[a-zA-Z_][a-zA-Z0-9_.-]*")
   def LexPercent(self):
     """Lex names after a % character."""
     s = self.Consume(self.current_ptr_, self.name_pattern)
     if s is not None:
-      self.token_state_.str_val = str(s)
+      self.token_state_.str_val = self.StrVal(self.token_state_.token_start.offset_ + 1, self.current_ptr_.offset_)
       return TokKind.kName
     return TokKind.kError
   escaping_pattern = LazyRE2(r'("([^"\\]|\\.)*")')
   def LexString(self):
     """Lexes quoted string with escaping characters. If matched, the quoted string
     will be unescaped and stored to token_state_.str_val."""
-    consumable = StringPieceFromPointers(self.token_state_.token_start, self.buf_.end())
+    consumable = StringPieceToEnd(self.token_state_.token_start)
     s = self.Consume(consumable, self.escaping_pattern)
     if s is not None:
       self.current_ptr_ = consumable.copy()
@@ -533,20 +599,332 @@ class HloLexer:
         self.token_state_.str_val = str(v)
         return TokKind.kString
     return TokKind.kError
+  def StrVal(self, start: int, end: int):
+    """Returns the text at start:end as a str_val: a str if the buffer is a
+    str, otherwise a BufferPointer view that is decoded by str()."""
+    buf = self.current_ptr_.buf_
+    if buf.__class__ is str:
+      return buf[start:end]
+    return BufferPointer(buf, start, end)
   def Consume(self, consumable: BufferPointer, pattern: re.Pattern):
-    #rx = LazyRE2(pattern)
-    match = pattern.match(str(consumable))
+    """Matches pattern at the start of consumable and advances consumable past
+    the match. The pattern is matched in place against the underlying buffer,
+    so the cost is proportional to the match rather than to the remainder of
+    the buffer."""
+    match = pattern.match(consumable.buf_, consumable.offset_, consumable.end_)
     if match:
-      consumable += match.start()
-      consumable += match.end() - match.start()
+      consumable += match.end() - consumable.offset_
       return match.group()
+  # The handler of each character that starts a token other than a
+  # single-character token, called after the character has been consumed.
+  # Characters not listed here are classified by LexToken.
+  dispatch_table = {
+    **dict.fromkeys('0123456789', LexNumberOrPattern),
+    **dict.fromkeys('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_', LexIdentifier),
+    '-': LexMinus,
+    '<': LexLeq,
+    '%': LexPercent,
+    '/': LexComment,
+    '.': LexDots,
+    '"': LexString,
+  }
+  # Trivia followed by one token, as a single alternation with a named group
+  # for each token class. Alternatives are tried in the order the hand-written
+  # lexer tries them, so the first one that matches is the token it would
+  # produce. Tokens that need more than a match (NaN payloads, -nan, non-ASCII
+  # identifiers), errors and the end of the buffer don't match, and are left
+  # to LexToken.
+  token_pattern = LazyRE2(
+    # Trivia is matched inside a lookahead so that it is never backtracked
+    # into: a comment must not be stretched over an unmatched token.
+    r'(?=(?P<trivia>' + trivia_pattern.pattern + r'))(?P=trivia)'
+    r'(?:(?P<single>[=,:*\[\]{}()])'
+    r'|(?P<arrow>->)'
+    r'|(?P<leq><=)'
+    r'|(?P<dots>\.\.\.)'
+    r'|(?P<string>' + escaping_pattern.pattern + r')'
+    r'|(?P<name>%' + name_pattern.pattern + r')'
+    r'|(?=[-\d])(?:'
+      r'(?P<decimal>' + float_pattern.pattern + r')'
+      r'|(?P<dim_labels>' + dim_labels_pattern.pattern + r')'
+      r'|(?P<dxd>' + dxd_pattern.pattern + r')'
+      r'|(?P<pad>' + pad_pattern.pattern + r')'
+      r'|(?P<int>' + int_pattern.pattern + r')'
+      r'|(?P<neg_inf>' + neg_inf.pattern + r'))'
+    r'|(?P<ident>[a-zA-Z_][\w.\-]*[:=]?))')
+  def LexTokenRegex(self) -> TokKind:
+    ptr = self.current_ptr_
+    match = self.token_pattern.match(ptr.buf_, ptr.offset_, ptr.end_)
+    if match is None:
+      return self.LexTokenByHand()
+    group = match.lastgroup
+    start, end = match.span(group)
+    state = self.token_state_
+    token_start = ptr.copy()
+    token_start.offset_ = start
+    state.token_start = token_start
+    ptr.offset_ = end
+    if group == 'single':
+      c = ptr.buf_[start]
+      return kSingleCharTokens[c if c.__class__ is str else kByteChars[c]]
+    if group == 'ident':
+      return self.LexIdentifierMatch(start, end)
+    if group == 'decimal':
+      state.decimal_val = float(match.group(group))
+      return TokKind.kDecimal
+    if group == 'int':
+      state.int64_val = int(match.group(group))
+      return TokKind.kInt
+    if group == 'name':
+      state.str_val = self.StrVal(start + 1, end)
+      return TokKind.kName
+    if group == 'string':
+      ok, v = CUnescape(BufferPointer(ptr.buf_, start + 1, end - 1))
+      if not ok:
+        ptr.offset_ = start
+        return self.LexTokenByHand()
+      state.str_val = str(v)
+      return TokKind.kString
+    if group in ('dim_labels', 'dxd', 'pad'):
+      state.str_val = self.StrVal(start, end)
+    return kRegexGroupKinds[group]
+  def LexIdentifierMatch(self, start: int, end: int) -> TokKind:
+    """Finishes a token matched by the ident group of token_pattern, which
+    spans start:end and includes a trailing ':' or '='."""
+    buf = self.current_ptr_.buf_
+    state = self.token_state_
+    last = buf[end - 1]
+    if last.__class__ is int:
+      last = kByteChars[last]
+    if last == ':':
+      state.str_val = BufferPointer(buf, start, end - 1)
+      return TokKind.kName
+    if last == '=':
+      state.str_val = BufferPointer(buf, start, end - 1)
+      return TokKind.kAttributeName
+    identifier = buf[start:end]
+    if identifier.__class__ is not str:
+      identifier = str(identifier, 'ascii')
+    primitive_type = PrimitiveTypeKeywords().get(identifier)
+    if primitive_type is not None:
+      state.primitive_type_val = primitive_type
+      return TokKind.kPrimitiveType
+    if identifier == "nan":
+      self.current_ptr_.offset_ = start
+      return self.LexTokenByHand()
+    kind = kKeywords.get(identifier)
+    if kind is not None:
+      return kind
+    s = self.identifier_dim_labels_pattern.match(buf, start)
+    if s is not None:
+      self.current_ptr_.offset_ = s.end()
+      state.str_val = self.StrVal(start, s.end())
+      return TokKind.kDimLabels
+    state.str_val = identifier
+    return TokKind.kIdent
+
+kLexerEngines = ('hand', 'regex')
+
+# Buffers that HloLexer lexes as UTF-8 bytes.
+kByteBuffers = (bytes, bytearray, memoryview, mmap.mmap)
+
+# The character each byte is lexed as. Non-ASCII bytes, which may only appear
+# in string literals, are mapped to a character that starts no token.
+kByteChars = tuple(chr(b) if b < 0x80 else '\ufffd' for b in range(256))
+
+@lru_cache
+def BytesPatterns() -> dict:
+  """Returns the bytes version of every pattern of HloLexer, by name."""
+  return {name: BytesRE2(value) for name, value in vars(HloLexer).items() if isinstance(value, re.Pattern)}
+
+# The kinds of the token_pattern groups that carry no value, or only a
+# str_val, and need no special handling.
+kRegexGroupKinds = {
+  'arrow': TokKind.kArrow,
+  'leq': TokKind.kLeq,
+  'dots': TokKind.kDots,
+  'dim_labels': TokKind.kDimLabels,
+  'dxd': TokKind.kDxD,
+  'pad': TokKind.kPad,
+  'neg_inf': TokKind.kNegInf,
+}
+
+# Tokens that are always exactly one character long.
+kSingleCharTokens = {
+  '=': TokKind.kEqual,
+  ',': TokKind.kComma,
+  ':': TokKind.kColon,
+  '*': TokKind.kAsterisk,
+  '[': TokKind.kLsquare,
+  ']': TokKind.kRsquare,
+  '{': TokKind.kLbrace,
+  '}': TokKind.kRbrace,
+  '(': TokKind.kLparen,
+  ')': TokKind.kRparen,
+}
+
+kKeywords = MappingProxyType({kw: getattr(TokKind, "kw_" + kw) for kw in [
+  "true",
+  "false",
+  "inf",
+  "HloModule",
+  "ENTRY",
+  "ROOT",
+  "maximal",
+  "replicated",
+  "manual",
+  "last_tile_dim_replicate",
+]})
+
+@lru_cache
+def PrimitiveTypeKeywords() -> dict:
+  """Primitive type strings are reserved words. The exception is 'tuple' whose
+  type is represented using nested parentheses without the string 'tuple'."""
+  return {name: primitive_type
+          for name, primitive_type in primitive_util.GetPrimitiveTypeStringMap().items()
+          if primitive_type != primitive_util.TUPLE}
+
+# Explicitly stored mantissa bits of each floating-point type.
+kMantissaBits = {float: 52}
+
+def NanPayloadBitMask(T=float) -> int:
+  return (1 << kMantissaBits[T]) - 1
 
 def IsIdentifierChar(c: str):
+  if not isinstance(c, str):
+    # kEOF or kError.
+    return False
   return c.isalpha() or c.isnumeric() or c in ['.', '_', '-']
 
 def StringPieceFromPointers(a, b) -> BufferPointer:
   return a.to(b)
 
+def StringPieceToEnd(a) -> BufferPointer:
+  """Equivalent to StringPieceFromPointers(a, buf.end())."""
+  ptr = a.copy()
+  ptr.end_ = len(a.buf_)
+  return ptr
+
 def CUnescape(source: BufferPointer):
   # TODO: unescape C strings properly. See CUnescape at ~/ml/abseil-cpp/absl/strings/escaping.cc:849
   return True, str(source)
+
+class TokenTable:
+  """The tokens of a module stored as parallel columns.
+
+  Row i describes one token: kinds[i] is its kTokKindCodes code, and
+  starts[i]:ends[i] is its span in text. Tokens that carry a value have an
+  index into the side table for their kind in value_index[i] (-1 otherwise):
+  int64_vals for kInt, decimal_vals for kDecimal, primitive_type_vals for
+  kPrimitiveType, and str_starts/str_ends (the span of the value in text) for
+  the string-valued kinds. Values are only turned into Python objects when
+  they are asked for."""
+  str_kinds = frozenset([
+    TokKind.kName,
+    TokKind.kAttributeName,
+    TokKind.kDimLabels,
+    TokKind.kDxD,
+    TokKind.kPad,
+    TokKind.kIdent,
+    TokKind.kString,
+  ])
+  # (name, array typecode) of each column.
+  columns = (
+    ('kinds', 'b'),
+    ('starts', 'q'),
+    ('ends', 'q'),
+    ('value_index', 'q'),
+    ('int64_vals', 'q'),
+    ('decimal_vals', 'd'),
+    ('primitive_type_vals', 'b'),
+    ('str_starts', 'q'),
+    ('str_ends', 'q'),
+  )
+  def __init__(self, text, **columns):
+    """Creates an empty table for text. Columns may instead be given as
+    keyword arguments, as any sequence supporting len() and indexing (for
+    example memoryviews of a memory-mapped file), to make a read-only table."""
+    self.text = text
+    for name, typecode in self.columns:
+      setattr(self, name, columns[name] if columns else array(typecode))
+  def __len__(self):
+    return len(self.kinds)
+  def append(self, kind: TokKind, start: int, end: int, state: 'HloLexer.TokenState'):
+    self.kinds.append(kTokKindCodes[kind])
+    self.starts.append(start)
+    self.ends.append(end)
+    if kind == TokKind.kInt:
+      self.value_index.append(len(self.int64_vals))
+      self.int64_vals.append(state.int64_val)
+    elif kind == TokKind.kDecimal:
+      self.value_index.append(len(self.decimal_vals))
+      self.decimal_vals.append(state.decimal_val)
+    elif kind == TokKind.kPrimitiveType:
+      self.value_index.append(len(self.primitive_type_vals))
+      self.primitive_type_vals.append(state.primitive_type_val)
+    elif kind in self.str_kinds:
+      # Recover the span of str_val from the token span: strings skip their
+      # quotes, names lexed after '%' skip the '%', and names and attribute
+      # names lexed as identifiers skip the trailing ':' or '='.
+      if kind == TokKind.kString:
+        start, end = start + 1, end - 1
+      elif kind == TokKind.kName:
+        if self.text[start:start + 1] in ('%', b'%'):
+          start += 1
+        else:
+          end -= 1
+      elif kind == TokKind.kAttributeName:
+        end -= 1
+      self.value_index.append(len(self.str_starts))
+      self.str_starts.append(start)
+      self.str_ends.append(end)
+    else:
+      self.value_index.append(-1)
+  def kind(self, i) -> TokKind:
+    return kTokKinds[self.kinds[i]]
+  def token_text(self, i) -> str:
+    """Returns the source text of token i."""
+    return str(BufferPointer(self.text, self.starts[i], self.ends[i]))
+  def value(self, i):
+    """Returns the value of token i, as HloLexer would have stored it in its
+    TokenState, or None if the token has no value."""
+    kind = self.kind(i)
+    index = self.value_index[i]
+    if kind == TokKind.kInt:
+      return self.int64_vals[index]
+    if kind == TokKind.kDecimal:
+      return self.decimal_vals[index]
+    if kind == TokKind.kPrimitiveType:
+      return self.primitive_type_vals[index]
+    if index < 0:
+      return None
+    value = str(BufferPointer(self.text, self.str_starts[index], self.str_ends[index]))
+    if kind == TokKind.kString:
+      ok, value = CUnescape(value)
+      assert ok
+    return value
+  def numpy(self):
+    """Returns the columns as a dict of NumPy arrays that share memory with
+    this table."""
+    import numpy as np
+    return {name: np.frombuffer(getattr(self, name), dtype=typecode) for name, typecode in self.columns}
+
+def tokenize(text, stats=None) -> TokenTable:
+  """Lexes a whole module in one pass and returns its tokens as a TokenTable.
+  kError tokens are kept, and lexing continues after them as it would with
+  repeated calls to HloLexer.Lex(). The trailing kEof is not stored. stats is
+  passed to HloLexer."""
+  lexer = HloLexer(text, stats=stats)
+  table = TokenTable(lexer.data_)
+  while True:
+    kind = lexer.Lex()
+    if kind == TokKind.kEof:
+      break
+    state = lexer.token_state_
+    start = state.token_start.offset_
+    end = lexer.current_ptr_.offset_
+    table.append(kind, start, end, state)
+    if kind == TokKind.kError and end == start:
+      # The lexer can't make progress past this character.
+      break
+  return table
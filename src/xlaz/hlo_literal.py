@@ -0,0 +1,217 @@
+"""Parses large dense literals in bulk with NumPy.
+
+A constant like `f32[1024,1024] constant({ {0.1, -2, ...}, ... })` holds
+millions of numbers, and lexing them one token at a time dominates parsing.
+ParseDenseLiteral instead takes the whole bracketed text of a literal whose
+shape is known, checks that it only holds what the token-by-token parser
+would accept, and converts all of its numbers with one call to
+numpy.fromstring. Anything unusual, such as comments, NaN payloads, -nan,
+integer -0 or out-of-range values, makes it return None so that the caller
+falls back to HloParser.ParseLiteral, which produces the same literal or
+reports the error.
+
+NumPy is optional: without it, ParseDenseLiteral always returns None.
+"""
+import math
+import warnings
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
+
+from xlaz import primitive_util
+from xlaz.hlo_lexer import BytesRE2, LazyRE2
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+
+# Literals with fewer elements are parsed token by token, which is faster
+# for them.
+kMinDenseLiteralElements = 256
+
+# Element type -> NumPy dtype of the arrays ParseDenseLiteral returns. BF16
+# values are returned as float32, rounded to bfloat16.
+kNumpyTypes = {
+  primitive_util.PRED: 'bool',
+  primitive_util.S8: 'int8',
+  primitive_util.S16: 'int16',
+  primitive_util.S32: 'int32',
+  primitive_util.S64: 'int64',
+  primitive_util.U8: 'uint8',
+  primitive_util.U16: 'uint16',
+  primitive_util.U32: 'uint32',
+  primitive_util.U64: 'uint64',
+  primitive_util.F16: 'float16',
+  primitive_util.BF16: 'float32',
+  primitive_util.F32: 'float32',
+  primitive_util.F64: 'float64',
+}
+
+kFloatTypes = frozenset([primitive_util.F16, primitive_util.BF16, primitive_util.F32, primitive_util.F64])
+
+# The bytes a literal of each kind of element type may contain. Braces are
+# turned into spaces before the numbers are converted.
+kIntBytes = b'0123456789- \t\n\r,{}'
+kFloatBytes = kIntBytes + b'.eEinfa'
+
+kBraceToSpace = bytes.maketrans(b'{}', b'  ')
+
+# The end of a numeric literal: it is followed by the ')' of constant(...).
+kLiteralEndPattern = LazyRE2(r"\)")
+
+# Text that numpy reads differently from the lexer: an integer -0, which the
+# parser turns into +0.0, a '.' that doesn't follow a digit or '-' (the lexer
+# only reads '.5' as a number after a '-'), and a '-' that doesn't start a
+# number. Every branch starts with the character it looks for, so that
+# searching skips quickly to the next '-' or '.'.
+kMisreadPattern = BytesRE2(LazyRE2(r"-(?:(?<![\d.eE]-)0+(?![\d.eE])|(?![\d.in]))|\.(?<![\d\-]\.)"))
+
+@lru_cache
+def Numpy():
+  """Returns the numpy module, or None if it isn't installed."""
+  try:
+    import numpy
+  except ImportError:
+    return None
+  return numpy
+
+def ParseDenseLiteral(text, start: int, element_type: int,
+                      dimensions: Sequence[int]) -> Optional[Tuple[object, int]]:
+  """Parses the literal of the given shape whose '{' is at offset start of
+  text, a str or bytes-like buffer. Returns (array, end) where array is a
+  NumPy array of dtype kNumpyTypes[element_type] with shape dimensions, and
+  end is the offset just past the literal's last '}'. Returns None if the
+  literal can't be parsed in bulk."""
+  np = Numpy()
+  if np is None or element_type not in kNumpyTypes:
+    return None
+  count = math.prod(dimensions)
+  pattern = kLiteralEndPattern if isinstance(text, str) else BytesRE2(kLiteralEndPattern)
+  match = pattern.search(text, start)
+  if match is None:
+    return None
+  body = text[start:match.start()]
+  if isinstance(body, str):
+    try:
+      body = body.encode('ascii')
+    except UnicodeEncodeError:
+      return None
+  else:
+    body = bytes(body)
+  body = body.rstrip()
+  end = start + len(body)
+  if element_type == primitive_util.PRED:
+    body = body.replace(b'true', b'1').replace(b'false', b'0')
+  allowed = kFloatBytes if element_type in kFloatTypes else kIntBytes
+  if body.translate(None, allowed) or not body.endswith(b'}') or b'-nan' in body:
+    return None
+  if kMisreadPattern.search(body):
+    return None
+  # The braces must be balanced, and only the last one may close the first.
+  chars = np.frombuffer(body, dtype=np.uint8)
+  braces = chars[(chars == ord('{')) | (chars == ord('}'))]
+  depth = np.cumsum(np.where(braces == ord('{'), 1, -1))
+  if depth[-1] != 0 or (len(depth) > 1 and depth[:-1].min() < 1):
+    return None
+  with warnings.catch_warnings():
+    # numpy warns, and stops, at text that isn't a number.
+    warnings.simplefilter('error')
+    try:
+      values = np.fromstring(body.translate(kBraceToSpace), sep=',',
+                             dtype=np.float64 if element_type in kFloatTypes else np.int64)
+    except (ValueError, DeprecationWarning):
+      return None
+  if len(values) != count:
+    return None
+  array = ConvertValues(values, element_type)
+  if array is None:
+    return None
+  return array.reshape(dimensions), end
+
+def ConvertValues(values, element_type: int):
+  """Converts float64 or int64 values to the dtype of element_type, as the
+  token-by-token parser would. Returns None for values it would reject."""
+  np = Numpy()
+  dtype = np.dtype(kNumpyTypes[element_type])
+  if element_type == primitive_util.PRED:
+    return values != 0
+  if dtype.kind in 'iu':
+    info = np.iinfo(dtype)
+    # int64 values at the limits may have been clamped by numpy.
+    limits = np.iinfo(np.int64)
+    if len(values) and (values.min() < max(info.min, limits.min + 1) or values.max() > min(info.max, limits.max - 1)):
+      return None
+    return values.astype(dtype)
+  if element_type == primitive_util.F64:
+    return values
+  with np.errstate(over='ignore', invalid='ignore'):
+    array = values.astype(np.float32 if element_type == primitive_util.BF16 else dtype)
+  if element_type != primitive_util.F32 and np.any(np.isinf(array) & np.isfinite(values)):
+    # struct.pack raises for values out of the range of F16 and BF16 (but
+    # F32 literals overflow to inf, as protobuf does).
+    return None
+  if element_type == primitive_util.BF16:
+    array = BF16Bits(array).astype(np.uint32) << 16
+    array = array.view(np.float32)
+  return array
+
+def BF16Bits(array):
+  """Returns the bits of float32 array rounded to bfloat16 (round to nearest
+  even), as hlo_parser.RoundToBF16 computes them."""
+  np = Numpy()
+  bits = array.view(np.uint32).astype(np.uint64)
+  rounded = (bits + 0x7fff + ((bits >> 16) & 1)) >> 16
+  return np.where(np.isnan(array), (bits >> 16) | 0x40, rounded).astype(np.uint16)
+
+def SetLiteralArray(literal: xd.LiteralProto, element_type: int, array):
+  """Stores array, as returned by ParseDenseLiteral, in the LiteralProto field
+  for element_type."""
+  np = Numpy()
+  flat = array.reshape(-1)
+  if element_type == primitive_util.BF16:
+    literal.bf16s = (flat.view(np.uint32) >> 16).astype('<u2').tobytes()
+  elif element_type == primitive_util.PRED:
+    literal.preds.extend(flat.tolist())
+  elif flat.dtype.itemsize < 4:
+    setattr(literal, kPackedFields[element_type], flat.astype(flat.dtype.newbyteorder('<')).tobytes())
+  else:
+    getattr(literal, kRepeatedFields[element_type]).extend(flat.tolist())
+
+kPackedFields = {
+  primitive_util.S8: 's8s',
+  primitive_util.U8: 'u8s',
+  primitive_util.S16: 's16s',
+  primitive_util.U16: 'u16s',
+  primitive_util.F16: 'f16s',
+}
+
+kRepeatedFields = {
+  primitive_util.S32: 's32s',
+  primitive_util.S64: 's64s',
+  primitive_util.U32: 'u32s',
+  primitive_util.U64: 'u64s',
+  primitive_util.F32: 'f32s',
+  primitive_util.F64: 'f64s',
+}
+
+def LiteralToNumpy(literal: xd.LiteralProto):
+  """Returns the values of a non-tuple LiteralProto as a NumPy array with the
+  literal's shape. BF16 values are returned as float32."""
+  np = Numpy()
+  if np is None:
+    raise ImportError("LiteralToNumpy requires numpy")
+  element_type = literal.shape.element_type
+  dimensions = list(literal.shape.dimensions)
+  if element_type == primitive_util.PRED:
+    array = np.array(literal.preds, dtype=bool)
+  elif element_type == primitive_util.BF16:
+    array = (np.frombuffer(literal.bf16s, dtype='<u2').astype(np.uint32) << 16).view(np.float32)
+  elif element_type in kPackedFields:
+    dtype = np.dtype(kNumpyTypes[element_type]).newbyteorder('<')
+    array = np.frombuffer(getattr(literal, kPackedFields[element_type]), dtype=dtype)
+  elif element_type in kRepeatedFields:
+    array = np.array(getattr(literal, kRepeatedFields[element_type]), dtype=kNumpyTypes[element_type])
+  elif element_type in (primitive_util.C64, primitive_util.C128):
+    if element_type == primitive_util.C64:
+      array = np.array(literal.c64s, dtype=np.float32).view(np.complex64)
+    else:
+      array = np.array(literal.c128s, dtype=np.float64).view(np.complex128)
+  else:
+    raise ValueError(f"literals of type {xd.PrimitiveType.Name(element_type)} are not supported")
+  return array.reshape(dimensions)
@@ -0,0 +1,404 @@
+"""Lazily parsed HLO modules.
+
+LoadHloModule only parses the HloModule header and finds where each
+computation starts; a computation is parsed the first time it is accessed.
+Computations are found without lexing or parsing instructions. A computation
+usually ends at the next '}' at the start of a line, which is taken as its
+end if, with strings and comments blanked out, its brackets balance up to
+there and no other computation header appears in between; those checks run
+at C speed with str and bytes methods and regular expressions. Otherwise its
+bracket tokens are counted one at a time, skipping strings and comments, so
+indentation and line breaks don't matter. If that fails too, the whole
+module is parsed instead, which reports the error with its location or, if
+the module is valid after all, gives the computations.
+
+The same index lets ParseHloModuleParallel and ParseHloFileParallel split a
+module at computation boundaries and parse the pieces in worker processes.
+Workers map the source file with mmap rather than receiving the text, and
+send back serialized computations, which are merged in module order.
+"""
+import mmap
+import os
+import tempfile
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from xlaz.hlo_lexer import BytesRE2, HloLexer, LazyRE2, TokKind
+from xlaz.hlo_parser import HloParseError, HloParser, ParseHloModule, SetEntryComputation
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+# The tokens that can open or close a bracket, or hide one: brackets,
+# strings and comments, as HloLexer lexes them. A '"' or '/' that doesn't
+# start a string or comment is an error.
+kBracketTokenPattern = LazyRE2(r'(?P<open>[{(\[])|(?P<rbrace>\})|(?P<close>[)\]])'
+                               r'|"(?:[^"\\]|\\.)*"|/\*[\s\S]*?\*/|//[^\n\r]*|(?P<error>["/])')
+
+# The likely end of a computation: a '}' at the start of a line.
+kLineStartBracePattern = LazyRE2(r'\n\}')
+
+# Strings and comments, as HloLexer lexes them.
+kHiddenPattern = LazyRE2(r'"[^"\\]*(?:\\.[^"\\]*)*"|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|//[^\n\r]*')
+kCommentPattern = LazyRE2(r'/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|//[^\n\r]*')
+
+# A comment with a quote in it, or something that looks like one inside a
+# string.
+kQuotedCommentPatterns = (LazyRE2(r'/\*[^*"]*(?:\*+[^*/"][^*"]*)*"'), LazyRE2(r'//[^\n\r"]*"'))
+
+# What follows the '{' of a layout rather than that of a computation body.
+kLayoutStartPattern = LazyRE2(r'\s*[\d:}]')
+
+# What might start a computation header in a computation body, once strings
+# and comments are blanked out, besides ENTRY: a parameter, an empty
+# parameter list, '->' after a name and before a shape, or a '{' after a
+# name. Instructions rarely match, and false matches only make the scan
+# count bracket tokens instead. Each pattern starts with a literal and is
+# searched on its own, so that searching is fast.
+kHeaderPatterns = (
+  LazyRE2(r':(?=\s*(?:\w+\[|\())'),
+  LazyRE2(r'\(\)(?=\s*(?:->|\{))'),
+  LazyRE2(r'->(?:(?<=[-\w.%]\s->)|(?<=[-\w.%]->)(?=\s*(?:\w+\[|\()))'),
+  LazyRE2(r'\{(?:(?<=[-\w.%]\{)|(?<=[-\w.%\s]\s\{))'),
+)
+
+# The strings FindComputationEnd splits on, joins with or counts, as str and
+# as bytes.
+kScanStrings = ('"', '\\"', '/', ' ', 'ENTRY')
+kScanBytes = tuple(string.encode() for string in kScanStrings)
+
+# Every byte but the brackets, quotes and slashes that FindComputationEnd
+# counts, which it deletes before counting the rest.
+kUncountedBytes = bytes(byte for byte in range(256) if byte not in b'{}()[]"/')
+
+kOpeningKinds = (TokKind.kLbrace, TokKind.kLparen, TokKind.kLsquare)
+kClosingKinds = (TokKind.kRbrace, TokKind.kRparen, TokKind.kRsquare)
+
+def ScanComputations(text, start: int = 0) -> List[tuple]:
+  """Returns (name, offset, is_entry) for each computation in text, starting
+  the scan at offset start, which should be just past the module header.
+  Instructions aren't lexed: a computation ends at the '}' that closes its
+  last open bracket, unless a '{' follows it, as after the layout of the
+  result shape in `-> f32[2]{0} {`. That is the next '}' at the start of a
+  line if FindComputationEnd can tell, or else is found by
+  ScanBracketTokens. Raises HloParseError if the brackets don't balance.
+  text may be a str or any buffer HloLexer accepts."""
+  lexer = HloLexer(text, start)
+  computations = []
+  kind = lexer.Lex()
+  while kind != TokKind.kEof:
+    offset = int(lexer.GetLoc())
+    is_entry = kind == TokKind.kw_ENTRY
+    if is_entry:
+      kind = lexer.Lex()
+    if kind not in (TokKind.kName, TokKind.kIdent):
+      ScanError(lexer, "expects computation name")
+    computations.append((str(lexer.token_state_.str_val), offset, is_entry))
+    pos = lexer.current_ptr_.offset_
+    kind = FindComputationEnd(lexer, pos)
+    if kind is None:
+      kind = ScanBracketTokens(lexer, pos)
+    # Attributes such as execution_thread="main" may follow the computation.
+    while kind == TokKind.kComma:
+      if lexer.Lex() != TokKind.kAttributeName:
+        ScanError(lexer, "expects attribute name")
+      kind = SkipValue(lexer, lexer.Lex())
+  return computations
+
+def FindComputationEnd(lexer: HloLexer, pos: int) -> Optional[TokKind]:
+  """Tries to end the computation whose name ends at offset pos at the next
+  '}' at the start of a line after the '{' that opens its body. If that '}'
+  closes the computation, skips past it and returns the kind of the next
+  token; otherwise returns None."""
+  data = lexer.data_
+  patterns = (kLineStartBracePattern, kHiddenPattern, kCommentPattern) + kQuotedCommentPatterns + kHeaderPatterns
+  strings = kScanStrings
+  if not isinstance(data, str):
+    patterns = tuple(BytesRE2(pattern) for pattern in patterns)
+    strings = kScanBytes
+  line_start_brace, hidden, comment = patterns[:3]
+  quoted_comments, headers = patterns[3:5], patterns[5:]
+  quote, escaped_quote, slash, space, entry = strings
+  body = FindBodyStart(data, pos)
+  if body is None:
+    return None
+  match = line_start_brace.search(data, body)
+  if match is None:
+    return None
+  span = data[body:match.end()]
+  if isinstance(span, memoryview):
+    span = span.tobytes()
+  # Blank out strings and comments. Strings are every other piece between
+  # quotes, which str.split finds much faster than a pattern, unless a quote
+  # is escaped or in a comment.
+  if span.count(escaped_quote) or span.count(quote) % 2 or any(pattern.search(span) for pattern in quoted_comments):
+    code = hidden.sub(space, span)
+  else:
+    code = space.join(span.split(quote)[0::2])
+    if code.count(slash):
+      code = comment.sub(space, code)
+  # A quote or slash left over starts an unterminated string or comment, or
+  # is an error.
+  counted = (code.encode() if isinstance(code, str) else code).translate(None, kUncountedBytes)
+  if (counted.count(b'"') or counted.count(b'/') or counted.count(b'{') != counted.count(b'}')
+      or counted.count(b'(') != counted.count(b')') or counted.count(b'[') != counted.count(b']')
+      or code.count(entry) or any(pattern.search(code) for pattern in headers)):
+    return None
+  lexer.SkipTo(match.end())
+  kind = lexer.Lex()
+  if kind == TokKind.kLbrace:
+    return None
+  return kind
+
+def FindBodyStart(data, pos: int) -> Optional[int]:
+  """Returns the offset of the '{' that opens the body of the computation
+  whose name ends at offset pos, past its parameters and result shape, or
+  None if it can't tell."""
+  pattern, layout_start = kBracketTokenPattern, kLayoutStartPattern
+  lbrace = '{'
+  if not isinstance(data, str):
+    pattern, layout_start, lbrace = BytesRE2(pattern), BytesRE2(layout_start), b'{'
+  depth = 0
+  while True:
+    match = pattern.search(data, pos)
+    if match is None:
+      return None
+    pos = match.end()
+    group = match.lastgroup
+    if group == 'open':
+      if depth == 0 and match.group() == lbrace and not layout_start.match(data, pos):
+        return match.start()
+      depth += 1
+    elif group in ('rbrace', 'close'):
+      depth -= 1
+      if depth < 0:
+        return None
+    elif group == 'error':
+      return None
+
+def ScanBracketTokens(lexer: HloLexer, pos: int) -> TokKind:
+  """Ends the computation whose name ends at offset pos at the '}' that
+  closes its last open bracket, counting bracket tokens one at a time, and
+  returns the kind of the token after it."""
+  pattern = kBracketTokenPattern if isinstance(lexer.data_, str) else BytesRE2(kBracketTokenPattern)
+  depth = 0
+  while True:
+    match = pattern.search(lexer.data_, pos)
+    if match is None:
+      lexer.SkipTo(len(lexer.data_))
+      lexer.Lex()
+      ScanError(lexer, "expects '}' at the end of computation")
+    pos = match.end()
+    group = match.lastgroup
+    if group == 'open':
+      depth += 1
+    elif group in ('rbrace', 'close'):
+      depth -= 1
+      if depth < 0:
+        ScanError(lexer, "unbalanced brackets", match.start())
+      if group == 'rbrace' and depth == 0:
+        lexer.SkipTo(pos)
+        kind = lexer.Lex()
+        if kind != TokKind.kLbrace:
+          return kind
+    elif group == 'error':
+      ScanError(lexer, "unterminated string or comment", match.start())
+
+def SkipValue(lexer: HloLexer, kind: TokKind) -> TokKind:
+  """Skips one attribute value starting with the current token, of the given
+  kind, like HloParser.SkipValue, and returns the kind of the next token."""
+  depth = 0
+  while True:
+    if kind in (TokKind.kEof, TokKind.kError):
+      ScanError(lexer, "unexpected end of attribute value")
+    if kind in kOpeningKinds:
+      depth += 1
+    elif kind in kClosingKinds:
+      depth -= 1
+    kind = lexer.Lex()
+    if depth <= 0:
+      return kind
+
+def ScanError(lexer: HloLexer, msg: str, offset: Optional[int] = None):
+  """Raises HloParseError at offset, or at the current token."""
+  line, col = lexer.GetLineAndColumn(lexer.GetLoc() if offset is None else lexer.buf_ + offset)
+  raise HloParseError(f"{line}:{col}: error: {msg}")
+
+class LazyHloModule(Mapping):
+  """A read-only mapping from computation name to HloComputationProto, in
+  module order, whose values are parsed on first access and then cached.
+
+  Ids are the same as those assigned by ParseHloModule. If the computations
+  can't be found without parsing them, they are all parsed up front, and
+  parsed_module is the whole module; their offsets are then None."""
+  def __init__(self, text):
+    self.text_ = text
+    self.header_ = hlo_pb2.HloModuleProto()
+    self.offsets_: Dict[str, Optional[int]] = {}
+    self.computation_ids_: Dict[str, int] = {}
+    self.cache_: Dict[str, hlo_pb2.HloComputationProto] = {}
+    self.parsed_module: Optional[hlo_pb2.HloModuleProto] = None
+    parser = HloParser(text)
+    parser.ParseHloModuleHeader(self.header_)
+    try:
+      self.ScanComputations(int(parser.lexer_.GetLoc()))
+    except HloParseError:
+      # ParseHloModule reports the error with its location, or parses a
+      # module that the scan got wrong.
+      self.SetParsedModule(ParseHloModule(text))
+
+  def ScanComputations(self, start: int):
+    entry_name = None
+    for name, offset, is_entry in ScanComputations(self.text_, start):
+      if name in self.offsets_:
+        raise HloParseError(f"computation already exists: {name}")
+      self.offsets_[name] = offset
+      self.computation_ids_[name] = len(self.computation_ids_)
+      if is_entry:
+        if entry_name is not None:
+          raise HloParseError("expects only one ENTRY")
+        entry_name = name
+    if not self.offsets_:
+      raise HloParseError("expects at least one computation")
+    self.entry_computation_name_ = entry_name if entry_name is not None else name
+
+  def SetParsedModule(self, module: hlo_pb2.HloModuleProto):
+    self.parsed_module = module
+    self.offsets_ = {computation.name: None for computation in module.computations}
+    self.computation_ids_ = {computation.name: computation.id for computation in module.computations}
+    self.cache_ = {computation.name: computation for computation in module.computations}
+    self.entry_computation_name_ = module.entry_computation_name
+
+  @property
+  def name(self) -> str:
+    return self.header_.name
+
+  @property
+  def entry_computation_name(self) -> str:
+    return self.entry_computation_name_
+
+  def entry_computation(self) -> hlo_pb2.HloComputationProto:
+    return self[self.entry_computation_name_]
+
+  def computation_id(self, name: str) -> int:
+    return self.computation_ids_[name]
+
+  def offset(self, name: str) -> Optional[int]:
+    """Returns the offset of the header of the named computation in the text,
+    or None if the module was parsed whole."""
+    return self.offsets_[name]
+
+  def is_parsed(self, name: str) -> bool:
+    return name in self.cache_
+
+  def __getitem__(self, name: str) -> hlo_pb2.HloComputationProto:
+    computation = self.cache_.get(name)
+    if computation is None:
+      parser = HloParser(self.text_, self.offsets_[name], self.computation_ids_)
+      computation = parser.RunComputation(self.computation_ids_[name])
+      self.cache_[name] = computation
+    return computation
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.offsets_)
+
+  def __len__(self) -> int:
+    return len(self.offsets_)
+
+  def ToProto(self) -> hlo_pb2.HloModuleProto:
+    """Parses any computations that haven't been parsed yet, and returns the
+    whole module."""
+    if self.parsed_module is not None:
+      return self.parsed_module
+    return AssembleModule(self.header_, [self[name] for name in self], self.computation_ids_[self.entry_computation_name_])
+
+def AssembleModule(header: hlo_pb2.HloModuleProto, computations: List[hlo_pb2.HloComputationProto],
+                   entry_computation_id: int) -> hlo_pb2.HloModuleProto:
+  """Returns a copy of header with computations, in module order, and the
+  entry computation set."""
+  module = hlo_pb2.HloModuleProto()
+  module.CopyFrom(header)
+  for computation in computations:
+    module.computations.add().CopyFrom(computation)
+  SetEntryComputation(module, module.computations[entry_computation_id])
+  return module
+
+def LoadHloModule(text) -> LazyHloModule:
+  """Indexes the computations of the HLO text of a module without parsing
+  them."""
+  return LazyHloModule(text)
+
+# The mapped source file, computation offsets and computation ids of a
+# ParseHloFileParallel worker process.
+_worker_state = None
+
+def _InitParseWorker(path: str, offsets: Dict[str, int], computation_ids: Dict[str, int]):
+  global _worker_state
+  with open(path, 'rb') as f:
+    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  _worker_state = (text, offsets, computation_ids)
+
+def _ParseComputationsInWorker(names: List[str]) -> List[bytes]:
+  text, offsets, computation_ids = _worker_state
+  return [HloParser(text, offsets[name], computation_ids).RunComputation(computation_ids[name]).SerializeToString()
+          for name in names]
+
+def SplitComputations(module: LazyHloModule, count: int) -> List[List[str]]:
+  """Splits the computations of module into at most count runs of
+  consecutive computations with roughly the same amount of text each."""
+  names = list(module)
+  size = len(module.text_)
+  ends = [module.offset(name) for name in names[1:]] + [size]
+  target = max(1, (size - module.offset(names[0])) // max(1, count))
+  runs = [[]]
+  run_start = module.offset(names[0])
+  for name, end in zip(names, ends):
+    runs[-1].append(name)
+    if end - run_start >= target and len(runs) < count:
+      runs.append([])
+      run_start = end
+  return [run for run in runs if run]
+
+def ParseHloFileParallel(path: str, max_workers: Optional[int] = None, tasks_per_worker: int = 4) -> hlo_pb2.HloModuleProto:
+  """Parses the HLO text file at path like ParseHloModule, using a pool of
+  max_workers processes (os.cpu_count() by default). The module is split
+  into about tasks_per_worker runs of computations per worker, so that one
+  large computation doesn't leave the other workers idle. With a single
+  worker, or if the computations can't be found without parsing them, the
+  module is parsed in this process."""
+  if max_workers is None:
+    max_workers = os.cpu_count() or 1
+  if os.path.getsize(path) == 0:
+    # mmap can't map an empty file; report the error ParseHloModule would.
+    return ParseHloModule('')
+  with open(path, 'rb') as f:
+    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  with text:
+    if max_workers <= 1:
+      return ParseHloModule(text)
+    module = LazyHloModule(text)
+    if module.parsed_module is not None:
+      return module.parsed_module
+    runs = SplitComputations(module, max_workers * tasks_per_worker)
+    if len(runs) <= 1:
+      return module.ToProto()
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(runs)), initializer=_InitParseWorker,
+                             initargs=(path, module.offsets_, module.computation_ids_)) as executor:
+      computations = [hlo_pb2.HloComputationProto.FromString(data)
+                      for datas in executor.map(_ParseComputationsInWorker, runs)
+                      for data in datas]
+    return AssembleModule(module.header_, computations, module.computation_ids_[module.entry_computation_name_])
+
+def ParseHloModuleParallel(text, max_workers: Optional[int] = None, tasks_per_worker: int = 4) -> hlo_pb2.HloModuleProto:
+  """Like ParseHloFileParallel, for HLO text in memory. The text is written
+  to a temporary file that the workers map."""
+  if max_workers is not None and max_workers <= 1:
+    return ParseHloModule(text)
+  if isinstance(text, str):
+    text = text.encode('utf-8')
+  fd, path = tempfile.mkstemp(prefix='xlaz-', suffix='.txt')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(text)
+    return ParseHloFileParallel(path, max_workers=max_workers, tasks_per_worker=tasks_per_worker)
+  finally:
+    os.unlink(path)
@@ -0,0 +1,1005 @@
+"""Parses HLO text into an HloModuleProto.
+
+This mirrors the structure of XLA's hlo_parser.cc, but builds the protos
+directly rather than going through HloModule. The parser makes a single pass
+over the HloLexer token stream: the current token is the only lookahead it
+ever needs, so no token is lexed more than once. Large dense literals are
+not lexed at all when NumPy is installed: xlaz.hlo_literal converts them in
+bulk. Neither are array shapes and shardings whose text was seen before,
+which are copied from an xlaz.hlo_shape_cache.ShapeCache and an
+xlaz.hlo_sharding.ShardingCache.
+"""
+import math
+import struct
+from typing import Callable, Dict, List
+
+from xlaz import hlo_literal
+from xlaz.hlo_lexer import BytesRE2, HloLexer, LazyRE2, TokKind
+from xlaz.hlo_shape_cache import ShapeCache
+from xlaz.hlo_sharding import ShardingCache
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+class HloParseError(ValueError):
+  pass
+
+# Tile dimension that is combined with the next most minor dimension.
+kCombineDimension = -(1 << 63)
+
+# The text of an array shape that is looked up in the shape cache: no
+# whitespace or comments, and a layout of ints and upper-case items only. If
+# there is no layout, no '{' may follow, since it would start one. Any other
+# shape is parsed token by token.
+kCachedShapePattern = LazyRE2(
+  r"[a-z][a-z0-9]*\[(?:(?:<=)?\d+(?:,(?:<=)?\d+)*)?\]"
+  r"(?:\{[\d,]*(?::[A-Z\d(),*]*)?\}|(?![ \t\r\n]*[{/]))")
+
+# The text of a sharding that is looked up in the sharding cache: a single
+# sharding, or a tuple of them, without strings or comments.
+kCachedShardingPattern = LazyRE2(r'\{(?:[^{}"/]|\{[^{}"/]*\})*\}')
+
+# An explicit device list, converted without lexing each id. The last id
+# must end the token.
+kDeviceListPattern = LazyRE2(r"\d+(?:[ \t\r\n]*,[ \t\r\n]*\d+)*(?![\w.])")
+
+class HloParser:
+  """Parses a module, or a single computation of a module.
+
+  Computation ids are the index of the computation in the module, and
+  instruction ids are (computation id << 32) | index of the instruction in its
+  computation. Because ids only depend on positions, any computation can be
+  parsed on its own and still get the ids it would have in the whole module.
+  """
+  def __init__(self, text, start: int = 0, computation_ids: Dict[str, int] = None, stats=None,
+               shape_cache: ShapeCache = None, sharding_cache: ShardingCache = None, index=None):
+    """Parses text from offset start. computation_ids maps the names of
+    computations that are not parsed by this parser to their ids, so that calls
+    to them can be resolved. stats is passed to HloLexer. shape_cache and
+    sharding_cache may be shared by several parsers; by default each parser
+    has its own. index, an xlaz.hlo_index.HloIndex, is told about each
+    instruction and operand use as they are parsed."""
+    self.lexer_ = HloLexer(text, start, stats=stats)
+    self.lexer_.Lex()
+    self.shape_cache_ = ShapeCache() if shape_cache is None else shape_cache
+    self.sharding_cache_ = ShardingCache() if sharding_cache is None else sharding_cache
+    patterns = (kCachedShapePattern, kCachedShardingPattern, kDeviceListPattern)
+    if not isinstance(self.lexer_.data_, str):
+      patterns = tuple(map(BytesRE2, patterns))
+    self.shape_pattern_, self.sharding_pattern_, self.device_list_pattern_ = patterns
+    # Computation name -> id, for resolving called computations.
+    self.computation_ids_ = dict(computation_ids or {})
+    # (instruction, names) pairs whose called computations are resolved once
+    # all computations have been parsed.
+    self.pending_calls_ = []
+    self.index_ = index
+
+  def Run(self) -> hlo_pb2.HloModuleProto:
+    """Parses the whole module."""
+    module = hlo_pb2.HloModuleProto()
+    self.ParseHloModule(module)
+    return module
+
+  def RunComputation(self, computation_id: int) -> hlo_pb2.HloComputationProto:
+    """Parses the single computation at the start offset, giving it the id
+    computation_id."""
+    module = hlo_pb2.HloModuleProto()
+    self.ParseComputation(module, computation_id)
+    self.ResolveCalledComputations()
+    return module.computations[0]
+
+  # Errors.
+
+  def Error(self, loc, msg: str):
+    line, col = self.lexer_.GetLineAndColumn(loc)
+    line_text = str(self.lexer_.GetLine(loc))
+    raise HloParseError(f"{line}:{col}: error: {msg}\n{line_text}\n{' ' * max(col - 1, 0)}^")
+
+  def TokenError(self, msg: str):
+    self.Error(self.lexer_.GetLoc(), msg)
+
+  # Token helpers.
+
+  def Kind(self) -> TokKind:
+    return self.lexer_.GetKind()
+
+  def EatIfPresent(self, kind: TokKind) -> bool:
+    if self.lexer_.GetKind() != kind:
+      return False
+    self.lexer_.Lex()
+    return True
+
+  def ParseToken(self, kind: TokKind, msg: str = None):
+    if self.lexer_.GetKind() != kind:
+      self.TokenError(msg or f"expects {kind.value!r}")
+    self.lexer_.Lex()
+
+  def ParseName(self) -> str:
+    """Parses a %name or bare identifier."""
+    if self.Kind() not in (TokKind.kName, TokKind.kIdent):
+      self.TokenError("expects name")
+    name = str(self.lexer_.token_state_.str_val)
+    self.lexer_.Lex()
+    return name
+
+  def ParseAttributeName(self) -> str:
+    if self.Kind() != TokKind.kAttributeName:
+      self.TokenError("expects attribute name")
+    name = str(self.lexer_.token_state_.str_val)
+    self.lexer_.Lex()
+    return name
+
+  def ParseIdent(self) -> str:
+    if self.Kind() != TokKind.kIdent:
+      self.TokenError("expects identifier")
+    ident = str(self.lexer_.token_state_.str_val)
+    self.lexer_.Lex()
+    return ident
+
+  def ParseString(self) -> str:
+    if self.Kind() != TokKind.kString:
+      self.TokenError("expects string")
+    s = str(self.lexer_.token_state_.str_val)
+    self.lexer_.Lex()
+    return s
+
+  def ParseInt64(self) -> int:
+    if self.Kind() != TokKind.kInt:
+      self.TokenError("expects integer")
+    value = self.lexer_.token_state_.int64_val
+    self.lexer_.Lex()
+    return value
+
+  def ParseDouble(self) -> float:
+    kind = self.Kind()
+    if kind == TokKind.kDecimal:
+      value = self.lexer_.token_state_.decimal_val
+    elif kind == TokKind.kInt:
+      value = float(self.lexer_.token_state_.int64_val)
+    elif kind == TokKind.kw_inf:
+      value = math.inf
+    elif kind == TokKind.kNegInf:
+      value = -math.inf
+    else:
+      self.TokenError("expects number")
+    self.lexer_.Lex()
+    return value
+
+  def ParseBool(self) -> bool:
+    if self.EatIfPresent(TokKind.kw_true):
+      return True
+    if self.EatIfPresent(TokKind.kw_false):
+      return False
+    self.TokenError("expects true or false")
+
+  def ParseList(self, start: TokKind, end: TokKind, delim: TokKind, parse: Callable) -> list:
+    """Parses `start [item (delim item)*] end`."""
+    self.ParseToken(start)
+    items = []
+    if self.EatIfPresent(end):
+      return items
+    items.append(parse())
+    while self.EatIfPresent(delim):
+      items.append(parse())
+    self.ParseToken(end)
+    return items
+
+  def ParseInt64List(self, start=TokKind.kLbrace, end=TokKind.kRbrace, delim=TokKind.kComma) -> List[int]:
+    return self.ParseList(start, end, delim, self.ParseInt64)
+
+  def ParseDxD(self) -> List[int]:
+    """Parses `1x2x3`, which lexes as kDxD, or a single integer."""
+    if self.Kind() == TokKind.kInt:
+      return [self.ParseInt64()]
+    if self.Kind() != TokKind.kDxD:
+      self.TokenError("expects dimension sizes like 1x2x3")
+    dims = [int(d) for d in str(self.lexer_.token_state_.str_val).split('x')]
+    self.lexer_.Lex()
+    return dims
+
+  def ParsePaddingPairs(self) -> List[List[int]]:
+    """Parses `low_high(_interior)?(x...)*`, which lexes as kPad."""
+    if self.Kind() != TokKind.kPad:
+      self.TokenError("expects padding like 0_0x1_1")
+    pads = [[int(p) for p in dim.split('_')] for dim in str(self.lexer_.token_state_.str_val).split('x')]
+    self.lexer_.Lex()
+    return pads
+
+  def SkipValue(self):
+    """Skips one attribute value: a single token, or a balanced (), [] or {}
+    group."""
+    opening = (TokKind.kLbrace, TokKind.kLparen, TokKind.kLsquare)
+    closing = (TokKind.kRbrace, TokKind.kRparen, TokKind.kRsquare)
+    depth = 0
+    while True:
+      kind = self.Kind()
+      if kind in (TokKind.kEof, TokKind.kError):
+        self.TokenError("unexpected end of attribute value")
+      if kind in opening:
+        depth += 1
+      elif kind in closing:
+        depth -= 1
+      self.lexer_.Lex()
+      if depth <= 0:
+        return
+
+  # Module and computations.
+
+  def ParseHloModule(self, module: hlo_pb2.HloModuleProto):
+    self.ParseHloModuleHeader(module)
+    entry = None
+    while self.Kind() != TokKind.kEof:
+      computation, is_entry = self.ParseComputation(module, len(module.computations))
+      if is_entry:
+        if entry is not None:
+          self.TokenError("expects only one ENTRY")
+        entry = computation
+    if not module.computations:
+      self.TokenError("expects at least one computation")
+    if entry is None:
+      entry = module.computations[-1]
+    SetEntryComputation(module, entry)
+    self.ResolveCalledComputations()
+
+  def ParseHloModuleHeader(self, module: hlo_pb2.HloModuleProto):
+    """header ::= 'HloModule' name (',' attribute)*"""
+    self.ParseToken(TokKind.kw_HloModule, "expects HloModule")
+    module.name = self.ParseName()
+    while self.EatIfPresent(TokKind.kComma):
+      attr = self.ParseAttributeName()
+      if attr == 'entry_computation_layout':
+        self.ParseToken(TokKind.kLbrace)
+        self.ParseProgramShape(module.host_program_shape)
+        self.ParseToken(TokKind.kRbrace)
+      elif attr == 'is_dynamic':
+        module.is_dynamic = self.ParseBool()
+      else:
+        self.SkipValue()
+
+  def ResolveCalledComputations(self):
+    for instruction, names in self.pending_calls_:
+      for loc, name in names:
+        if name not in self.computation_ids_:
+          self.Error(loc, f"computation does not exist: {name}")
+        instruction.called_computation_ids.append(self.computation_ids_[name])
+    self.pending_calls_ = []
+
+  def ParseComputation(self, module: hlo_pb2.HloModuleProto, computation_id: int):
+    """computation ::= ('ENTRY')? name (param_list '->' shape)? instruction_list"""
+    is_entry = self.EatIfPresent(TokKind.kw_ENTRY)
+    loc = self.lexer_.GetLoc()
+    name = self.ParseName()
+    if self.computation_ids_.get(name, computation_id) != computation_id:
+      self.Error(loc, f"computation already exists: {name}")
+    computation = module.computations.add()
+    computation.name = name
+    computation.id = computation_id
+    self.computation_ids_[name] = computation_id
+    body_lbrace_lexed = False
+    if self.Kind() == TokKind.kLparen:
+      # The parameter list repeats the shapes of the parameter instructions,
+      # so the program shape is computed from the instructions instead.
+      header = xd.ProgramShapeProto()
+      self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma, lambda: self.ParseParam(header))
+      self.ParseToken(TokKind.kArrow)
+      body_lbrace_lexed = self.ParseShape(header.result, body_may_follow=True)
+    if not body_lbrace_lexed:
+      self.ParseToken(TokKind.kLbrace, "expects '{' at the beginning of the instruction list")
+    self.ParseInstructionList(computation)
+    # Attributes such as execution_thread="main" may follow the computation.
+    while self.EatIfPresent(TokKind.kComma):
+      self.ParseAttributeName()
+      self.SkipValue()
+    return computation, is_entry
+
+  def ParseParam(self, program_shape: xd.ProgramShapeProto):
+    program_shape.parameter_names.append(self.ParseName())
+    self.EatIfPresent(TokKind.kColon)
+    self.ParseShape(program_shape.parameters.add())
+
+  def ParseProgramShape(self, program_shape: xd.ProgramShapeProto):
+    """program_shape ::= '(' (shape (',' shape)*)? ')' '->' shape"""
+    self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma,
+                   lambda: self.ParseShape(program_shape.parameters.add()))
+    self.ParseToken(TokKind.kArrow)
+    self.ParseShape(program_shape.result)
+
+  def ParseInstructionList(self, computation: hlo_pb2.HloComputationProto):
+    # Instruction name -> id, and (instruction, [(loc, name)]) pairs for the
+    # operands and control predecessors to resolve once all instructions of
+    # the computation are known.
+    ids = {}
+    pending_operands = []
+    pending_predecessors = []
+    root = None
+    while self.Kind() != TokKind.kRbrace:
+      if self.Kind() == TokKind.kEof:
+        self.TokenError("expects '}' at the end of instruction list")
+      offset = self.lexer_.token_state_.token_start.offset_
+      instruction, is_root, operands, predecessors = self.ParseInstruction(computation)
+      if instruction.name in ids:
+        self.TokenError(f"instruction already exists: {instruction.name}")
+      if self.index_ is not None:
+        self.index_.AddInstruction(computation, instruction, offset)
+      ids[instruction.name] = instruction.id
+      pending_operands.append((instruction, operands))
+      pending_predecessors.append((instruction, predecessors))
+      if is_root:
+        if root is not None:
+          self.TokenError("one computation should have only one ROOT")
+        root = instruction
+    self.ParseToken(TokKind.kRbrace)
+    if not computation.instructions:
+      self.TokenError("expects at least one instruction")
+    for field, pending in (('operand_ids', pending_operands), ('control_predecessor_ids', pending_predecessors)):
+      for instruction, names in pending:
+        for loc, name in names:
+          if name not in ids:
+            self.Error(loc, f"instruction does not exist: {name}")
+          getattr(instruction, field).append(ids[name])
+          if self.index_ is not None and field == 'operand_ids':
+            self.index_.AddUse(ids[name], instruction.id, int(loc))
+    if root is None:
+      root = computation.instructions[-1]
+    computation.root_id = root.id
+    ComputeProgramShape(computation, root)
+
+  def ParseInstruction(self, computation: hlo_pb2.HloComputationProto):
+    """instruction ::= ('ROOT')? name '=' shape opcode operands (attribute)*"""
+    is_root = self.EatIfPresent(TokKind.kw_ROOT)
+    instruction = computation.instructions.add()
+    instruction.name = self.ParseName()
+    instruction.id = (computation.id << 32) | (len(computation.instructions) - 1)
+    self.ParseToken(TokKind.kEqual, "expects '=' in instruction")
+    self.ParseShape(instruction.shape)
+    instruction.opcode = self.ParseIdent()
+    operands = []
+    if instruction.opcode == 'parameter':
+      self.ParseToken(TokKind.kLparen)
+      instruction.parameter_number = self.ParseInt64()
+      self.ParseToken(TokKind.kRparen)
+    elif instruction.opcode == 'constant':
+      self.ParseToken(TokKind.kLparen)
+      self.ParseLiteral(instruction.literal, instruction.shape)
+      self.ParseToken(TokKind.kRparen)
+    else:
+      self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma, lambda: operands.append(self.ParseOperand()))
+    predecessors = []
+    calls = []
+    while self.EatIfPresent(TokKind.kComma):
+      self.ParseAttribute(instruction, calls, predecessors)
+    if calls:
+      self.pending_calls_.append((instruction, calls))
+    return instruction, is_root, operands, predecessors
+
+  def ParseOperand(self):
+    """operand ::= (shape)? name"""
+    if self.Kind() in (TokKind.kPrimitiveType, TokKind.kLparen):
+      self.ParseShape(xd.ShapeProto())
+    loc = self.lexer_.GetLoc()
+    return loc, self.ParseName()
+
+  # Shapes.
+
+  def ParseShape(self, shape: xd.ShapeProto, body_may_follow: bool = False) -> bool:
+    """shape ::= '(' (shape (',' shape)*)? ')' | primitive_type dims (layout)?
+
+    If body_may_follow is set, a '{' after the shape that does not start a
+    layout is consumed and True is returned, so that a computation header can
+    be parsed without looking ahead more than one token."""
+    if self.Kind() == TokKind.kLparen:
+      shape.element_type = xd.TUPLE
+      self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma,
+                     lambda: self.ParseShape(shape.tuple_shapes.add()))
+      return False
+    if self.Kind() != TokKind.kPrimitiveType:
+      self.TokenError("expects shape")
+    if not body_may_follow and self.shape_cache_.max_size > 0:
+      return self.ParseCachedShape(shape)
+    return self.ParseArrayShape(shape, body_may_follow)
+
+  def ParseCachedShape(self, shape: xd.ShapeProto) -> bool:
+    """Copies the shape from the shape cache if its text is cached, and
+    otherwise parses and caches it."""
+    match = self.shape_pattern_.match(self.lexer_.data_, self.lexer_.token_state_.token_start.offset_)
+    if match is None:
+      return self.ParseArrayShape(shape)
+    key = match.group()
+    if self.shape_cache_.get(key, shape):
+      self.lexer_.SkipTo(match.end())
+      self.lexer_.Lex()
+    else:
+      self.ParseArrayShape(shape)
+      self.shape_cache_.put(key, shape)
+    return False
+
+  def ParseArrayShape(self, shape: xd.ShapeProto, body_may_follow: bool = False) -> bool:
+    shape.element_type = self.lexer_.token_state_.primitive_type_val
+    self.lexer_.Lex()
+    self.ParseToken(TokKind.kLsquare, "expects '[' to start the dimensions")
+    if not self.EatIfPresent(TokKind.kRsquare):
+      while True:
+        is_dynamic = self.EatIfPresent(TokKind.kLeq)
+        shape.dimensions.append(self.ParseInt64())
+        shape.is_dynamic_dimension.append(is_dynamic)
+        if not self.EatIfPresent(TokKind.kComma):
+          break
+      self.ParseToken(TokKind.kRsquare, "expects ']' to end the dimensions")
+    if not self.EatIfPresent(TokKind.kLbrace):
+      return False
+    if body_may_follow and self.Kind() not in (TokKind.kInt, TokKind.kColon, TokKind.kRbrace):
+      return True
+    self.ParseLayout(shape.layout)
+    return False
+
+  def ParseLayout(self, layout: xd.LayoutProto):
+    """layout ::= '{' (int (',' int)*)? (':' layout_item*)? '}', with the
+    opening brace already consumed."""
+    layout.format = xd.DENSE
+    if self.Kind() == TokKind.kInt:
+      layout.minor_to_major.append(self.ParseInt64())
+      while self.EatIfPresent(TokKind.kComma):
+        layout.minor_to_major.append(self.ParseInt64())
+    if self.EatIfPresent(TokKind.kColon):
+      while self.Kind() == TokKind.kIdent:
+        item = self.ParseIdent()
+        if item == 'T':
+          while self.Kind() == TokKind.kLparen:
+            tile = layout.tiles.add()
+            self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma,
+                           lambda: tile.dimensions.append(self.ParseTileDimension()))
+        elif item == 'E':
+          self.ParseToken(TokKind.kLparen)
+          layout.element_size_in_bits = self.ParseInt64()
+          self.ParseToken(TokKind.kRparen)
+        elif item == 'S':
+          self.ParseToken(TokKind.kLparen)
+          layout.memory_space = self.ParseInt64()
+          self.ParseToken(TokKind.kRparen)
+        elif self.Kind() == TokKind.kLparen:
+          self.SkipValue()
+    self.ParseToken(TokKind.kRbrace, "expects '}' at the end of the layout")
+
+  def ParseTileDimension(self) -> int:
+    if self.EatIfPresent(TokKind.kAsterisk):
+      return kCombineDimension
+    return self.ParseInt64()
+
+  # Literals.
+
+  def ParseLiteral(self, literal: xd.LiteralProto, shape: xd.ShapeProto):
+    literal.shape.CopyFrom(shape)
+    if shape.element_type == xd.TUPLE:
+      elements = iter(shape.tuple_shapes)
+      def ParseElement():
+        element_shape = next(elements, None)
+        if element_shape is None:
+          self.TokenError("too many elements in tuple literal")
+        self.ParseLiteral(literal.tuple_literals.add(), element_shape)
+      self.ParseList(TokKind.kLparen, TokKind.kRparen, TokKind.kComma, ParseElement)
+      return
+    values = []
+    if not shape.dimensions:
+      values.append(self.ParseLiteralValue(shape.element_type))
+    else:
+      loc = self.lexer_.GetLoc()
+      if self.Kind() == TokKind.kLbrace and math.prod(shape.dimensions) >= hlo_literal.kMinDenseLiteralElements:
+        parsed = hlo_literal.ParseDenseLiteral(self.lexer_.data_, loc.offset_, shape.element_type, shape.dimensions)
+        if parsed is not None:
+          array, end = parsed
+          hlo_literal.SetLiteralArray(literal, shape.element_type, array)
+          self.lexer_.SkipTo(end)
+          self.lexer_.Lex()
+          return
+      self.ParseToken(TokKind.kLbrace)
+      if self.EatIfPresent(TokKind.kDots):
+        # The printer elides large literals as {...}.
+        self.ParseToken(TokKind.kRbrace)
+        return
+      depth = 1
+      while depth > 0:
+        kind = self.Kind()
+        if kind == TokKind.kLbrace:
+          depth += 1
+          self.lexer_.Lex()
+        elif kind == TokKind.kRbrace:
+          depth -= 1
+          self.lexer_.Lex()
+        elif kind == TokKind.kComma:
+          self.lexer_.Lex()
+        else:
+          values.append(self.ParseLiteralValue(shape.element_type))
+      if len(values) != math.prod(shape.dimensions):
+        self.Error(loc, f"expects {math.prod(shape.dimensions)} elements in literal, but sees {len(values)}")
+    SetLiteralValues(literal, shape.element_type, values)
+
+  def ParseLiteralValue(self, element_type):
+    if element_type == xd.PRED:
+      if self.Kind() == TokKind.kInt:
+        return bool(self.ParseInt64())
+      return self.ParseBool()
+    if element_type in (xd.C64, xd.C128):
+      self.ParseToken(TokKind.kLparen)
+      real = self.ParseDouble()
+      self.ParseToken(TokKind.kComma)
+      imag = self.ParseDouble()
+      self.ParseToken(TokKind.kRparen)
+      return complex(real, imag)
+    loc = self.lexer_.GetLoc()
+    if element_type in (xd.F16, xd.BF16, xd.F32, xd.F64):
+      value = self.ParseDouble()
+      fmt = kNarrowFloatFormats.get(element_type)
+      if fmt is not None:
+        try:
+          struct.pack(fmt, value)
+        except OverflowError:
+          self.LiteralRangeError(loc, value, element_type)
+      return value
+    value = self.ParseInt64()
+    low, high = kIntegerLiteralRanges.get(element_type, (value, value))
+    if not low <= value <= high:
+      self.LiteralRangeError(loc, value, element_type)
+    return value
+
+  def LiteralRangeError(self, loc, value, element_type):
+    self.Error(loc, f"value {value} is out of range for literal's primitive type {xd.PrimitiveType.Name(element_type)}")
+
+  # Attributes.
+
+  def ParseAttribute(self, instruction: hlo_pb2.HloInstructionProto, calls: list, predecessors: list):
+    name = self.ParseAttributeName()
+    parse = kAttributeParsers.get(name)
+    if parse is None:
+      self.SkipValue()
+    else:
+      parse(self, instruction, name, calls, predecessors)
+
+  def ParseComputationName(self, calls: list):
+    loc = self.lexer_.GetLoc()
+    calls.append((loc, self.ParseName()))
+
+  def ParseSharding(self, sharding: xd.OpSharding):
+    """Copies the sharding from the sharding cache if its text is cached, and
+    otherwise parses and caches it."""
+    if self.Kind() != TokKind.kLbrace or self.sharding_cache_.max_size <= 0:
+      return self.ParseOpSharding(sharding)
+    match = self.sharding_pattern_.match(self.lexer_.data_, self.lexer_.token_state_.token_start.offset_)
+    if match is None:
+      return self.ParseOpSharding(sharding)
+    key = match.group()
+    if self.sharding_cache_.get(key, sharding):
+      self.lexer_.SkipTo(match.end())
+      self.lexer_.Lex()
+    else:
+      self.ParseOpSharding(sharding)
+      self.sharding_cache_.put(key, sharding)
+
+  def ParseOpSharding(self, sharding: xd.OpSharding):
+    """sharding ::= '{' single_sharding '}' | '{' ('{' single_sharding '}' (',' ...)*)? '}'"""
+    self.ParseToken(TokKind.kLbrace, "expects '{' to start sharding attribute")
+    if self.Kind() == TokKind.kLbrace or self.Kind() == TokKind.kRbrace:
+      sharding.type = xd.OpSharding.TUPLE
+      if not self.EatIfPresent(TokKind.kRbrace):
+        self.ParseOpSharding(sharding.tuple_shardings.add())
+        while self.EatIfPresent(TokKind.kComma):
+          self.ParseOpSharding(sharding.tuple_shardings.add())
+        self.ParseToken(TokKind.kRbrace, "expects '}' to end tuple sharding")
+      return
+    self.ParseSingleSharding(sharding)
+
+  def ParseSingleSharding(self, sharding: xd.OpSharding):
+    """Parses the body of a non-tuple sharding, up to and including its closing
+    brace."""
+    maximal = replicated = manual = last_tile_dim_replicate = False
+    devices = []
+    dims = []
+    while not self.EatIfPresent(TokKind.kRbrace):
+      kind = self.Kind()
+      if kind == TokKind.kw_maximal:
+        maximal = True
+        self.lexer_.Lex()
+      elif kind == TokKind.kw_replicated:
+        replicated = True
+        self.lexer_.Lex()
+      elif kind == TokKind.kw_manual:
+        manual = True
+        self.lexer_.Lex()
+      elif kind == TokKind.kw_last_tile_dim_replicate:
+        last_tile_dim_replicate = True
+        self.lexer_.Lex()
+      elif kind == TokKind.kAttributeName:
+        attr = self.ParseAttributeName()
+        if attr == 'device':
+          devices = [self.ParseInt64()]
+        elif attr == 'devices':
+          dims = self.ParseInt64List(TokKind.kLsquare, TokKind.kRsquare)
+          devices = self.ParseTileAssignmentDevices(dims)
+        elif attr == 'metadata':
+          self.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma,
+                         lambda: self.ParseMetadata(sharding.metadata.add()))
+        else:
+          self.SkipValue()
+      else:
+        self.TokenError("unexpected token in sharding")
+    if replicated:
+      sharding.type = xd.OpSharding.REPLICATED
+    elif manual:
+      sharding.type = xd.OpSharding.MANUAL
+    elif maximal:
+      if len(devices) != 1:
+        self.TokenError("maximal shardings should have exactly one device assigned")
+      sharding.type = xd.OpSharding.MAXIMAL
+      sharding.tile_assignment_dimensions.append(1)
+      sharding.tile_assignment_devices.extend(devices)
+    else:
+      if not dims:
+        self.TokenError("non-maximal shardings must have a tile assignment list including dimensions")
+      if math.prod(dims) != len(devices):
+        self.TokenError(f"tile assignment dimensions {dims} don't match the {len(devices)} devices")
+      sharding.type = xd.OpSharding.OTHER
+      sharding.tile_assignment_dimensions.extend(dims)
+      sharding.tile_assignment_devices.extend(devices)
+      sharding.replicate_on_last_tile_dim = last_tile_dim_replicate
+
+  def ParseTileAssignmentDevices(self, dims: List[int]) -> List[int]:
+    """Parses an explicit device list `0,1,2,3`, or an iota tile assignment
+    `<=[4]` or `<=[2,2]T(1,0)`."""
+    if not self.EatIfPresent(TokKind.kLeq):
+      match = None
+      if self.Kind() == TokKind.kInt:
+        match = self.device_list_pattern_.match(self.lexer_.data_, self.lexer_.token_state_.token_start.offset_)
+      if match is None:
+        devices = [self.ParseInt64()]
+      else:
+        text = match.group()
+        # int() ignores the whitespace around each id.
+        devices = list(map(int, text.split(',' if isinstance(text, str) else b',')))
+        self.lexer_.SkipTo(match.end())
+        self.lexer_.Lex()
+      # A comment may have stopped the match.
+      while self.EatIfPresent(TokKind.kComma):
+        devices.append(self.ParseInt64())
+      return devices
+    reshape_dims = self.ParseInt64List(TokKind.kLsquare, TokKind.kRsquare)
+    perm = list(range(len(reshape_dims)))
+    if self.Kind() == TokKind.kIdent and str(self.lexer_.token_state_.str_val) == 'T':
+      self.lexer_.Lex()
+      perm = self.ParseInt64List(TokKind.kLparen, TokKind.kRparen)
+    return IotaTileAssignment(reshape_dims, perm)
+
+  def ParseMetadata(self, metadata: xd.OpMetadata):
+    """metadata ::= '{' (attribute_name '=' value)* '}'"""
+    self.ParseToken(TokKind.kLbrace, "expects '{' to start metadata")
+    while not self.EatIfPresent(TokKind.kRbrace):
+      attr = self.ParseAttributeName()
+      if attr in ('op_type', 'op_name', 'source_file'):
+        setattr(metadata, attr, self.ParseString())
+      elif attr in ('source_line', 'creation_pass_id', 'logical_creation_pass_id',
+                    'size_of_generated_code_in_bytes', 'size_of_memory_working_set_in_bytes'):
+        setattr(metadata, attr, self.ParseInt64())
+      else:
+        self.SkipValue()
+
+  def ParseWindow(self, window: xd.Window):
+    """window ::= '{' ('size='DxD | 'stride='DxD | 'pad='pad | 'lhs_dilate='DxD |
+    'rhs_dilate='DxD | 'rhs_reversal='DxD)* '}'"""
+    self.ParseToken(TokKind.kLbrace, "expects '{' to start window")
+    fields = {}
+    locs = {}
+    while not self.EatIfPresent(TokKind.kRbrace):
+      loc = self.lexer_.GetLoc()
+      attr = self.ParseAttributeName()
+      locs[attr] = loc
+      if attr == 'pad':
+        fields[attr] = self.ParsePaddingPairs()
+      elif attr in ('size', 'stride', 'lhs_dilate', 'rhs_dilate', 'rhs_reversal'):
+        fields[attr] = self.ParseDxD()
+      else:
+        self.Error(loc, f"unexpected attribute in window: {attr}")
+    if 'size' not in fields:
+      self.TokenError("sub-attribute 'size=' is required in the window attribute")
+    for attr, values in fields.items():
+      if len(values) != len(fields['size']):
+        self.Error(locs[attr], f"expects '{attr}=' to have the same number of dimensions as 'size='")
+    for i, size in enumerate(fields['size']):
+      dim = window.dimensions.add()
+      dim.size = size
+      dim.stride = fields['stride'][i] if 'stride' in fields else 1
+      if 'pad' in fields:
+        dim.padding_low, dim.padding_high = fields['pad'][i][:2]
+      dim.base_dilation = fields['lhs_dilate'][i] if 'lhs_dilate' in fields else 1
+      dim.window_dilation = fields['rhs_dilate'][i] if 'rhs_dilate' in fields else 1
+      dim.window_reversal = bool(fields['rhs_reversal'][i]) if 'rhs_reversal' in fields else False
+
+  def ParseConvolutionDimensionNumbers(self, dnums: xd.ConvolutionDimensionNumbers):
+    """dim_labels ::= lhs_labels '_' rhs_labels '->' output_labels, e.g.
+    b01f_01io->b01f."""
+    if self.Kind() != TokKind.kDimLabels:
+      self.TokenError("expects dim labels pattern, e.g., 'bf0_0io->0bf'")
+    loc = self.lexer_.GetLoc()
+    labels = str(self.lexer_.token_state_.str_val)
+    self.lexer_.Lex()
+    lhs_rhs, out = labels.split('->')
+    lhs, rhs = lhs_rhs.split('_')
+    if not (len(lhs) == len(rhs) == len(out)):
+      self.Error(loc, f"convolution lhs, rhs, and output must have the same rank, but got {labels}")
+    def Spatial(labels):
+      # Spatial dimensions are labeled by their index: 0, 1, 2, ...
+      return [labels.index(str(i)) for i in range(len(labels) - 2)]
+    for side, expected in ((lhs, 'bf'), (rhs, 'io'), (out, 'bf')):
+      if sorted(side) != sorted(expected + ''.join(str(i) for i in range(len(side) - 2))):
+        self.Error(loc, f"expects each of {expected[0]!r}, {expected[1]!r} and the spatial dimensions "
+                        f"0 to {len(side) - 3} once in dim labels {side}")
+    dnums.input_batch_dimension = lhs.index('b')
+    dnums.input_feature_dimension = lhs.index('f')
+    dnums.input_spatial_dimensions.extend(Spatial(lhs))
+    dnums.kernel_input_feature_dimension = rhs.index('i')
+    dnums.kernel_output_feature_dimension = rhs.index('o')
+    dnums.kernel_spatial_dimensions.extend(Spatial(rhs))
+    dnums.output_batch_dimension = out.index('b')
+    dnums.output_feature_dimension = out.index('f')
+    dnums.output_spatial_dimensions.extend(Spatial(out))
+
+  def ParseSliceRanges(self, instruction: hlo_pb2.HloInstructionProto):
+    """slice ::= '{' ('[' start ':' limit (':' stride)? ']' (',' ...)*)? '}'"""
+    def ParseRange():
+      bounds = self.ParseList(TokKind.kLsquare, TokKind.kRsquare, TokKind.kColon, self.ParseInt64)
+      if len(bounds) not in (2, 3):
+        self.TokenError("expects [start:limit] or [start:limit:stride]")
+      dim = instruction.slice_dimensions.add()
+      dim.start, dim.limit = bounds[:2]
+      dim.stride = bounds[2] if len(bounds) == 3 else 1
+    self.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma, ParseRange)
+
+  def ParsePaddingConfig(self, padding_config: xd.PaddingConfig):
+    for pad in self.ParsePaddingPairs():
+      dim = padding_config.dimensions.add()
+      dim.edge_padding_low, dim.edge_padding_high = pad[:2]
+      dim.interior_padding = pad[2] if len(pad) > 2 else 0
+
+  def ParseReplicaGroups(self, instruction: hlo_pb2.HloInstructionProto):
+    """replica_groups ::= '{' ('{' int_list '}' (',' ...)*)? '}'"""
+    self.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma,
+                   lambda: instruction.replica_groups.add().replica_ids.extend(self.ParseInt64List()))
+
+  def ParseSourceTargetPairs(self, instruction: hlo_pb2.HloInstructionProto):
+    def ParsePair():
+      pair = self.ParseInt64List()
+      if len(pair) != 2:
+        self.TokenError("expects source-target pairs like {0,1}")
+      source_target = instruction.source_target_pairs.add()
+      source_target.source, source_target.target = pair
+    self.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma, ParsePair)
+
+  def ParseFrontendAttributes(self, frontend_attributes: xd.FrontendAttributes):
+    """frontend_attributes ::= '{' (name '=' string (',' ...)*)? '}'"""
+    def ParseEntry():
+      key = self.ParseAttributeName()
+      frontend_attributes.map[key] = self.ParseString()
+    self.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma, ParseEntry)
+
+def SetEntryComputation(module: hlo_pb2.HloModuleProto, entry: hlo_pb2.HloComputationProto):
+  module.entry_computation_name = entry.name
+  module.entry_computation_id = entry.id
+  if not module.HasField('host_program_shape'):
+    module.host_program_shape.CopyFrom(entry.program_shape)
+
+def ComputeProgramShape(computation: hlo_pb2.HloComputationProto, root: hlo_pb2.HloInstructionProto):
+  parameters = sorted((i for i in computation.instructions if i.opcode == 'parameter'),
+                      key=lambda i: i.parameter_number)
+  program_shape = computation.program_shape
+  for parameter in parameters:
+    program_shape.parameters.add().CopyFrom(parameter.shape)
+    program_shape.parameter_names.append(parameter.name)
+  program_shape.result.CopyFrom(root.shape)
+
+def IotaTileAssignment(reshape_dims: List[int], perm: List[int]) -> List[int]:
+  """Returns iota(prod(reshape_dims)).reshape(reshape_dims).transpose(perm),
+  flattened."""
+  strides = [1] * len(reshape_dims)
+  for i in reversed(range(len(reshape_dims) - 1)):
+    strides[i] = strides[i + 1] * reshape_dims[i + 1]
+  devices = [0]
+  for axis in perm:
+    devices = [d + k * strides[axis] for d in devices for k in range(reshape_dims[axis])]
+  return devices
+
+def RoundToBF16(value: float) -> int:
+  """Returns the bits of value rounded to bfloat16 (round to nearest even)."""
+  bits = struct.unpack('<I', struct.pack('<f', value))[0]
+  if math.isnan(value):
+    return (bits >> 16) | 0x40
+  return (bits + 0x7fff + ((bits >> 16) & 1)) >> 16
+
+# The values literals of each integer type can hold.
+kIntegerLiteralRanges = {
+  xd.S8: (-(1 << 7), (1 << 7) - 1),
+  xd.S16: (-(1 << 15), (1 << 15) - 1),
+  xd.S32: (-(1 << 31), (1 << 31) - 1),
+  xd.S64: (-(1 << 63), (1 << 63) - 1),
+  xd.U8: (0, (1 << 8) - 1),
+  xd.U16: (0, (1 << 16) - 1),
+  xd.U32: (0, (1 << 32) - 1),
+  xd.U64: (0, (1 << 64) - 1),
+}
+
+# The struct formats that finite F16 and BF16 literal values must fit: BF16
+# values are rounded from float32.
+kNarrowFloatFormats = {
+  xd.F16: '<e',
+  xd.BF16: '<f',
+}
+
+# Element type -> (LiteralProto field, struct format) for the types that are
+# stored as packed little-endian bytes.
+kPackedLiteralFields = {
+  xd.S8: ('s8s', 'b'),
+  xd.U8: ('u8s', 'B'),
+  xd.S16: ('s16s', 'h'),
+  xd.U16: ('u16s', 'H'),
+  xd.F16: ('f16s', 'e'),
+}
+
+kRepeatedLiteralFields = {
+  xd.PRED: 'preds',
+  xd.S32: 's32s',
+  xd.S64: 's64s',
+  xd.U32: 'u32s',
+  xd.U64: 'u64s',
+  xd.F32: 'f32s',
+  xd.F64: 'f64s',
+}
+
+def SetLiteralValues(literal: xd.LiteralProto, element_type, values: list):
+  """Stores values, in row-major order, in the LiteralProto field for
+  element_type."""
+  if element_type in kRepeatedLiteralFields:
+    getattr(literal, kRepeatedLiteralFields[element_type]).extend(values)
+  elif element_type in kPackedLiteralFields:
+    field, fmt = kPackedLiteralFields[element_type]
+    setattr(literal, field, struct.pack(f'<{len(values)}{fmt}', *values))
+  elif element_type == xd.BF16:
+    literal.bf16s = struct.pack(f'<{len(values)}H', *map(RoundToBF16, values))
+  elif element_type in (xd.C64, xd.C128):
+    field = literal.c64s if element_type == xd.C64 else literal.c128s
+    for value in values:
+      field.extend([value.real, value.imag])
+  elif values:
+    raise HloParseError(f"literals of type {xd.PrimitiveType.Name(element_type)} are not supported")
+
+def _ParseIntField(field):
+  def parse(parser, instruction, name, calls, predecessors):
+    setattr(instruction, field, parser.ParseInt64())
+  return parse
+
+def _ParseBoolField(field):
+  def parse(parser, instruction, name, calls, predecessors):
+    setattr(instruction, field, parser.ParseBool())
+  return parse
+
+def _ParseIntListField(field):
+  def parse(parser, instruction, name, calls, predecessors):
+    getattr(instruction, field).extend(parser.ParseInt64List())
+  return parse
+
+def _ParseIdentField(field, convert=str):
+  def parse(parser, instruction, name, calls, predecessors):
+    loc = parser.lexer_.GetLoc()
+    value = parser.ParseIdent()
+    try:
+      setattr(instruction, field, convert(value))
+    except ValueError:
+      parser.Error(loc, f"unknown {name}: {value}")
+  return parse
+
+def _ParseMessageField(field, method):
+  def parse(parser, instruction, name, calls, predecessors):
+    getattr(parser, method)(getattr(instruction, field))
+  return parse
+
+def _ParseDimensionNumbersField(field, subfield):
+  def parse(parser, instruction, name, calls, predecessors):
+    getattr(getattr(instruction, field), subfield).extend(parser.ParseInt64List())
+  return parse
+
+def _ParseCalledComputation(parser, instruction, name, calls, predecessors):
+  if parser.Kind() == TokKind.kLbrace:
+    parser.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma, lambda: parser.ParseComputationName(calls))
+  else:
+    parser.ParseComputationName(calls)
+
+def _ParseControlPredecessors(parser, instruction, name, calls, predecessors):
+  def ParsePredecessor():
+    loc = parser.lexer_.GetLoc()
+    predecessors.append((loc, parser.ParseName()))
+  parser.ParseList(TokKind.kLbrace, TokKind.kRbrace, TokKind.kComma, ParsePredecessor)
+
+def _ParseIotaDimension(parser, instruction, name, calls, predecessors):
+  instruction.dimensions.append(parser.ParseInt64())
+
+def _ParseBackendConfig(parser, instruction, name, calls, predecessors):
+  if parser.Kind() == TokKind.kString:
+    instruction.backend_config = parser.ParseString().encode()
+  else:
+    parser.SkipValue()
+
+def _ParseEpsilon(parser, instruction, name, calls, predecessors):
+  instruction.epsilon = parser.ParseDouble()
+
+def _ParseCustomCallTarget(parser, instruction, name, calls, predecessors):
+  instruction.custom_call_target = parser.ParseString()
+
+def _ParseSliceSizes(parser, instruction, name, calls, predecessors):
+  sizes = parser.ParseInt64List()
+  if instruction.opcode == 'gather':
+    instruction.gather_slice_sizes.extend(sizes)
+  else:
+    instruction.dynamic_slice_sizes.extend(sizes)
+
+def _ParseIndexVectorDim(parser, instruction, name, calls, predecessors):
+  dnums = instruction.scatter_dimension_numbers if instruction.opcode == 'scatter' else instruction.gather_dimension_numbers
+  dnums.index_vector_dim = parser.ParseInt64()
+
+kAttributeParsers: Dict[str, Callable] = {
+  'sharding': _ParseMessageField('sharding', 'ParseSharding'),
+  'metadata': _ParseMessageField('metadata', 'ParseMetadata'),
+  'window': _ParseMessageField('window', 'ParseWindow'),
+  'dim_labels': _ParseMessageField('convolution_dimension_numbers', 'ParseConvolutionDimensionNumbers'),
+  'padding': _ParseMessageField('padding_config', 'ParsePaddingConfig'),
+  'frontend_attributes': _ParseMessageField('frontend_attributes', 'ParseFrontendAttributes'),
+  'domain': lambda parser, instruction, name, calls, predecessors: parser.SkipValue(),
+  'slice': lambda parser, instruction, name, calls, predecessors: parser.ParseSliceRanges(instruction),
+  'replica_groups': lambda parser, instruction, name, calls, predecessors: parser.ParseReplicaGroups(instruction),
+  'source_target_pairs': lambda parser, instruction, name, calls, predecessors: parser.ParseSourceTargetPairs(instruction),
+  'dimensions': _ParseIntListField('dimensions'),
+  'dynamic_slice_sizes': _ParseIntListField('dynamic_slice_sizes'),
+  'fft_length': _ParseIntListField('fft_length'),
+  'slice_sizes': _ParseSliceSizes,
+  'iota_dimension': _ParseIotaDimension,
+  'index': _ParseIntField('tuple_index'),
+  'feature_group_count': _ParseIntField('feature_group_count'),
+  'batch_group_count': _ParseIntField('batch_group_count'),
+  'channel_id': _ParseIntField('channel_id'),
+  'exponent_bits': _ParseIntField('exponent_bits'),
+  'mantissa_bits': _ParseIntField('mantissa_bits'),
+  'feature_index': _ParseIntField('feature_index'),
+  'all_reduce_id': _ParseIntField('all_reduce_id'),
+  'use_global_device_ids': _ParseBoolField('use_global_device_ids'),
+  'constrain_layout': _ParseBoolField('constrain_layout'),
+  'is_host_transfer': _ParseBoolField('is_host_transfer'),
+  'is_stable': _ParseBoolField('is_stable'),
+  'custom_call_has_side_effect': _ParseBoolField('custom_call_has_side_effect'),
+  'indices_are_sorted': _ParseBoolField('indices_are_sorted'),
+  'unique_indices': _ParseBoolField('unique_indices'),
+  'is_cross_program_prefetch': _ParseBoolField('is_cross_program_prefetch'),
+  'epsilon': _ParseEpsilon,
+  'custom_call_target': _ParseCustomCallTarget,
+  'backend_config': _ParseBackendConfig,
+  'kind': _ParseIdentField('fusion_kind'),
+  'direction': _ParseIdentField('comparison_direction'),
+  'type': _ParseIdentField('comparison_type'),
+  'distribution': _ParseIdentField('distribution', lambda s: xd.RandomDistribution.Value(s.upper())),
+  'fft_type': _ParseIdentField('fft_type', xd.FftType.Value),
+  'lhs_contracting_dims': _ParseDimensionNumbersField('dot_dimension_numbers', 'lhs_contracting_dimensions'),
+  'rhs_contracting_dims': _ParseDimensionNumbersField('dot_dimension_numbers', 'rhs_contracting_dimensions'),
+  'lhs_batch_dims': _ParseDimensionNumbersField('dot_dimension_numbers', 'lhs_batch_dimensions'),
+  'rhs_batch_dims': _ParseDimensionNumbersField('dot_dimension_numbers', 'rhs_batch_dimensions'),
+  'offset_dims': _ParseDimensionNumbersField('gather_dimension_numbers', 'offset_dims'),
+  'collapsed_slice_dims': _ParseDimensionNumbersField('gather_dimension_numbers', 'collapsed_slice_dims'),
+  'start_index_map': _ParseDimensionNumbersField('gather_dimension_numbers', 'start_index_map'),
+  'index_vector_dim': _ParseIndexVectorDim,
+  'update_window_dims': _ParseDimensionNumbersField('scatter_dimension_numbers', 'update_window_dims'),
+  'inserted_window_dims': _ParseDimensionNumbersField('scatter_dimension_numbers', 'inserted_window_dims'),
+  'scatter_dims_to_operand_dims': _ParseDimensionNumbersField('scatter_dimension_numbers', 'scatter_dims_to_operand_dims'),
+  'control-predecessors': _ParseControlPredecessors,
+}
+for _name in ['to_apply', 'calls', 'body', 'condition', 'branch_computations',
+              'true_computation', 'false_computation', 'select', 'scatter']:
+  kAttributeParsers[_name] = _ParseCalledComputation
+del _name
+
+def ParseHloModule(text, stats=None, shape_cache: ShapeCache = None,
+                   sharding_cache: ShardingCache = None) -> hlo_pb2.HloModuleProto:
+  """Parses the HLO text of a module. Raises HloParseError on syntax errors.
+  stats, an xlaz.hlo_instrument.LexerStats, records what the lexer does.
+  shape_cache and sharding_cache, if given, are used instead of new caches."""
+  return HloParser(text, stats=stats, shape_cache=shape_cache, sharding_cache=sharding_cache).Run()
@@ -0,0 +1,150 @@
+"""Lexes or parses every module of an XLA dump directory in parallel.
+
+A dump written with --xla_dump_to holds one module_*.txt file per module and
+pass. Files are handed out to a process pool and each worker memory-maps its
+file, lexes or parses it, and sends back the result as bytes: a token table
+as written by xlaz.hlo_cache.SerializeTokenTable, or a serialized
+HloModuleProto. Bytes are cheap to pickle, so the parent process spends
+almost no time receiving results and throughput grows with the number of
+workers.
+
+Usage: xlaz-scan [--parse] [--workers N] [--chunksize N] [--pattern GLOB]
+                 [--output DIR] DIR...
+"""
+import argparse
+import glob
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+from xlaz.hlo_cache import DeserializeTokenTable, SerializeTokenTable
+from xlaz.hlo_lexer import TokenTable, tokenize
+from xlaz.hlo_parser import ParseHloModule
+from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
+
+kScanModes = ('tokens', 'parse')
+
+kDefaultPattern = 'module_*.txt'
+
+class ScanResult(NamedTuple):
+  path: str
+  mode: str
+  data: bytes  # Empty if the file couldn't be scanned.
+  count: int  # Tokens, or instructions if mode is 'parse'.
+  seconds: float  # Time spent in the worker.
+  error: Optional[str] = None
+
+  def tokens(self, text=None) -> TokenTable:
+    """Returns the token table of a 'tokens' result. Token values are read
+    from text, which defaults to the contents of the file."""
+    assert self.mode == 'tokens'
+    if text is None:
+      with open(self.path, 'rb') as f:
+        text = f.read()
+    return DeserializeTokenTable(text, self.data)
+
+  def module(self) -> hlo_pb2.HloModuleProto:
+    """Returns the module of a 'parse' result."""
+    assert self.mode == 'parse'
+    return hlo_pb2.HloModuleProto.FromString(self.data)
+
+def FindDumpFiles(directory: str, pattern: str = kDefaultPattern) -> List[str]:
+  """Returns the files in directory that match pattern, sorted by name."""
+  return sorted(glob.glob(os.path.join(glob.escape(directory), pattern)))
+
+def ScanFile(path: str, mode: str = 'tokens') -> ScanResult:
+  """Lexes or parses the file at path. Errors, whatever their type, are
+  returned in the result rather than raised, so that one bad file doesn't
+  stop a batch."""
+  if mode not in kScanModes:
+    raise ValueError(f"unknown scan mode {mode!r}; expected one of {kScanModes}")
+  start = time.perf_counter()
+  try:
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        # mmap can't map an empty file.
+        text = f.read()
+      else:
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if mode == 'tokens':
+        table = tokenize(text)
+        data, count = SerializeTokenTable(table), len(table)
+      else:
+        module = ParseHloModule(text)
+        data = module.SerializeToString()
+        count = sum(len(computation.instructions) for computation in module.computations)
+    finally:
+      if isinstance(text, mmap.mmap):
+        text.close()
+  except Exception as e:
+    return ScanResult(path, mode, b'', 0, time.perf_counter() - start, f'{type(e).__name__}: {e}')
+  return ScanResult(path, mode, data, count, time.perf_counter() - start)
+
+def _ScanFileWithMode(args) -> ScanResult:
+  return ScanFile(*args)
+
+def ScanFiles(paths: Iterable[str], mode: str = 'tokens', max_workers: Optional[int] = None,
+              chunksize: int = 1) -> Iterator[ScanResult]:
+  """Yields the ScanResult of each path, in order. Files are scanned by a
+  pool of max_workers processes (os.cpu_count() by default), which are sent
+  chunksize paths at a time. With max_workers=1 the files are scanned in this
+  process."""
+  if mode not in kScanModes:
+    raise ValueError(f"unknown scan mode {mode!r}; expected one of {kScanModes}")
+  paths = list(paths)
+  if max_workers is None:
+    max_workers = os.cpu_count() or 1
+  max_workers = max(1, min(max_workers, len(paths)))
+  if max_workers == 1:
+    for path in paths:
+      yield ScanFile(path, mode)
+    return
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    yield from executor.map(_ScanFileWithMode, [(path, mode) for path in paths], chunksize=chunksize)
+
+def ScanDirectory(directory: str, mode: str = 'tokens', pattern: str = kDefaultPattern,
+                  **kwargs) -> Iterator[ScanResult]:
+  """Yields the ScanResult of each file in directory that matches pattern.
+  See ScanFiles for the other arguments."""
+  return ScanFiles(FindDumpFiles(directory, pattern), mode, **kwargs)
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(prog='xlaz-scan', description="Lex or parse the HLO modules of XLA dump directories.")
+  parser.add_argument('directories', nargs='+', metavar='DIR')
+  parser.add_argument('--parse', action='store_true', help="parse modules instead of only lexing them")
+  parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+  parser.add_argument('--chunksize', type=int, default=1, help="files sent to a worker at a time")
+  parser.add_argument('--pattern', default=kDefaultPattern, help=f"file name pattern (default: {kDefaultPattern})")
+  parser.add_argument('--output', metavar='DIR', help="write each result to DIR as <name>.tokens or <name>.hlo.pb")
+  args = parser.parse_args(argv)
+  mode = 'parse' if args.parse else 'tokens'
+  paths = [path for directory in args.directories for path in FindDumpFiles(directory, args.pattern)]
+  if args.output:
+    os.makedirs(args.output, exist_ok=True)
+  suffix = '.hlo.pb' if args.parse else '.tokens'
+  unit = 'instructions' if args.parse else 'tokens'
+  start = time.perf_counter()
+  total_bytes = total_count = failures = 0
+  for result in ScanFiles(paths, mode, max_workers=args.workers, chunksize=args.chunksize):
+    if result.error is not None:
+      failures += 1
+      print(f'{result.path}: {result.error}', file=sys.stderr)
+      continue
+    total_bytes += os.path.getsize(result.path)
+    total_count += result.count
+    print(f'{result.path}: {result.count} {unit} in {result.seconds:.3f}s')
+    if args.output:
+      name = os.path.splitext(os.path.basename(result.path))[0]
+      with open(os.path.join(args.output, name + suffix), 'wb') as f:
+        f.write(result.data)
+  elapsed = time.perf_counter() - start
+  print(f'{len(paths) - failures} files, {total_bytes / 2**20:.1f} MB, {total_count} {unit} in {elapsed:.3f}s'
+        + (f', {failures} failed' if failures else ''))
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,76 @@
+"""An in-memory cache of parsed shapes, keyed by their text.
+
+Modules repeat a handful of shapes on most of their instructions, such as
+`f32[5,7,11,13]{3,2,1,0}` on every elementwise op. HloParser looks the text
+of each array shape up in a ShapeCache: on a hit it copies the cached
+ShapeProto, layout included, and skips the shape's tokens without lexing
+them. On a miss it parses the shape token by token and caches the result.
+
+The cache is a bounded LRU. Each distinct shape text is parsed once while it
+stays in the cache, and hits, misses and evictions are counted so that the
+hit rate of a module can be checked. Cached protos are never handed out:
+callers get a copy, so the entries can't be modified.
+"""
+from collections import OrderedDict
+from typing import Optional, Union
+
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+
+class ShapeCache:
+  """Parsed shapes by text, keeping at most max_size of them. A max_size of
+  0 disables the cache."""
+  def __init__(self, max_size: int = 4096):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.entries_ = OrderedDict()
+
+  def __len__(self):
+    return len(self.entries_)
+
+  def get(self, key: Union[str, bytes], shape: xd.ShapeProto) -> bool:
+    """Copies the shape cached for key into shape. Returns False, and leaves
+    shape alone, if key isn't cached."""
+    cached = self.entries_.get(key)
+    if cached is None:
+      self.misses += 1
+      return False
+    self.hits += 1
+    self.entries_.move_to_end(key)
+    shape.CopyFrom(cached)
+    return True
+
+  def put(self, key: Union[str, bytes], shape: xd.ShapeProto):
+    """Caches a copy of shape for key, evicting the least recently used entry
+    if the cache is full."""
+    if self.max_size <= 0:
+      return
+    cached = type(shape)()
+    cached.CopyFrom(shape)
+    self.entries_[key] = cached
+    self.entries_.move_to_end(key)
+    while len(self.entries_) > self.max_size:
+      self.entries_.popitem(last=False)
+      self.evictions += 1
+
+  def clear(self):
+    """Removes every entry. The counters are kept."""
+    self.entries_.clear()
+
+  @property
+  def hit_rate(self) -> Optional[float]:
+    """The fraction of lookups that were hits, or None before any lookup."""
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else None
+
+  def report(self) -> dict:
+    """Returns the counters as a dict of plain values, ready for json.dump."""
+    return {
+      'size': len(self.entries_),
+      'max_size': self.max_size,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': self.hit_rate,
+    }
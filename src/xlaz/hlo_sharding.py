@@ -0,0 +1,44 @@
+"""Interned shardings and their tile assignments as NumPy arrays.
+
+SPMD modules repeat the same few sharding attributes on most instructions,
+and a sharding over a whole pod lists thousands of device ids. HloParser
+looks the text of each sharding up in a ShardingCache and copies the cached
+OpSharding on a hit, so each distinct sharding is parsed once. Explicit
+device lists that are parsed are converted in one step rather than one
+token per device.
+
+TileAssignment returns the devices of a parsed sharding as a read-only
+NumPy array with the tile assignment dimensions. Arrays are interned, so
+identical shardings share one array.
+"""
+from functools import lru_cache
+from typing import Tuple
+
+from xlaz.hlo_literal import Numpy
+from xlaz.hlo_shape_cache import ShapeCache
+from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+
+class ShardingCache(ShapeCache):
+  """Parsed OpShardings by text, with the same LRU and counters as
+  ShapeCache. Shardings can be long, so fewer are kept by default."""
+  def __init__(self, max_size: int = 1024):
+    super().__init__(max_size)
+
+def TileAssignment(sharding: xd.OpSharding):
+  """Returns the tile assignment of a MAXIMAL or OTHER sharding as a
+  read-only int64 NumPy array whose shape is tile_assignment_dimensions, or
+  None for shardings without one."""
+  if sharding.type == xd.OpSharding.TUPLE:
+    raise ValueError("tuple shardings have no single tile assignment")
+  if sharding.type not in (xd.OpSharding.MAXIMAL, xd.OpSharding.OTHER):
+    return None
+  return InternTileAssignment(tuple(sharding.tile_assignment_dimensions), tuple(sharding.tile_assignment_devices))
+
+@lru_cache(maxsize=1024)
+def InternTileAssignment(dims: Tuple[int, ...], devices: Tuple[int, ...]):
+  np = Numpy()
+  if np is None:
+    raise ImportError("TileAssignment requires numpy")
+  array = np.array(devices, dtype=np.int64).reshape(dims)
+  array.flags.writeable = False
+  return array
@@ -0,0 +1,94 @@
+"""Lexes HLO text from files, mmaps or chunk iterators with bounded memory.
+
+The source is decoded incrementally and lexed one window at a time with
+HloLexer. A window always ends just after a separator character (whitespace
+or ','), which no token other than a string or a /* */ comment can contain,
+so every token that ends inside the window is final. Strings and comments
+that run past the window, and any trailing comment, are lexed again once the
+next chunk has arrived. Peak memory is proportional to the chunk size plus
+the longest run of text without a separator.
+"""
+import codecs
+import mmap
+from typing import Iterable, Iterator, NamedTuple, Union
+
+from xlaz.hlo_lexer import HloLexer, TokenTable, TokKind
+
+kDefaultChunkSize = 1 << 20
+
+kSeparators = (' ', '\t', '\n', '\r', ',')
+
+class Token(NamedTuple):
+  kind: TokKind
+  start: int  # Offset of the token in the decoded text.
+  end: int
+  value: object = None  # As returned by TokenTable.value.
+
+def IterChunks(source, chunk_size: int = kDefaultChunkSize) -> Iterator[Union[bytes, str]]:
+  """Yields the contents of source in pieces of at most chunk_size. source may
+  be an mmap.mmap, a file object opened in binary or text mode, or an iterable
+  of bytes or str chunks."""
+  if isinstance(source, mmap.mmap):
+    for offset in range(0, len(source), chunk_size):
+      yield source[offset:offset + chunk_size]
+  elif hasattr(source, 'read'):
+    while True:
+      chunk = source.read(chunk_size)
+      if not chunk:
+        break
+      yield chunk
+  else:
+    yield from source
+
+def LexStream(source, chunk_size: int = kDefaultChunkSize, encoding: str = 'utf-8') -> Iterator[Token]:
+  """Yields the tokens of source, ending with a kEof token. The kinds and values
+  are the same as those produced by calling HloLexer.Lex() on the whole text,
+  and offsets are relative to the start of the decoded text."""
+  decoder = codecs.getincrementaldecoder(encoding)()
+  chunks = IterChunks(source, chunk_size)
+  pending = ''
+  base = 0
+  final = False
+  while not final:
+    chunk = next(chunks, None)
+    final = chunk is None
+    if final:
+      pending += decoder.decode(b'', final=True)
+    elif isinstance(chunk, str):
+      pending += chunk
+    else:
+      pending += decoder.decode(chunk)
+    if final:
+      cut = len(pending)
+    else:
+      cut = max(pending.rfind(c) for c in kSeparators) + 1
+      if cut <= 0:
+        continue
+    lexer = HloLexer(pending[:cut])
+    table = TokenTable(lexer.data_)
+    resume = 0
+    while True:
+      kind = lexer.Lex()
+      start = lexer.token_state_.token_start.offset_
+      end = lexer.current_ptr_.offset_
+      if kind == TokKind.kEof:
+        if final:
+          yield Token(kind, base + start, base + end)
+        break
+      if kind == TokKind.kError and not final and (
+          lexer.data_.startswith('"', start) or lexer.data_.startswith('/*', start)):
+        # A string or comment that continues in the next chunk.
+        break
+      table.append(kind, start, end, lexer.token_state_)
+      yield Token(kind, base + start, base + end, table.value(len(table) - 1))
+      resume = end
+      if kind == TokKind.kError and end == start:
+        # The lexer can't make progress past this character.
+        return
+    pending = pending[resume:]
+    base += resume
+
+def LexFile(path, chunk_size: int = kDefaultChunkSize, encoding: str = 'utf-8') -> Iterator[Token]:
+  """Yields the tokens of the HLO text file at path. See LexStream."""
+  with open(path, 'rb') as f:
+    yield from LexStream(f, chunk_size=chunk_size, encoding=encoding)
@@ -1,12 +1,53 @@
-from tensorflow_checkpoint_reader.pb.tensorflow.compiler.xla.service import hlo_pb2
-from tensorflow_checkpoint_reader.pb.tensorflow.compiler.xla import xla_pb2
-from tensorflow_checkpoint_reader.pb.tensorflow.compiler.xla import xla_data_pb2
-
+# The protobuf modules of tensorflow_checkpoint_reader, under xlaz.pb. A finder
+# on sys.meta_path aliases every module below xlaz.pb to the one of the same
+# name below tensorflow_checkpoint_reader.pb, so each is only imported, along
+# with protobuf, when first used.
+import importlib as _importlib
+import importlib.machinery as _machinery
 import sys as _sys
 
-_sys.modules.update({
-  k.replace('tensorflow_checkpoint_reader.pb.', __name__+'.'): v
-  for k, v in _sys.modules.items()
-  if k.startswith('tensorflow_checkpoint_reader.pb.')})
+_prefix = __name__ + '.'
+_target = 'tensorflow_checkpoint_reader.pb.'
+
+_aliases = {
+  'hlo_pb2': _prefix + 'tensorflow.compiler.xla.service.hlo_pb2',
+  'xla_pb2': _prefix + 'tensorflow.compiler.xla.xla_pb2',
+  'xla_data_pb2': _prefix + 'tensorflow.compiler.xla.xla_data_pb2',
+}
+
+# Not derived from importlib.abc, which takes longer to import than the rest
+# of xlaz.pb.
+class _AliasFinder:
+  def find_spec(self, fullname, path, target=None):
+    if not fullname.startswith(_prefix):
+      return None
+    # The parents of the aliased module are namespace packages, which are
+    # cheap to import.
+    name = _target + fullname[len(_prefix):]
+    spec = _machinery.PathFinder.find_spec(name, _importlib.import_module(name.rpartition('.')[0]).__path__)
+    if spec is None:
+      return None
+    return _machinery.ModuleSpec(fullname, self, is_package=spec.submodule_search_locations is not None)
+
+  def create_module(self, spec):
+    return None
+
+  def exec_module(self, module):
+    # The import system returns whatever is in sys.modules once this returns,
+    # so the alias is the module itself rather than a copy of it.
+    _sys.modules[module.__name__] = _importlib.import_module(_target + module.__name__[len(_prefix):])
+
+# Ahead of the path finders, which would otherwise import a second copy of a
+# package's modules under xlaz.pb and register their protos twice.
+if not any(isinstance(finder, _AliasFinder) for finder in _sys.meta_path):
+  _sys.meta_path.insert(0, _AliasFinder())
 
-del _sys
+def __getattr__(name):
+  if name in _aliases:
+    module = _importlib.import_module(_aliases[name])
+  elif name == 'tensorflow':
+    module = _importlib.import_module(_prefix + name)
+  else:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  globals()[name] = module
+  return module
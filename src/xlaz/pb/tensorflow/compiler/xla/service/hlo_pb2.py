@@ -1 +0,0 @@
-from tensorflow_checkpoint_reader.pb.tensorflow.compiler.xla.service.hlo_pb2 import *
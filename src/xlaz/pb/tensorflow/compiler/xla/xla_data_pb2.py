@@ -1 +0,0 @@
-from tensorflow_checkpoint_reader.pb.tensorflow.compiler.xla.xla_data_pb2 import *
@@ -1,15 +1,90 @@
 from functools import lru_cache
 
-from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2 as xd
+# The values of the PrimitiveType enum in xla_data.proto. They are repeated
+# here so that the lexer can recognize primitive types without importing
+# protobuf; test_primitive_types checks them against xla_data_pb2.
+PRIMITIVE_TYPE_INVALID = 0
+PRED = 1
+S8 = 2
+S16 = 3
+S32 = 4
+S64 = 5
+U8 = 6
+U16 = 7
+U32 = 8
+U64 = 9
+F16 = 10
+F32 = 11
+BF16 = 16
+F64 = 12
+C64 = 15
+C128 = 18
+TUPLE = 13
+OPAQUE_TYPE = 14
+TOKEN = 17
+
+kPrimitiveTypes = {
+  'PRIMITIVE_TYPE_INVALID': PRIMITIVE_TYPE_INVALID,
+  'PRED': PRED,
+  'S8': S8,
+  'S16': S16,
+  'S32': S32,
+  'S64': S64,
+  'U8': U8,
+  'U16': U16,
+  'U32': U32,
+  'U64': U64,
+  'F16': F16,
+  'F32': F32,
+  'BF16': BF16,
+  'F64': F64,
+  'C64': C64,
+  'C128': C128,
+  'TUPLE': TUPLE,
+  'OPAQUE_TYPE': OPAQUE_TYPE,
+  'TOKEN': TOKEN,
+}
 
 @lru_cache
 def GetPrimitiveTypeStringMap():
-  d = {k.lower(): v for k, v in xd.PrimitiveType.items() if v not in [xd.PRIMITIVE_TYPE_INVALID, xd.OPAQUE_TYPE]}
-  d['opaque'] = xd.OPAQUE_TYPE
+  d = {k.lower(): v for k, v in kPrimitiveTypes.items() if v not in [PRIMITIVE_TYPE_INVALID, OPAQUE_TYPE]}
+  d['opaque'] = OPAQUE_TYPE
   return d
 
-def StringToPrimitiveType(name) -> xd.PrimitiveType:
+def StringToPrimitiveType(name) -> int:
   return GetPrimitiveTypeStringMap()[str(name)]
 
 def IsPrimitiveTypeName(name) -> bool:
   return str(name) in GetPrimitiveTypeStringMap()
+
+# The bits of each element of an array of the primitive type, or 0 for the
+# types that aren't arrays. PRED takes a byte, as in XLA.
+kBitWidths = {
+  PRIMITIVE_TYPE_INVALID: 0,
+  PRED: 8,
+  S8: 8,
+  S16: 16,
+  S32: 32,
+  S64: 64,
+  U8: 8,
+  U16: 16,
+  U32: 32,
+  U64: 64,
+  F16: 16,
+  F32: 32,
+  BF16: 16,
+  F64: 64,
+  C64: 64,
+  C128: 128,
+  TUPLE: 0,
+  OPAQUE_TYPE: 0,
+  TOKEN: 0,
+}
+
+kByteWidths = {k: (v + 7) // 8 for k, v in kBitWidths.items()}
+
+def BitWidth(type: int) -> int:
+  return kBitWidths[type]
+
+def ByteWidth(type: int) -> int:
+  return kByteWidths[type]
@@ -1,10 +1,51 @@
+import contextlib
+import importlib
+import io
+import mmap
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 import xlaz
+import xlaz.hlo_cache
+import xlaz.hlo_cost
+import xlaz.hlo_diff
+import xlaz.hlo_fingerprint
+import xlaz.hlo_incremental
+import xlaz.hlo_index
+import xlaz.hlo_instrument
 import xlaz.hlo_lexer
+import xlaz.hlo_literal
+import xlaz.hlo_module
+import xlaz.hlo_parser
+import xlaz.hlo_scan
+import xlaz.hlo_shape_cache
+import xlaz.hlo_sharding
+import xlaz.hlo_stream
+import xlaz.pb
+import xlaz.primitive_util
 from xlaz.pb.tensorflow.compiler.xla import xla_data_pb2, xla_pb2
 from xlaz.pb.tensorflow.compiler.xla.service import hlo_pb2
 
+def lex_all(text, engine):
+  """Returns the kind, span and values of every token of text."""
+  TokKind = xlaz.hlo_lexer.TokKind
+  lexer = xlaz.hlo_lexer.HloLexer(text, engine=engine)
+  tokens = []
+  while True:
+    kind = lexer.Lex()
+    state = lexer.token_state_
+    tokens.append((kind, int(state.token_start), int(lexer.current_ptr_), str(state.str_val),
+                   state.int64_val, repr(state.decimal_val), state.primitive_type_val))
+    if kind in (TokKind.kEof, TokKind.kError):
+      return tokens
+
 class XlaTestCase(unittest.TestCase):
   def test_basic(self):
     self.assertEqual(1, 1)
@@ -12,6 +53,33 @@ class XlaTestCase(unittest.TestCase):
     self.assertTrue(xla_pb2.__name__.startswith('tensorflow_checkpoint_reader.'))
     self.assertTrue(xla_data_pb2.__name__.startswith('tensorflow_checkpoint_reader.'))
 
+  def test_lazy_import(self):
+    # The lexer and the package itself must not pay for protobuf or package
+    # metadata; see benchmarks/import_time.py.
+    code = ("import sys, xlaz, xlaz.hlo_lexer, xlaz.hlo_stream, xlaz.pb\n"
+            "print(sorted(m for m in ('google.protobuf', 'importlib.metadata') if m in sys.modules))")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+      [os.path.dirname(os.path.dirname(xlaz.hlo_lexer.__file__)), os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, env=env).stdout
+    self.assertEqual(output.strip(), '[]')
+    self.assertIsInstance(xlaz.__version__, str)
+    self.assertIs(xlaz.pb.hlo_pb2, hlo_pb2)
+    # Every module of tensorflow_checkpoint_reader.pb is aliased, not just
+    # the ones xlaz imports itself.
+    feature_pb2 = importlib.import_module('xlaz.pb.tensorflow.core.example.feature_pb2')
+    self.assertIs(feature_pb2, importlib.import_module('tensorflow_checkpoint_reader.pb.tensorflow.core.example.feature_pb2'))
+    self.assertIs(xlaz.pb.tensorflow.core.example.feature_pb2, feature_pb2)
+    self.assertEqual(feature_pb2.Feature(int64_list=feature_pb2.Int64List(value=[1])).int64_list.value, [1])
+    with self.assertRaises(ImportError):
+      importlib.import_module('xlaz.pb.tensorflow.core.example.no_such_pb2')
+
+  def test_primitive_types(self):
+    self.assertEqual(xlaz.primitive_util.kPrimitiveTypes, dict(xla_data_pb2.PrimitiveType.items()))
+    self.assertEqual(set(xlaz.primitive_util.kBitWidths), set(xla_data_pb2.PrimitiveType.values()))
+    self.assertEqual([xlaz.primitive_util.BitWidth(getattr(xla_data_pb2, name)) for name in ['PRED', 'BF16', 'C128', 'TUPLE']],
+                     [8, 16, 128, 0])
+    self.assertEqual(xlaz.primitive_util.ByteWidth(xla_data_pb2.C64), 8)
+
   def test_lexer(self):
     hlo_string = """
 HloModule module
@@ -31,6 +99,857 @@ ENTRY %elementwise {
       if prev == loc:
         break
 
+  def test_lexer_patterns(self):
+    lexer = xlaz.hlo_lexer.HloLexer('1.5e3 01b_io01->b01 2x3 0_1x1_0 -7 -inf %name.1 "s"')
+    TokKind = xlaz.hlo_lexer.TokKind
+    self.assertEqual(lexer.Lex(), TokKind.kDecimal)
+    self.assertEqual(lexer.token_state_.decimal_val, 1500.0)
+    self.assertEqual(lexer.Lex(), TokKind.kDimLabels)
+    self.assertEqual(lexer.token_state_.str_val, '01b_io01->b01')
+    self.assertEqual(lexer.Lex(), TokKind.kDxD)
+    self.assertEqual(lexer.token_state_.str_val, '2x3')
+    self.assertEqual(lexer.Lex(), TokKind.kPad)
+    self.assertEqual(lexer.token_state_.str_val, '0_1x1_0')
+    self.assertEqual(lexer.Lex(), TokKind.kInt)
+    self.assertEqual(lexer.token_state_.int64_val, -7)
+    self.assertEqual(lexer.Lex(), TokKind.kNegInf)
+    self.assertEqual(lexer.Lex(), TokKind.kName)
+    self.assertEqual(lexer.token_state_.str_val, 'name.1')
+    self.assertEqual(lexer.Lex(), TokKind.kString)
+    self.assertEqual(lexer.token_state_.str_val, 's')
+    self.assertEqual(lexer.Lex(), TokKind.kEof)
+
+  def test_lexer_trivia(self):
+    TokKind = xlaz.hlo_lexer.TokKind
+    def kinds(text):
+      lexer = xlaz.hlo_lexer.HloLexer(text)
+      result = []
+      while result[-1:] not in ([TokKind.kEof], [TokKind.kError]):
+        result.append(lexer.Lex())
+      return result
+    self.assertEqual(kinds('a /* b */ -> // c\n\r\t<= ...'),
+                     [TokKind.kIdent, TokKind.kArrow, TokKind.kLeq, TokKind.kDots, TokKind.kEof])
+    self.assertEqual(kinds('true tuple pred ROOT'),
+                     [TokKind.kw_true, TokKind.kIdent, TokKind.kPrimitiveType, TokKind.kw_ROOT, TokKind.kEof])
+    self.assertEqual(kinds('{ /* unterminated'), [TokKind.kLbrace, TokKind.kError])
+    self.assertEqual(kinds('// comment \0'), [TokKind.kError])
+    self.assertEqual(kinds('a / b'), [TokKind.kIdent, TokKind.kError])
+
+  lexer_corpus = [
+    'HloModule m, is_scheduled=true\n\nENTRY %main.3 (p0: f32[2,3]) -> (f32[2,3], s32[]) {\n'
+    '  %p0 = f32[2,3]{1,0:T(8,128)} parameter(0), sharding={devices=[2,1]<=[2]}\n'
+    '  %c = s32[] constant(-7), metadata={op_name="a/b" source_line=3}\n'
+    '  ROOT %t = (f32[2,3]{1,0}, s32[]) tuple(f32[2,3]{1,0} %p0, %c) // done\n}\n',
+    'window={size=3x3 stride=2x2 pad=0_1x1_0}, dim_labels=b01f_01io->b01f, dim_labels=01b_io01->b01',
+    'constant({1.5e3, -2.5E-3, .5, 1., inf, -inf, nan, -nan, nan(0x3), -nan(0x7ff), nan(0x0)})',
+    'a /* b */ -> // c\n\r\t<= ... %name.1-x: attr= "s\\"q" tuple pred[] token[] last_tile_dim_replicate',
+    'x² ½ été: /* c */ ² /* d */ y',
+    '< -x . .. % "unterminated',
+    'a /* unterminated',
+    'a // b \0 c',
+  ]
+
+  def test_lexer_engines(self):
+    for text in self.lexer_corpus:
+      # Lex every suffix too, so that tokens are also compared when lexing
+      # starts in the middle of a token or after an error.
+      for start in range(len(text)):
+        with self.subTest(text=text, start=start):
+          self.assertEqual(lex_all(text[start:], 'regex'), lex_all(text[start:], 'hand'))
+    with self.assertRaisesRegex(ValueError, 'unknown lexer engine'):
+      xlaz.hlo_lexer.HloLexer('', engine='fast')
+
+  def test_lexer_bytes(self):
+    TokKind = xlaz.hlo_lexer.TokKind
+    with tempfile.TemporaryFile() as f:
+      for text in self.lexer_corpus:
+        if not text.isascii():
+          continue
+        data = text.encode()
+        f.seek(0)
+        f.truncate()
+        f.write(data)
+        f.flush()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+          for buf in (data, bytearray(data), memoryview(data), mapped):
+            for engine in xlaz.hlo_lexer.kLexerEngines:
+              with self.subTest(text=text, buf=type(buf).__name__, engine=engine):
+                self.assertEqual(lex_all(buf, engine), lex_all(text, engine))
+    # Names are views of the buffer until str() is called on them, and string
+    # literals are decoded as UTF-8.
+    lexer = xlaz.hlo_lexer.HloLexer('%n = f32[] constant(0), metadata={op_name="été"}'.encode())
+    self.assertEqual(lexer.Lex(), TokKind.kName)
+    self.assertIsInstance(lexer.token_state_.str_val, xlaz.hlo_lexer.BufferPointer)
+    self.assertEqual(str(lexer.token_state_.str_val), 'n')
+    while lexer.Lex() != TokKind.kString:
+      pass
+    self.assertEqual(lexer.token_state_.str_val, 'été')
+    table = xlaz.hlo_lexer.tokenize(b'ENTRY %e { x="a b" }')
+    self.assertEqual([table.value(i) for i in range(len(table))], [None, 'e', None, 'x', 'a b', None])
+    self.assertEqual(table.token_text(1), '%e')
+
+  def test_lexer_lookahead(self):
+    TokKind = xlaz.hlo_lexer.TokKind
+    lexer = xlaz.hlo_lexer.HloLexer('ROOT %a = s32[] constant(42)')
+    lexed = []
+    LexToken = lexer.LexToken
+    lexer.LexToken = lambda: lexed.append(None) or LexToken()
+    self.assertEqual(lexer.Lex(), TokKind.kw_ROOT)
+    self.assertEqual(lexer.LookAhead(), TokKind.kName)
+    self.assertEqual(lexer.PeekAhead(3), TokKind.kPrimitiveType)
+    self.assertEqual(lexer.GetKind(), TokKind.kw_ROOT)
+    self.assertEqual(lexer.Lex(), TokKind.kName)
+    self.assertEqual(lexer.token_state_.str_val, 'a')
+    kinds = [lexer.Lex() for _ in range(9)]
+    self.assertEqual(kinds[-2:], [TokKind.kRparen, TokKind.kEof])
+    self.assertEqual(lexer.PeekAhead(2), TokKind.kEof)
+    self.assertEqual(len(lexed), 11)
+
+  def test_buffer_pointer(self):
+    BufferPointer = xlaz.hlo_lexer.BufferPointer
+    buf = "HloModule m\nENTRY %e {\n  ROOT %c = f32[] constant(0)\n}"
+    ptr = BufferPointer(buf, 12)
+    self.assertEqual(len(ptr), len(buf) - 12)
+    self.assertEqual(ptr.deref(), 'E')
+    self.assertEqual(ptr.end() - ptr.begin(), len(buf))
+    self.assertEqual(str(ptr.to(ptr + 5)), 'ENTRY')
+    self.assertTrue(ptr < ptr + 1 <= ptr.end())
+    self.assertEqual(ptr, BufferPointer(ptr, 12))
+    # Buffers are compared by identity, not by contents.
+    self.assertNotEqual(ptr, BufferPointer(''.join(buf), 12))
+    lexer = xlaz.hlo_lexer.HloLexer(buf)
+    while lexer.Lex() != xlaz.hlo_lexer.TokKind.kw_ROOT:
+      pass
+    loc = lexer.GetLoc()
+    self.assertEqual(lexer.GetLineAndColumn(loc), (3, 3))
+    self.assertEqual(str(lexer.GetLine(loc)), '  ROOT %c = f32[] constant(0)')
+    # Queries may arrive in any order.
+    self.assertEqual(lexer.GetLineAndColumn(lexer.buf_.begin() + 13), (2, 2))
+    self.assertEqual(lexer.GetLineAndColumn(lexer.buf_.begin() + 4), (1, 4))
+    self.assertEqual(lexer.GetLineAndColumn(lexer.buf_.end()), (4, 2))
+    self.assertEqual(str(lexer.GetLine(lexer.buf_.begin() + 4)), 'HloModule m')
+
+  def test_tokenize(self):
+    TokKind = xlaz.hlo_lexer.TokKind
+    text = 'ENTRY %e { p0: f32[2], x="a b" -1.5 dim=2x3 }'
+    table = xlaz.hlo_lexer.tokenize(text)
+    tokens = [(table.kind(i), table.token_text(i), table.value(i)) for i in range(len(table))]
+    self.assertEqual(tokens, [
+      (TokKind.kw_ENTRY, 'ENTRY', None),
+      (TokKind.kName, '%e', 'e'),
+      (TokKind.kLbrace, '{', None),
+      (TokKind.kName, 'p0:', 'p0'),
+      (TokKind.kPrimitiveType, 'f32', xla_data_pb2.F32),
+      (TokKind.kLsquare, '[', None),
+      (TokKind.kInt, '2', 2),
+      (TokKind.kRsquare, ']', None),
+      (TokKind.kComma, ',', None),
+      (TokKind.kAttributeName, 'x=', 'x'),
+      (TokKind.kString, '"a b"', 'a b'),
+      (TokKind.kDecimal, '-1.5', -1.5),
+      (TokKind.kAttributeName, 'dim=', 'dim'),
+      (TokKind.kDxD, '2x3', '2x3'),
+      (TokKind.kRbrace, '}', None),
+    ])
+
+  def test_instrument(self):
+    TokKind = xlaz.hlo_lexer.TokKind
+    text = '%a = f32[2]{0} constant({1, -inf}), dim_labels=b01f_01io->b01f /* c */ x=3x3'
+    for engine in xlaz.hlo_lexer.kLexerEngines:
+      with self.subTest(engine=engine):
+        tokens = []
+        stats = xlaz.hlo_instrument.LexerStats(callback=lambda kind, start, end: tokens.append(text[start:end]))
+        lexer = xlaz.hlo_lexer.HloLexer(text, engine=engine, stats=stats)
+        self.assertEqual(lexer.Lex(), TokKind.kName)
+        self.assertEqual(lexer.LookAhead(), TokKind.kEqual)
+        while lexer.Lex() != TokKind.kEof:
+          pass
+        self.assertEqual(tokens[:4], ['%a', '=', 'f32', '['])
+        self.assertEqual(tokens[-3:], ['x=', '3x3', ''])
+        report = stats.report()
+        self.assertEqual(report['tokens']['kName'], 1)
+        self.assertEqual(report['tokens']['kAttributeName'], 2)
+        self.assertEqual(report['token_bytes']['kDimLabels'], len('b01f_01io->b01f'))
+        self.assertEqual(report['trivia_bytes'], len(text) - sum(map(len, tokens)))
+        self.assertEqual(sum(report['tokens'].values()), len(tokens))
+        self.assertEqual(report['methods']['LookAhead']['calls'], 1)
+        self.assertEqual(report['methods']['LexToken']['calls'], len(tokens))
+        self.assertEqual(list(report['token_seconds']), list(report['tokens']))
+        self.assertIn('trivia_pattern', stats.format())
+        if engine == 'hand':
+          self.assertEqual(report['methods']['LexMinus']['calls'], 1)
+          # 2, 0, 1 and -inf are tried against dxd_pattern before int_pattern.
+          self.assertEqual(report['patterns']['dxd_pattern'], {'attempts': 5, 'misses': 4})
+        else:
+          self.assertEqual(report['patterns']['token_pattern'], {'attempts': len(tokens), 'misses': 1})
+          # The token the pattern misses is lexed by hand, and timed.
+          self.assertEqual(report['methods']['LexTokenByHand']['calls'], 1)
+        stats.detach(lexer)
+        self.assertNotIn('trivia_pattern', vars(lexer))
+        self.assertEqual(lex_all(text, engine), lex_all(text, engine))
+    # Characters outside the dispatch table go through the timed handlers.
+    stats = xlaz.hlo_instrument.LexerStats()
+    lexer = xlaz.hlo_lexer.HloLexer('\u00e9t\u00e9 \u0661', stats=stats)
+    while lexer.Lex() != TokKind.kEof:
+      pass
+    self.assertEqual(stats.method_calls['LexIdentifier'], 1)
+    self.assertEqual(stats.method_calls['LexNumberOrPattern'], 1)
+    text = 'HloModule m\n\nENTRY %e () -> f32[] {\n  ROOT %c = f32[] constant(1)\n}\n'
+    stats = xlaz.hlo_instrument.LexerStats()
+    module = xlaz.hlo_parser.ParseHloModule(text, stats=stats)
+    self.assertEqual(module.SerializeToString(), xlaz.hlo_parser.ParseHloModule(text).SerializeToString())
+    self.assertEqual(sum(stats.token_counts.values()), len(xlaz.hlo_lexer.tokenize(text)) + 1)
+    self.assertEqual(stats.token_counts[TokKind.kw_ENTRY], 1)
+
+  def test_incremental_lexer(self):
+    def check(lexer, text):
+      table = xlaz.hlo_lexer.tokenize(text)
+      self.assertEqual(lexer.text, text)
+      self.assertEqual([(lexer.kind(i), lexer.span(i)) for i in range(len(lexer))],
+                       [(table.kind(i), (table.starts[i], table.ends[i])) for i in range(len(table))])
+    text = b'%a = f32[2]{0} add(%x, %y), metadata={op_name="a/b"}\n/* c */ %b = s32[] constant(-1)\n' * 20
+    lexer = xlaz.hlo_incremental.IncrementalLexer(text.decode())
+    check(lexer, text)
+    self.assertEqual([lexer.value(i) for i in range(10)], [xlaz.hlo_lexer.tokenize(text).value(i) for i in range(10)])
+    self.assertEqual(lexer.token_text(-2), '-1')
+    # Tokens lexed differently on their own have the value tokenize gives them.
+    for context in (b'nan(0', b'x -nan(', b'-inf(', b'1.5e'):
+      with self.subTest(context=context):
+        table = xlaz.hlo_lexer.tokenize(context)
+        other = xlaz.hlo_incremental.IncrementalLexer(context)
+        self.assertEqual([other.value(i) for i in range(len(other))], [table.value(i) for i in range(len(table))])
+    # Opening a comment or string changes every token up to where it ends.
+    offset = text.index(b'%b')
+    self.assertEqual(lexer.edit(offset, 0, '/*'), xlaz.hlo_incremental.TokenEdit(21, 30, 0))
+    text = text[:offset] + b'/*' + text[offset:]
+    check(lexer, text)
+    self.assertEqual(lexer.edit(offset + 2, 0, '*/'), xlaz.hlo_incremental.TokenEdit(21, 0, 30))
+    text = text[:offset + 2] + b'*/' + text[offset + 2:]
+    check(lexer, text)
+    self.assertGreater(lexer.edit(2, 0, '"').removed, 500)
+    text = text[:2] + b'"' + text[2:]
+    check(lexer, text)
+    with self.assertRaises(IndexError):
+      lexer.edit(len(text), 1)
+    rng = random.Random(0)
+    pieces = [b'/*', b'*/', b'//', b'"', b'\\', b' ', b'\n', b'\0', b'x', b'1', b'-', b'.', b'e5', b'%', b'{', b',', b'=', b':', b'3x3']
+    for step in range(300):
+      offset = rng.randrange(len(text) + 1)
+      deleted = rng.randrange(min(4, len(text) - offset) + 1)
+      inserted = b''.join(rng.choice(pieces) for _ in range(rng.randrange(3)))
+      edit = lexer.edit(offset, deleted, inserted)
+      text = text[:offset] + inserted + text[offset + deleted:]
+      with self.subTest(step=step, edit=edit):
+        check(lexer, text)
+    # Edits that span several blocks, and inserts that split them.
+    text = b'%a = f32[2]{0} add(%x, %y), metadata={op_name="a/b"}\n/* c */ %b = s32[] constant(-1)\n' * 20
+    pieces.remove(b'\0')
+    with mock.patch.object(xlaz.hlo_incremental, 'kBlockSize', 16):
+      lexer = xlaz.hlo_incremental.IncrementalLexer(text)
+      blocks = len(lexer.texts_)
+      for step in range(200):
+        offset = rng.randrange(len(text) + 1)
+        deleted = rng.randrange(min(40, len(text) - offset) + 1)
+        inserted = b''.join(rng.choice(pieces) for _ in range(rng.randrange(20)))
+        edit = lexer.edit(offset, deleted, inserted)
+        text = text[:offset] + inserted + text[offset + deleted:]
+        with self.subTest(block_size=16, step=step, edit=edit):
+          check(lexer, text)
+      self.assertGreater(len(lexer.texts_), blocks)
+
+  def test_index(self):
+    hlo_string = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(f32[] %x, f32[] %y)
+}
+
+ENTRY %main {
+  %param0 = f32[5,7,11,13]{3,2,1,0} parameter(0), metadata={op_name="jit(f)/input"}
+  %c = s32[2,2]{1,0} constant({{1, 2}, {3, 4}})
+  %ar = f32[5,7,11,13]{3,2,1,0} all-reduce(%param0), replica_groups={{0,1}}, to_apply=%add,
+    metadata={op_name="jit(f)/psum"}
+  %sum = f32[5,7,11,13]{3,2,1,0} add(%ar, %param0), metadata={op_name="jit(f)/add"}
+  ROOT %t = (f32[5,7,11,13]{3,2,1,0}, s32[2,2]{1,0}) tuple(%sum, %c)
+}
+"""
+    index = xlaz.hlo_index.HloIndex(hlo_string)
+    self.assertEqual(index.module.SerializeToString(), xlaz.hlo_parser.ParseHloModule(hlo_string).SerializeToString())
+    self.assertEqual(len(index), 8)
+    [ar] = index.opcode('all-reduce')
+    self.assertEqual((ar.name, ar.computation, ar.id), ('ar', 'main', 1 << 32 | 2))
+    self.assertEqual(index.line_and_column(ar), (12, 3))
+    self.assertEqual(index.instruction(ar).opcode, 'all-reduce')
+    self.assertEqual([entry.computation for entry in index.opcode('add')], ['add', 'main'])
+    self.assertEqual([entry.name for entry in index.name('add')], ['add'])
+    self.assertEqual([entry.name for entry in index.name('x', computation='main')], [])
+    uses = index.uses('param0')
+    self.assertEqual([use.user.name for use in uses], ['ar', 'sum'])
+    self.assertEqual(index.line_and_column(uses[1]), (14, 43))
+    self.assertEqual(index.line(uses[1]).strip()[:12], '%sum = f32[5')
+    self.assertEqual(index.uses(index.entry(ar.id)), index.uses('ar'))
+    self.assertEqual([use.user.name for use in index.uses('x')], ['add'])
+    self.assertEqual(index.uses('t'), [])
+    self.assertEqual([entry.name for entry in index.op_name('jit(f)/psum')], ['ar'])
+    self.assertEqual([entry.name for entry in index.op_name(re.compile(r'/(psum|add)$'))], ['ar', 'sum'])
+    self.assertEqual([entry.name for entry in index.op_name(re.compile(r'^jit'))], ['param0', 'ar', 'sum'])
+    self.assertEqual(index.op_name(re.compile(r'input.jit')), [])
+    self.assertEqual([entry.name for entry in index.primitive_type('s32')], ['c'])
+    self.assertEqual([entry.name for entry in index.primitive_type(xla_data_pb2.TUPLE)], ['t'])
+    self.assertEqual([entry.name for entry in index.larger_than(5 * 7 * 11 * 13 * 4)], ['t'])
+    self.assertEqual([entry.name for entry in index.larger_than(16)], ['t', 'sum', 'ar', 'param0'])
+    self.assertEqual(index.bytes(index.name('c')[0]), 16)
+    self.assertEqual(xlaz.hlo_index.HloIndex(hlo_string.encode()).uses('param0'), uses)
+
+  def test_fingerprint(self):
+    hlo_string = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(f32[] %x, f32[] %y)
+}
+
+ENTRY %main {
+  %param0 = f32[4,8]{1,0} parameter(0), metadata={op_name="jit(f)/input"}
+  %ar = f32[4,8]{1,0} all-reduce(%param0), replica_groups={{0,1}}, to_apply=%add
+  ROOT %sum = f32[4,8]{1,0} subtract(%ar, %param0), sharding={devices=[2,1]0,1 metadata={{op_name="s"}}}
+}
+"""
+    def fingerprints(text):
+      module = xlaz.hlo_parser.ParseHloModule(text)
+      return xlaz.hlo_fingerprint.ModuleFingerprint(module), xlaz.hlo_fingerprint.ComputationFingerprints(module)
+    module_fingerprint, computation_fingerprints = fingerprints(hlo_string)
+    self.assertEqual(list(computation_fingerprints), ['add', 'main'])
+    self.assertEqual(xlaz.hlo_fingerprint.FingerprintHloModule(hlo_string.encode()), module_fingerprint)
+    # Names, metadata, comments and formatting don't count.
+    renamed = (hlo_string.replace('%add', '%sum.1').replace('%x', '%lhs').replace('param0', 'p')
+               .replace('"jit(f)/input"', '"other"').replace(' metadata={{op_name="s"}}', '')
+               .replace('HloModule module', 'HloModule other /* comment */').replace('  ROOT', '\n  ROOT'))
+    self.assertEqual(fingerprints(renamed), (module_fingerprint, {'sum.1': computation_fingerprints['add'],
+                                                                  'main': computation_fingerprints['main']}))
+    # Operand order, shapes, attributes and callees do.
+    for changed in ['subtract(%param0, %ar)', 'f32[4,8]{0,1} all-reduce', 'replica_groups={{0},{1}}',
+                    'ROOT %add = f32[] multiply', 'devices=[1,2]0,1']:
+      original = {'subtract(%param0, %ar)': 'subtract(%ar, %param0)', 'f32[4,8]{0,1} all-reduce': 'f32[4,8]{1,0} all-reduce',
+                  'replica_groups={{0},{1}}': 'replica_groups={{0,1}}', 'ROOT %add = f32[] multiply': 'ROOT %add = f32[] add',
+                  'devices=[1,2]0,1': 'devices=[2,1]0,1'}[changed]
+      with self.subTest(changed=changed):
+        changed_fingerprint, changed_computations = fingerprints(hlo_string.replace(original, changed))
+        self.assertNotEqual(changed_fingerprint, module_fingerprint)
+        self.assertNotEqual(changed_computations['main'], computation_fingerprints['main'])
+        self.assertEqual(changed_computations['add'] == computation_fingerprints['add'], 'multiply' not in changed)
+    # A computation that calls itself, directly or through another, has no
+    # fingerprint.
+    recursive = """HloModule recursive
+
+%b (p: f32[]) -> f32[] {
+  %p = f32[] parameter(0)
+  ROOT %call = f32[] call(%p), to_apply=%a
+}
+
+%a (p: f32[]) -> f32[] {
+  %p = f32[] parameter(0)
+  ROOT %call = f32[] call(%p), to_apply=%a
+}
+
+ENTRY %main {
+  %p = f32[] parameter(0)
+  ROOT %call = f32[] call(%p), to_apply=%a
+}
+"""
+    for text, cycle in [(recursive, 'a -> a'), (recursive.replace('to_apply=%a\n}\n\nENTRY', 'to_apply=%b\n}\n\nENTRY'), 'b -> a -> b')]:
+      with self.subTest(cycle=cycle):
+        module = xlaz.hlo_parser.ParseHloModule(text)
+        with self.assertRaisesRegex(ValueError, '^computation call graph has a cycle: ' + cycle + '$'):
+          xlaz.hlo_fingerprint.ComputationFingerprints(module)
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+          xlaz.hlo_diff.DiffHloModules(text, text)
+
+  def test_diff(self):
+    old = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(%x, %y)
+}
+
+ENTRY %main {
+  %p = f32[4]{0} parameter(0)
+  %a = f32[4]{0} negate(%p)
+  %b = f32[4]{0} exponential(%a)
+  %c = f32[4]{0} add(%a, %b)
+  %d = f32[4]{0} sqrt(%p)
+  %z = f32[] constant(0)
+  %r = f32[] reduce(%c, %z), dimensions={0}, to_apply=%add
+  ROOT %t = (f32[4]{0}, f32[], f32[4]{0}) tuple(%c, %r, %d)
+}
+"""
+    # Renaming everything changes nothing.
+    renamed = re.sub(r'%(\w+)', r'%\1.1', old)
+    diff = xlaz.hlo_diff.DiffHloModules(old, renamed)
+    self.assertFalse(diff)
+    self.assertEqual(diff.identical_computations, 2)
+    new = (renamed.replace('exponential', 'tanh')
+           .replace('  %c.1 = f32[4]{0} add(%a.1, %b.1)', '  %n = f32[4]{0} abs(%b.1)\n  %c.1 = f32[4]{0} add(%a.1, %n)')
+           .replace('  %d.1 = f32[4]{0} sqrt(%p.1)\n', '')
+           .replace('tuple(%c.1, %r.1, %d.1)', 'tuple(%c.1, %r.1, %p.1)')
+           .replace('ENTRY', '%mul (x: f32[], y: f32[]) -> f32[] {\n  %x = f32[] parameter(0)\n'
+                    '  %y = f32[] parameter(1)\n  ROOT %m = f32[] multiply(%x, %y)\n}\n\nENTRY'))
+    diff = xlaz.hlo_diff.DiffHloModules(old.encode(), new)
+    self.assertTrue(diff)
+    self.assertEqual([(c.old, c.new) for c in diff.computations], [(None, 'mul'), ('main', 'main.1')])
+    self.assertEqual([(i.kind, i.old and i.old.name, i.new and i.new.name) for i in diff.instructions()],
+                     [('removed', 'd', None), ('changed', 'b', 'b.1'), ('added', None, 'n'),
+                      ('changed', 'c', 'c.1'), ('changed', 't', 't.1')])
+    self.assertEqual(xlaz.hlo_diff.FormatDiff(diff).splitlines(), [
+      '+ computation %mul',
+      '@@ computation %main -> main.1',
+      '-14: %d = f32[4]{0} sqrt(%p)',
+      '-12: %b = f32[4]{0} exponential(%a)',
+      '+18: %b.1 = f32[4]{0} tanh(%a.1)',
+      '+19: %n = f32[4]{0} abs(%b.1)',
+      '-13: %c = f32[4]{0} add(%a, %b)',
+      '+20: %c.1 = f32[4]{0} add(%a.1, %n)',
+      '-17: ROOT %t = (f32[4]{0}, f32[], f32[4]{0}) tuple(%c, %r, %d)',
+      '+23: ROOT %t.1 = (f32[4]{0}, f32[], f32[4]{0}) tuple(%c.1, %r.1, %p.1)',
+      '1 added, 1 removed, 3 changed instructions; 1 added, 0 removed, 1 changed, 1 identical computations',
+    ])
+    with tempfile.TemporaryDirectory() as directory:
+      paths = [os.path.join(directory, name) for name in ('old.hlo', 'renamed.hlo', 'new.hlo')]
+      for path, text in zip(paths, (old, renamed, new)):
+        with open(path, 'w') as f:
+          f.write(text)
+      for other, code, summary in [(paths[1], 0, '0 added, 0 removed, 0 changed instructions; 0 added, 0 removed, 0 changed, 2 identical computations'),
+                                   (paths[2], 1, '1 added, 1 removed, 3 changed instructions; 1 added, 0 removed, 1 changed, 1 identical computations')]:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+          self.assertEqual(xlaz.hlo_diff.main(['--summary', paths[0], other]), code)
+        self.assertEqual(output.getvalue(), summary + '\n')
+
+  @unittest.skipIf(xlaz.hlo_literal.Numpy() is None, "requires numpy")
+  def test_cost(self):
+    hlo_string = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(%x, %y)
+}
+
+ENTRY %main {
+  %p = f32[8,16]{1,0} parameter(0)
+  %w = bf16[16,32]{1,0} parameter(1)
+  %k = f32[3,3,4,6]{3,2,1,0} parameter(2)
+  %i = f32[2,10,10,4]{3,2,1,0} parameter(3)
+  %d = f32[8,32]{1,0} dot(%p, %w), lhs_contracting_dims={1}, rhs_contracting_dims={0}
+  %e = f32[8,32]{1,0} exponential(%d)
+  %cv = f32[2,8,8,6]{3,2,1,0} convolution(%i, %k), window={size=3x3}, dim_labels=b01f_01io->b01f
+  %z = f32[] constant(0)
+  %r = f32[] reduce(%e, %z), dimensions={0,1}, to_apply=%add
+  %t = (f32[8,32]{1,0}, (f32[], pred[4])) tuple(%e, %r)
+  ROOT %g = f32[8,32]{1,0} get-tuple-element(%t), index=0
+}
+"""
+    module = xlaz.hlo_parser.ParseHloModule(hlo_string)
+    cost = xlaz.hlo_cost.CostAnalysis(module)
+    self.assertEqual(len(cost), 14)
+    self.assertEqual(list(cost.ids), [i.id for c in module.computations for i in c.instructions])
+    self.assertEqual(cost.position(module.computations[1].root_id), 13)
+    self.assertEqual(cost.output_bytes.tolist(), [4, 4, 4, 512, 1024, 864, 3200, 1024, 1024, 3072, 4, 4, 1032, 1024])
+    # 2 per multiply-add: 16 for each element of the dot and 3*3*4 for each
+    # of the convolution, and 1 per element of add and exponential.
+    self.assertEqual(cost.flops.tolist(), [0, 0, 1, 0, 0, 0, 0, 2 * 256 * 16, 256, 2 * 768 * 36, 0, 0, 0, 0])
+    # Parameters are live from the start, other buffers until their last
+    # use, and %e and %r until the root, through %t and %g.
+    self.assertEqual(cost.live_bytes.tolist(), [8, 8, 12, 5600, 5600, 5600, 5600, 6624, 6112, 8160, 1028, 1032, 1028, 1028])
+    self.assertEqual(cost.peak_live_bytes(), {'add': 12, 'main': 8160})
+    self.assertEqual(cost.report(), {'instructions': 14, 'output_bytes': 12796, 'flops': 8192 + 256 + 55296 + 1,
+                                     'peak_live_bytes': {'add': 12, 'main': 8160}})
+    dimensions, element_types = xlaz.hlo_cost.ShapeArrays([module.computations[1].instructions[i].shape for i in (0, 2, 5)])
+    self.assertEqual(dimensions.tolist(), [[8, 16, 1, 1], [3, 3, 4, 6], [8, 32, 1, 1]])
+    self.assertEqual(xlaz.hlo_cost.ArrayBytes(dimensions, element_types).tolist(), [512, 864, 1024])
+
+  def test_lex_stream(self):
+    text = ('HloModule m /* a comment,\n spanning lines */ ENTRY %e {\n'
+            '  %c = f32[2] constant({1.5e-3, -inf}), metadata={op_name="a, b"}\n'
+            '  ROOT %t = (f32[2]) tuple(%c) // trailing, comment\n}')
+    table = xlaz.hlo_lexer.tokenize(text)
+    expected = [(table.kind(i), table.starts[i], table.ends[i], table.value(i)) for i in range(len(table))]
+    for chunk_size in [1, 2, 3, 5, 8, 13, 1 << 20]:
+      tokens = list(xlaz.hlo_stream.LexStream(io.BytesIO(text.encode()), chunk_size=chunk_size))
+      self.assertEqual(tokens[-1].kind, xlaz.hlo_lexer.TokKind.kEof)
+      self.assertEqual([tuple(token) for token in tokens[:-1]], expected)
+
+  def test_parser(self):
+    hlo_string = """
+HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(f32[] %x, f32[] %y)
+}
+
+ENTRY %elementwise {
+  %param0 = f32[5,7,11,13]{3,2,1,0} parameter(0),
+    sharding={devices=[1,2,2,1]0,1,2,3},
+    metadata={op_name="test"}
+  %c = f32[2,2]{1,0} constant({{1, 2.5}, {-inf, 4}})
+  %ar = f32[5,7,11,13]{3,2,1,0} all-reduce(%param0), replica_groups={{0,1},{2,3}}, to_apply=%add
+  ROOT %copy = f32[5,7,11,13]{3,2,1,0} copy(%ar), sharding={replicated}
+}"""
+    module = xlaz.hlo_parser.ParseHloModule(hlo_string)
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(hlo_string.encode()).SerializeToString(), module.SerializeToString())
+    self.assertEqual(module.name, 'module')
+    self.assertEqual(module.entry_computation_name, 'elementwise')
+    add, entry = module.computations
+    self.assertEqual(module.entry_computation_id, entry.id)
+    self.assertEqual([i.opcode for i in entry.instructions], ['parameter', 'constant', 'all-reduce', 'copy'])
+    param0, c, ar, copy = entry.instructions
+    self.assertEqual(entry.root_id, copy.id)
+    self.assertEqual(list(param0.shape.dimensions), [5, 7, 11, 13])
+    self.assertEqual(list(param0.shape.layout.minor_to_major), [3, 2, 1, 0])
+    self.assertEqual(param0.sharding.type, xla_data_pb2.OpSharding.OTHER)
+    self.assertEqual(list(param0.sharding.tile_assignment_dimensions), [1, 2, 2, 1])
+    self.assertEqual(list(param0.sharding.tile_assignment_devices), [0, 1, 2, 3])
+    self.assertEqual(param0.metadata.op_name, 'test')
+    self.assertEqual(list(c.literal.f32s), [1, 2.5, float('-inf'), 4])
+    self.assertEqual(list(ar.operand_ids), [param0.id])
+    self.assertEqual(list(ar.called_computation_ids), [add.id])
+    self.assertEqual([list(g.replica_ids) for g in ar.replica_groups], [[0, 1], [2, 3]])
+    self.assertEqual(copy.sharding.type, xla_data_pb2.OpSharding.REPLICATED)
+    self.assertEqual(list(add.program_shape.parameter_names), ['x', 'y'])
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, 'instruction does not exist: missing'):
+      xlaz.hlo_parser.ParseHloModule('HloModule m\nENTRY %e {\n  ROOT %a = f32[] copy(%missing)\n}')
+    # Malformed attributes and literals are reported with their location.
+    malformed = 'HloModule m\nENTRY %e {\n  %p = f32[4,4]{1,0} parameter(0)\n  %k = f32[2,2,1,1]{3,2,1,0} parameter(1)\n  ROOT %r = {}\n}'
+    for root, error in [
+        ('f32[3,3]{1,0} reduce-window(%p, %p), window={size=2x2 stride=1}, to_apply=%e',
+         "5:67: error: expects 'stride=' to have the same number of dimensions as 'size='"),
+        ('c64[4,4]{1,0} fft(%p), fft_type=BAD, fft_length={4}', '5:45: error: unknown fft_type: BAD'),
+        ('f32[] rng(%p, %p), distribution=rng_bad', '5:45: error: unknown distribution: rng_bad'),
+        ('u8[1] constant({300})', "5:29: error: value 300 is out of range for literal's primitive type U8"),
+        ('s32[] constant(-2147483649)', "5:28: error: value -2147483649 is out of range for literal's primitive type S32"),
+        ('f16[] constant(1e10)', "5:28: error: value 10000000000.0 is out of range for literal's primitive type F16"),
+        ('f32[1,3,3,1]{3,2,1,0} convolution(%p, %k), window={size=2x2}, dim_labels=f01f_01io->b01f',
+         "5:86: error: expects each of 'b', 'f' and the spatial dimensions 0 to 1 once in dim labels f01f"),
+    ]:
+      with self.subTest(root=root):
+        with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, '^' + re.escape(error)):
+          xlaz.hlo_parser.ParseHloModule(malformed.replace('{}', root))
+
+  def test_lazy_module(self):
+    hlo_string = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(%x, %y)
+}
+
+%unused {
+  ROOT %c = f32[] constant(1)
+}, execution_thread="main"
+
+ENTRY %main {
+  %p = f32[4]{0} parameter(0)
+  ROOT %r = f32[] reduce(%p, %p), dimensions={0}, to_apply=%add
+}
+"""
+    module = xlaz.hlo_module.LoadHloModule(hlo_string)
+    self.assertEqual(module.name, 'module')
+    self.assertEqual(list(module), ['add', 'unused', 'main'])
+    self.assertEqual(module.entry_computation_name, 'main')
+    entry = module.entry_computation()
+    self.assertEqual(list(entry.instructions[1].called_computation_ids), [module.computation_id('add')])
+    self.assertTrue(module.is_parsed('main'))
+    self.assertFalse(module.is_parsed('add'))
+    self.assertIs(module['main'], entry)
+    self.assertEqual(module.ToProto().SerializeToString(),
+                     xlaz.hlo_parser.ParseHloModule(hlo_string).SerializeToString())
+    self.assertEqual(xlaz.hlo_module.LoadHloModule(memoryview(hlo_string.encode())).ToProto().SerializeToString(),
+                     module.ToProto().SerializeToString())
+    # Computations that end with a '}' at the start of a line are found
+    # without counting bracket tokens one at a time.
+    with mock.patch.object(xlaz.hlo_module, 'ScanBracketTokens', side_effect=AssertionError):
+      for text in (hlo_string, hlo_string.encode(), memoryview(hlo_string.encode())):
+        self.assertEqual(list(xlaz.hlo_module.LoadHloModule(text)), ['add', 'unused', 'main'])
+    # Computations are found by their brackets, whatever the layout, and
+    # braces in strings and comments don't count.
+    layouts = [
+      hlo_string.replace('\n}', '\n  }'),
+      ' '.join(line.strip() for line in hlo_string.splitlines()),
+      hlo_string.replace('dimensions={0}', 'dimensions={0}, metadata={op_name="}\\"\n}"} /* } */ // }'),
+      hlo_string.replace('-> f32[] {', '-> f32[]{:T(128)} { // {'),
+      # A computation that ends in the middle of a line, before one that
+      # ends at the start of one.
+      hlo_string.replace('add(%x, %y)\n}\n\n%unused {', 'add(%x, %y) } %unused {'),
+      hlo_string.replace('add(%x, %y)\n}\n\n%unused {', 'add(%x, %y) }\n%unused () -> f32[] {'),
+    ]
+    for layout in layouts:
+      with self.subTest(layout=layout):
+        lazy = xlaz.hlo_module.LoadHloModule(layout)
+        self.assertEqual(list(lazy), ['add', 'unused', 'main'])
+        self.assertEqual(lazy.entry_computation_name, 'main')
+        self.assertIsNone(lazy.parsed_module)
+        self.assertEqual(lazy.ToProto().SerializeToString(), xlaz.hlo_parser.ParseHloModule(layout).SerializeToString())
+    # Modules that can't be scanned are parsed whole, which reports errors
+    # with their location.
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, r"^9:9: error: expects '=' in instruction"):
+      xlaz.hlo_module.LoadHloModule(hlo_string.replace('ROOT %add = f32[] add(%x, %y)\n}', 'ROOT %add = f32[] add(%x, %y)\n'))
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, r'^\d+:\d+: error: '):
+      xlaz.hlo_module.LoadHloModule(hlo_string.replace('"main"', '"main'))
+
+  def test_parse_parallel(self):
+    hlo_string = """HloModule module
+
+%add (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %add = f32[] add(%x, %y)
+}
+
+%mul (x: f32[], y: f32[]) -> f32[] {
+  %x = f32[] parameter(0)
+  %y = f32[] parameter(1)
+  ROOT %mul = f32[] multiply(%x, %y)
+}
+
+%body (p: (s32[], f32[4])) -> (s32[], f32[4]) {
+  %p = (s32[], f32[4]{0}) parameter(0)
+  %i = s32[] get-tuple-element(%p), index=0
+  %v = f32[4]{0} get-tuple-element(%p), index=1
+  %s = f32[] reduce(%v, %v), dimensions={0}, to_apply=%add
+  ROOT %t = (s32[], f32[4]{0}) tuple(%i, %v)
+}
+
+ENTRY %main (p: f32[4]) -> f32[] {
+  %p = f32[4]{0} parameter(0)
+  ROOT %r = f32[] reduce(%p, %p), dimensions={0}, to_apply=%mul
+}
+"""
+    expected = xlaz.hlo_parser.ParseHloModule(hlo_string).SerializeToString()
+    for max_workers, tasks_per_worker in ((1, 4), (2, 1), (2, 4)):
+      module = xlaz.hlo_module.ParseHloModuleParallel(hlo_string, max_workers=max_workers, tasks_per_worker=tasks_per_worker)
+      self.assertEqual(module.SerializeToString(), expected)
+    for layout in [hlo_string.replace('\n}', '\n  }'), ' '.join(line.strip() for line in hlo_string.splitlines()),
+                   hlo_string.replace('index=1', 'index=1, metadata={op_name="}\\n}"} /* } */')]:
+      with self.subTest(layout=layout):
+        self.assertEqual(xlaz.hlo_module.ParseHloModuleParallel(layout, max_workers=2, tasks_per_worker=2).SerializeToString(),
+                         xlaz.hlo_parser.ParseHloModule(layout).SerializeToString())
+    runs = xlaz.hlo_module.SplitComputations(xlaz.hlo_module.LoadHloModule(hlo_string), 3)
+    self.assertEqual(sum(runs, []), ['add', 'mul', 'body', 'main'])
+    self.assertLessEqual(len(runs), 3)
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, '^6:29: error: instruction does not exist: missing'):
+      xlaz.hlo_module.ParseHloModuleParallel(hlo_string.replace('add(%x, %y)', 'add(%x, %missing)'), max_workers=2)
+
+  @unittest.skipIf(xlaz.hlo_literal.Numpy() is None, "requires numpy")
+  def test_dense_literal(self):
+    def parse(text, bulk=True):
+      minimum = xlaz.hlo_literal.kMinDenseLiteralElements if bulk else 1 << 62
+      with mock.patch.object(xlaz.hlo_literal, 'kMinDenseLiteralElements', minimum):
+        try:
+          return xlaz.hlo_parser.ParseHloModule(text).SerializeToString()
+        except xlaz.hlo_parser.HloParseError as e:
+          return str(e)
+    values = {
+      'pred': ['true', 'false', '0', '1'],
+      's8': ['-128', '127', '0', '5'],
+      'u16': ['65535', '0', '7', '12'],
+      's32': ['-2147483648', '2147483647', '-3', '0'],
+      'u64': ['9223372036854775806', '0', '1', '9'],
+      'f16': ['65504', '-inf', 'nan', '0.5'],
+      'bf16': ['1.00390625', '-0.0', 'inf', '3e38'],
+      'f32': ['1.5e-3', '-inf', 'nan', '-.25'],
+      'f64': ['1e300', '-1', '2.5', '1E-300'],
+    }
+    for element_type, row in values.items():
+      literal = '{ ' + ', '.join('{' + ', '.join(row * 16) + '}' for _ in range(4)) + ' }'
+      text = (f'HloModule m\nENTRY %e {{\n  ROOT %c = {element_type}[4,64]{{1,0}} '
+              f'constant({literal})\n}}\n')
+      with self.subTest(element_type=element_type):
+        expected = parse(text, bulk=False)
+        self.assertEqual(parse(text), expected)
+        self.assertEqual(parse(text.encode()), expected)
+        array, end = xlaz.hlo_literal.ParseDenseLiteral(text, text.index('{ {'),
+                                                         xlaz.primitive_util.StringToPrimitiveType(element_type), [4, 64])
+        self.assertEqual(text[end - 1:end + 1], '})')
+        self.assertEqual(array.dtype, xlaz.hlo_literal.kNumpyTypes[xlaz.primitive_util.StringToPrimitiveType(element_type)])
+        literal = xlaz.hlo_parser.ParseHloModule(text).computations[0].instructions[0].literal
+        converted = xlaz.hlo_literal.LiteralToNumpy(literal)
+        self.assertEqual(converted.shape, (4, 64))
+        self.assertEqual(converted.tobytes(), array.tobytes())
+    # Literals the lexer reads differently, or rejects, are parsed token by token.
+    for body in ['.5', '-nan', '-0', '1 /* c */', '1 2', '2, 3', '-', '0x1']:
+      row = ', '.join(['1'] * 15 + [body])
+      text = f'HloModule m\nENTRY %e {{\n  ROOT %c = f32[16,16]{{1,0}} constant({{ {", ".join(["{" + row + "}"] * 16)} }})\n}}\n'
+      with self.subTest(body=body):
+        self.assertIsNone(xlaz.hlo_literal.ParseDenseLiteral(text, text.index('{ {'), xlaz.primitive_util.F32, [16, 16]))
+        self.assertEqual(parse(text), parse(text, bulk=False))
+
+  def test_shape_cache(self):
+    text = """HloModule m
+ENTRY %e {
+  %p = f32[5,7]{1,0} parameter(0)
+  %q = f32[5,7]{1,0} parameter(1)
+  %a = f32[5,7]{1,0} add(f32[5,7]{1,0} %p, %q)
+  %b = f32[5,7] {0,1} negate(%a)
+  %c = bf16[<=4,8]{1,0:T(8,128)(2,1)} parameter(2)
+  %d = bf16[<=4,8]{1,0:T(8,128)(2,1)} copy(%c)
+  ROOT %t = (f32[5,7]{1,0}, f32[5,7], s32[]) tuple(%a, %b, %c)
+}
+"""
+    uncached = xlaz.hlo_parser.ParseHloModule(text, shape_cache=xlaz.hlo_shape_cache.ShapeCache(0)).SerializeToString()
+    cache = xlaz.hlo_shape_cache.ShapeCache()
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(text, shape_cache=cache).SerializeToString(), uncached)
+    # '{0,1}' after whitespace is parsed token by token.
+    self.assertEqual(sorted(cache.entries_), ['bf16[<=4,8]{1,0:T(8,128)(2,1)}', 'f32[5,7]', 'f32[5,7]{1,0}', 's32[]'])
+    self.assertEqual((cache.hits, cache.misses, cache.evictions), (5, 4, 0))
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(text.encode(), shape_cache=cache).SerializeToString(), uncached)
+    self.assertEqual(cache.report(), {'size': 8, 'max_size': 4096, 'hits': 10, 'misses': 8, 'evictions': 0, 'hit_rate': 10 / 18})
+    # Cached shapes are copied, so changing a parsed shape doesn't change them.
+    module = xlaz.hlo_parser.ParseHloModule(text, shape_cache=cache)
+    module.computations[0].instructions[0].shape.dimensions[0] = 6
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(text, shape_cache=cache).SerializeToString(), uncached)
+    small = xlaz.hlo_shape_cache.ShapeCache(1)
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(text, shape_cache=small).SerializeToString(), uncached)
+    self.assertEqual(len(small), 1)
+    self.assertEqual(small.evictions, small.misses - 1)
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, "^4:21: error: expects '}' at the end of the layout"):
+      xlaz.hlo_parser.ParseHloModule(text.replace('%q = f32[5,7]{1,0}', '%q = f32[5,7]{1,0'), shape_cache=cache)
+
+  def test_sharding_cache(self):
+    text = """HloModule m
+ENTRY %e {
+  %p = f32[8]{0} parameter(0), sharding={devices=[2,4]7,6,5,4,3,2,1,0}
+  %q = f32[8]{0} parameter(1), sharding={devices=[2,4]7,6,5,4,3,2,1,0}
+  %r = f32[8]{0} parameter(2), sharding={devices=[2,2,2]0, 1,\n2,3 /* c */, 4,5,6,7 last_tile_dim_replicate}
+  %s = f32[8]{0} parameter(3), sharding={maximal device=3}
+  ROOT %t = (f32[8]{0}, f32[8]{0}) tuple(%p, %q), sharding={{replicated}, {devices=[2,4]7,6,5,4,3,2,1,0}}
+}
+"""
+    uncached = xlaz.hlo_parser.ParseHloModule(text, sharding_cache=xlaz.hlo_sharding.ShardingCache(0))
+    cache = xlaz.hlo_sharding.ShardingCache()
+    module = xlaz.hlo_parser.ParseHloModule(text, sharding_cache=cache)
+    self.assertEqual(module.SerializeToString(), uncached.SerializeToString())
+    self.assertEqual(xlaz.hlo_parser.ParseHloModule(text.encode(), sharding_cache=cache).SerializeToString(),
+                     uncached.SerializeToString())
+    # The sharding with a comment is parsed token by token.
+    self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 6, 6))
+    p, q, r, s, t = module.computations[0].instructions
+    self.assertEqual(list(r.sharding.tile_assignment_devices), list(range(8)))
+    self.assertTrue(r.sharding.replicate_on_last_tile_dim)
+    if xlaz.hlo_literal.Numpy() is not None:
+      tiles = xlaz.hlo_sharding.TileAssignment(p.sharding)
+      self.assertEqual(tiles.tolist(), [[7, 6, 5, 4], [3, 2, 1, 0]])
+      self.assertFalse(tiles.flags.writeable)
+      self.assertIs(xlaz.hlo_sharding.TileAssignment(t.sharding.tuple_shardings[1]), tiles)
+      self.assertEqual(xlaz.hlo_sharding.TileAssignment(s.sharding).tolist(), [3])
+    self.assertIsNone(xlaz.hlo_sharding.TileAssignment(t.sharding.tuple_shardings[0]))
+    with self.assertRaises(ValueError):
+      xlaz.hlo_sharding.TileAssignment(t.sharding)
+    with self.assertRaisesRegex(xlaz.hlo_parser.HloParseError, r"^4:3: error: tile assignment dimensions \[2, 4\] don't match the 7 devices"):
+      xlaz.hlo_parser.ParseHloModule(text.replace('7,6,5,4,3,2,1,0}\n', '7,6,5,4,3,2,1}\n', 1), sharding_cache=cache)
+
+  def test_cache(self):
+    text = 'HloModule m\nENTRY %e {\n  ROOT %c = f32[2]{0} constant({1.5, -2})\n}\n'
+    with tempfile.TemporaryDirectory() as directory:
+      cache = xlaz.hlo_cache.HloCache(directory)
+      tokens = cache.Tokenize(text)
+      cached = cache.Tokenize(text)
+      self.assertIsInstance(cached.kinds, memoryview)
+      self.assertEqual([(cached.kind(i), cached.value(i)) for i in range(len(cached))],
+                       [(tokens.kind(i), tokens.value(i)) for i in range(len(tokens))])
+      module = cache.ParseHloModule(text)
+      self.assertEqual(str(cache.ParseHloModule(text)), str(module))
+      self.assertEqual(len(os.listdir(directory)), 2)
+      # Other files, and the temporary files of writers, are left alone.
+      for name in ('notes.txt', '.tmp-writing', '.tmp-stale'):
+        with open(os.path.join(directory, name), 'w') as f:
+          f.write('x' * 100)
+      stale = time.time() - 2 * xlaz.hlo_cache.kStaleTemporarySeconds
+      os.utime(os.path.join(directory, '.tmp-stale'), (stale, stale))
+      xlaz.hlo_cache.HloCache(directory, max_bytes=0).Evict()
+      self.assertEqual(sorted(os.listdir(directory)), ['.tmp-stale', '.tmp-writing', 'notes.txt'])
+      cache.Tokenize(text)
+      cache.Clear()
+      self.assertEqual(sorted(os.listdir(directory)), ['.tmp-writing', 'notes.txt'])
+      # Token tables of a str have character offsets, those of its bytes
+      # byte offsets, so each is cached on its own.
+      text = 'HloModule m\nENTRY %e {\n  ROOT %c = f32[] constant(1), metadata={op_name="\u00e9t\u00e9"}\n}\n'
+      for buf in (text, text.encode(), text, text.encode()):
+        with self.subTest(buf=type(buf)):
+          table, expected = cache.Tokenize(buf), xlaz.hlo_lexer.tokenize(buf)
+          self.assertEqual(list(table.starts), list(expected.starts))
+          self.assertEqual([table.value(i) for i in range(len(table))], [expected.value(i) for i in range(len(expected))])
+      self.assertNotEqual(cache.Key(text, 'tokens'), cache.Key(text.encode(), 'tokens'))
+
+  def test_scan(self):
+    texts = {
+      'module_0001.a.txt': 'HloModule a\nENTRY %e {\n  ROOT %c = f32[2]{0} constant({1.5, -2})\n}\n',
+      'module_0002.b.txt': 'HloModule b\nENTRY %e {\n  %p = f32[] parameter(0)\n  ROOT %n = f32[] negate(%p)\n}\n',
+      'module_0003.bad.txt': 'HloModule bad\nENTRY %e {\n  ROOT %a = f32[] copy(%missing)\n}\n',
+      'module_0004.empty.txt': '',
+    }
+    with tempfile.TemporaryDirectory() as directory:
+      for name, text in texts.items():
+        with open(os.path.join(directory, name), 'w') as f:
+          f.write(text)
+      with open(os.path.join(directory, 'other.txt'), 'w') as f:
+        f.write('ignored')
+      paths = xlaz.hlo_scan.FindDumpFiles(directory)
+      self.assertEqual([os.path.basename(path) for path in paths], list(texts))
+      for max_workers in (1, 2):
+        tokens = list(xlaz.hlo_scan.ScanDirectory(directory, max_workers=max_workers, chunksize=2))
+        self.assertEqual([result.path for result in tokens], paths)
+        for result, text in zip(tokens, texts.values()):
+          expected = xlaz.hlo_lexer.tokenize(text)
+          table = result.tokens()
+          self.assertEqual(result.count, len(expected))
+          self.assertEqual([(table.kind(i), table.value(i)) for i in range(len(table))],
+                           [(expected.kind(i), expected.value(i)) for i in range(len(expected))])
+        parsed = list(xlaz.hlo_scan.ScanDirectory(directory, 'parse', max_workers=max_workers))
+        a, b, bad, empty = parsed
+        self.assertEqual(a.module().SerializeToString(), xlaz.hlo_parser.ParseHloModule(texts['module_0001.a.txt']).SerializeToString())
+        self.assertEqual(b.count, 2)
+        self.assertIsNone(b.error)
+        self.assertRegex(bad.error, 'HloParseError: .*instruction does not exist: missing')
+        self.assertEqual(bad.data, b'')
+        self.assertIsNotNone(empty.error)
+      # Unexpected exceptions from one file don't stop the others.
+      parse = xlaz.hlo_scan.ParseHloModule
+      def ParseOrFail(text):
+        if bytes(text[:12]) == b'HloModule b\n':
+          raise RuntimeError("unexpected")
+        return parse(text)
+      with mock.patch.object(xlaz.hlo_scan, 'ParseHloModule', ParseOrFail):
+        a, b, bad, empty = xlaz.hlo_scan.ScanFiles(paths, 'parse', max_workers=1)
+      self.assertIsNone(a.error)
+      self.assertEqual(b.error, 'RuntimeError: unexpected')
+      self.assertRegex(bad.error, '^HloParseError: ')
+      output = os.path.join(directory, 'out')
+      with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        self.assertEqual(xlaz.hlo_scan.main(['--parse', '--workers', '1', '--output', output, directory]), 1)
+      self.assertEqual(sorted(os.listdir(output)), ['module_0001.a.hlo.pb', 'module_0002.b.hlo.pb'])
+
+  def test_benchmark_generator(self):
+    from benchmarks import hlo_generator
+    for computations in (1, 2, 5):
+      config = hlo_generator.GeneratorConfig(computations=computations, instructions=30, constants=0.1, comments=0.2)
+      with self.subTest(computations=computations):
+        text = hlo_generator.generate_module(config)
+        self.assertEqual(text, hlo_generator.generate_module(config))
+        self.assertNotEqual(text, hlo_generator.generate_module(config, seed=1))
+        module = xlaz.hlo_parser.ParseHloModule(text)
+        self.assertEqual(len(module.computations), computations)
+        self.assertEqual(module.computations[-1].name, 'main')
+    text = hlo_generator.module_of_size(50_000)
+    self.assertLess(abs(len(text) - 50_000), 10_000)
+
 
 if __name__ == '__main__':
   unittest.main()